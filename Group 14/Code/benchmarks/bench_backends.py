@@ -0,0 +1,104 @@
+"""Compares the classifier inference backends: the eager model, the eager
+model with BatchNorm folded, and the exported TorchScript and ONNX files.
+
+The model gets random weights and BatchNorm statistics, so no trained
+weights are needed; the speed doesn't depend on the weights.
+
+Usage:
+    python bench_backends.py [--batch-size 64] [--threads 4]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "modules", "helpers"))
+
+import numpy as np
+import torch
+import torch.nn as nn
+from classifier import (build_model, fold_model, export_model, EagerBackend,
+                        TorchScriptBackend, OnnxBackend)
+
+
+def randomize_batchnorm(model, rng):
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, (nn.BatchNorm1d, nn.BatchNorm2d)):
+                n = module.num_features
+                module.running_mean.copy_(torch.from_numpy(rng.uniform(-0.5, 0.5, n)))
+                module.running_var.copy_(torch.from_numpy(rng.uniform(0.5, 2.0, n)))
+                module.weight.copy_(torch.from_numpy(rng.uniform(0.5, 1.5, n)))
+                module.bias.copy_(torch.from_numpy(rng.uniform(-0.2, 0.2, n)))
+
+        # Keep the logits small, so that the probabilities don't all end up
+        # at exactly 0 or 1 and can still be compared.
+        model.h1.o.weight.mul_(1e-5)
+
+
+def timed(fn, repeats):
+    fn()    # warm up
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--input-size", type=int, default=150)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, help="number of CPU threads for every backend")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    rng = np.random.RandomState(0)
+    torch.manual_seed(0)
+    start = time.perf_counter()
+    model = build_model()
+    print("build_model took %.2f s" % (time.perf_counter() - start))
+    randomize_batchnorm(model, rng)
+
+    tmp_dir = tempfile.mkdtemp()
+    ts_path = os.path.join(tmp_dir, "model.ts")
+    onnx_path = os.path.join(tmp_dir, "model.onnx")
+
+    start = time.perf_counter()
+    export_model(model, args.input_size, ts_path, onnx_path)
+    print("export took %.1f s" % (time.perf_counter() - start))
+
+    backends = [("eager", lambda: EagerBackend(model, "cpu")),
+                ("eager, folded", lambda: EagerBackend(fold_model(model), "cpu")),
+                ("torchscript", lambda: TorchScriptBackend(ts_path, "cpu"))]
+    try:
+        import onnxruntime
+        backends.append(("onnx", lambda: OnnxBackend(onnx_path, args.threads)))
+    except ImportError:
+        print("onnxruntime is not installed, skipping the ONNX backend")
+
+    x = torch.randn(args.batch_size, 3, args.input_size, args.input_size)
+    reference = None
+
+    print()
+    print("%14s %10s %12s %10s %10s" % ("backend", "load (s)", "images/s", "speedup", "max diff"))
+    for name, make_backend in backends:
+        start = time.perf_counter()
+        backend = make_backend()
+        load_time = time.perf_counter() - start
+
+        t, probs = timed(lambda: backend(x), args.repeats)
+        if reference is None:
+            reference, t_reference = probs, t
+        print("%14s %10.2f %12.1f %9.2fx %10.2g" % (name, load_time, args.batch_size / t,
+                                                   t_reference / t, np.abs(probs - reference).max()))
+
+
+if __name__ == "__main__":
+    main()
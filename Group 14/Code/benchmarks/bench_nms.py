@@ -0,0 +1,138 @@
+"""Compares BlazeFace's weighted NMS, which loops over the frames and faces
+in Python, with nms.weighted_nms(), which does all frames at once.
+
+The baseline below is BlazeFace.nms() from blazeface.py. Every frame gets
+a number of faces, and each face is detected a few times with slightly
+different boxes and scores, like a face that shows up in two or three
+overlapping tiles.
+
+Usage:
+    python bench_nms.py [--frames 64] [--faces 1 4 16 64] [--device cpu]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "modules", "helpers"))
+
+import numpy as np
+import torch
+from nms import weighted_nms
+
+
+def jaccard(box_a, box_b):
+    max_xy = torch.min(box_a[:, None, 2:], box_b[None, :, 2:])
+    min_xy = torch.max(box_a[:, None, :2], box_b[None, :, :2])
+    inter = torch.clamp(max_xy - min_xy, min=0)
+    inter = inter[:, :, 0] * inter[:, :, 1]
+    area_a = ((box_a[:, 2] - box_a[:, 0]) * (box_a[:, 3] - box_a[:, 1]))[:, None]
+    area_b = ((box_b[:, 2] - box_b[:, 0]) * (box_b[:, 3] - box_b[:, 1]))[None, :]
+    return inter / (area_a + area_b - inter)
+
+
+def baseline_weighted_nms(detections, threshold):
+    """BlazeFace._weighted_non_max_suppression()."""
+    if len(detections) == 0: return []
+    output_detections = []
+    remaining = torch.argsort(detections[:, 16], descending=True)
+    while len(remaining) > 0:
+        detection = detections[remaining[0]]
+        ious = jaccard(detection[:4].unsqueeze(0), detections[remaining, :4]).squeeze(0)
+        mask = ious > threshold
+        overlapping = remaining[mask]
+        remaining = remaining[~mask]
+
+        weighted_detection = detection.clone()
+        if len(overlapping) > 1:
+            coordinates = detections[overlapping, :16]
+            scores = detections[overlapping, 16:17]
+            total_score = scores.sum()
+            weighted = (coordinates * scores).sum(dim=0) / total_score
+            weighted_detection[:16] = weighted
+            weighted_detection[16] = total_score / len(overlapping)
+        output_detections.append(weighted_detection)
+    return output_detections
+
+
+def baseline_nms(detections, threshold):
+    """BlazeFace.nms(): one list of detections per frame."""
+    filtered_detections = []
+    for i in range(len(detections)):
+        faces = baseline_weighted_nms(detections[i], threshold)
+        faces = torch.stack(faces) if len(faces) > 0 else torch.zeros((0, 17))
+        filtered_detections.append(faces)
+    return filtered_detections
+
+
+def random_frames(num_frames, faces_per_frame, duplicates, rng):
+    """Returns one tensor of detections per frame. The faces of a frame lie
+    on a grid so they don't overlap each other, and each face is detected
+    1 to duplicates times."""
+    side = max(1, int(np.ceil(np.sqrt(faces_per_frame))))
+    size = 0.8 / side
+    frames = []
+    for _ in range(num_frames):
+        rows = []
+        for f in range(faces_per_frame):
+            y, x = 0.1 + (f // side) * size, 0.1 + (f % side) * size
+            for _ in range(rng.randint(1, duplicates + 1)):
+                d = np.empty(17, dtype=np.float32)
+                jitter = rng.uniform(-0.05, 0.05, 2) * size
+                d[0:4] = [y + jitter[0], x + jitter[1], y + jitter[0] + 0.8 * size, x + jitter[1] + 0.8 * size]
+                d[4:16] = rng.uniform(0, 1, 12)
+                d[16] = rng.uniform(0.75, 1.0)
+                rows.append(d)
+        rng.shuffle(rows)
+        frames.append(torch.from_numpy(np.array(rows, dtype=np.float32).reshape(-1, 17)))
+    return frames
+
+
+def timed(fn, repeats):
+    fn()    # warm up
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=64)
+    parser.add_argument("--faces", type=int, nargs="+", default=[0, 1, 4, 16, 64], help="faces per frame")
+    parser.add_argument("--duplicates", type=int, default=3, help="maximum detections per face")
+    parser.add_argument("--threshold", type=float, default=0.3)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    rng = np.random.RandomState(0)
+
+    print("%d frames, up to %d detections per face, device %s" % (args.frames, args.duplicates, device))
+    print()
+    print("%10s %12s %16s %16s %9s %6s" % ("faces/frm", "detections", "before (us/frm)",
+                                           "after (us/frm)", "speedup", "same"))
+    for faces in args.faces:
+        per_frame = [d.to(device) for d in random_frames(args.frames, faces, args.duplicates, rng)]
+        detections = torch.cat(per_frame)
+        frame_ids = torch.repeat_interleave(torch.arange(args.frames, device=device),
+                                            torch.tensor([len(d) for d in per_frame], device=device))
+
+        t_before, before = timed(lambda: baseline_nms(per_frame, args.threshold), args.repeats)
+        t_after, after = timed(lambda: weighted_nms(detections, frame_ids, args.frames, args.threshold),
+                               args.repeats)
+
+        same = all(a.shape == b.shape and torch.allclose(a.cpu(), b.cpu(), atol=1e-5)
+                   for a, b in zip(before, after))
+        us_before = t_before / args.frames * 1e6
+        us_after = t_after / args.frames * 1e6
+        print("%10d %12d %16.1f %16.1f %8.1fx %6s" % (faces, len(detections), us_before, us_after,
+                                                     us_before / us_after, same))
+
+
+if __name__ == "__main__":
+    main()
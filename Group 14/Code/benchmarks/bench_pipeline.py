@@ -0,0 +1,288 @@
+"""End-to-end benchmark of the detection pipeline on synthetic videos.
+
+Generates videos with cartoon faces (see synthetic.py) at several
+resolutions, lengths and codecs, and measures three levels of the pipeline
+for several frames_per_video settings:
+
+    read_frames           VideoReader.read_frames() on each video
+    process_videos        FaceExtractor.process_videos(), one video at a time
+    predict_on_video_set  DeepfakeDetector.predict_on_video_set(), with the
+                          decoder pool at several worker counts (only on the
+                          first resolution, length and codec)
+    predict_on_videos     DeepfakeDetector.predict_on_videos(), the threaded
+                          version, with the worker counts as decode threads
+                          (also only on the first video)
+
+Every measurement runs in a fresh Python process, so that its peak RSS can
+be reported. Per-stage latency percentiles come from metrics.py; for
+predict_on_video_set, decoding and tiling happen in the decoder processes
+and are not part of the stages.
+
+Without --blazeface-dir, SyntheticFaceDetector stands in for BlazeFace, and
+without --model the classifier has random weights. Neither changes how much
+work the rest of the pipeline does. Everything runs on the CPU.
+
+The results are written as JSON. Pass an earlier file with --compare to
+see the change in videos/sec for every measurement, e.g. between commits.
+
+Usage:
+    python bench_pipeline.py [--quick] [--output results.json] [--compare old.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+HELPERS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "modules", "helpers")
+sys.path.insert(0, HELPERS)
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """The peak resident set size of this process (or of its largest child
+    that has finished, with RUSAGE_CHILDREN) in MB."""
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss / 1024**2 if sys.platform == "darwin" else maxrss / 1024
+
+
+def summarize(report):
+    """Keeps the interesting parts of metrics.to_dict()."""
+    stages = {}
+    for name, h in report["stages"].items():
+        stages[name] = { "count": h["count"],
+                         "mean_ms": h["mean"] * 1000,
+                         "p50_ms": h["p50"] * 1000,
+                         "p90_ms": h["p90"] * 1000,
+                         "p99_ms": h["p99"] * 1000 }
+    return stages, report["counters"]
+
+
+def make_detector(case):
+    if case["blazeface_dir"] is not None:
+        from pipeline import load_blazeface
+        return load_blazeface(case["blazeface_dir"], "cpu")
+    from synthetic import SyntheticFaceDetector
+    return SyntheticFaceDetector()
+
+
+def run_case(case):
+    """Runs one measurement. This is called in its own process."""
+    import numpy as np
+    from metrics import metrics
+
+    if case["threads"] is not None and case["benchmark"] != "read_frames":
+        import torch
+        torch.set_num_threads(case["threads"])
+
+    paths = [case["video"]] * case["videos"]
+    fpv = case["frames_per_video"]
+    metrics.enable(keep_samples=True)
+
+    if case["benchmark"] == "read_frames":
+        from read_video_1 import VideoReader
+        reader = VideoReader(verbose=False)
+        run = lambda: [reader.read_frames(path, fpv) for path in paths]
+        reader.read_frames(paths[0], fpv)    # warm up
+
+    elif case["benchmark"] == "process_videos":
+        from read_video_1 import VideoReader
+        from face_extract_1 import FaceExtractor
+        reader = VideoReader(verbose=False)
+        extractor = FaceExtractor(lambda x: reader.read_frames(x, num_frames=fpv), make_detector(case))
+        input_dir = os.path.dirname(paths[0])
+        filenames = [os.path.basename(path) for path in paths]
+        run = lambda: [extractor.process_videos(input_dir, filenames, [i]) for i in range(len(paths))]
+        extractor.process_videos(input_dir, filenames, [0])
+
+    elif case["benchmark"] == "predict_on_video_set":
+        from pipeline import DeepfakeDetector
+        detector = DeepfakeDetector(None, case["model"], backend=case["backend"], device="cpu",
+                                    frames_per_video=fpv, facedet=make_detector(case))
+        run = lambda: detector.predict_on_video_set(paths, num_workers=case["workers"],
+                                                    detector_batch_size=case["detector_batch_size"])
+        detector.predict_on_batch(np.zeros((fpv, detector.input_size, detector.input_size, 3), np.uint8))
+
+    elif case["benchmark"] == "predict_on_videos":
+        from pipeline import DeepfakeDetector
+        detector = DeepfakeDetector(None, case["model"], backend=case["backend"], device="cpu",
+                                    frames_per_video=fpv, facedet=make_detector(case))
+        run = lambda: list(detector.predict_on_videos(paths, decode_threads=case["workers"]))
+        detector.predict_on_batch(np.zeros((fpv, detector.input_size, detector.input_size, 3), np.uint8))
+
+    else:
+        raise ValueError("unknown benchmark '%s'" % case["benchmark"])
+
+    metrics.reset()
+    start = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - start
+
+    stages, counters = summarize(metrics.to_dict())
+    result = { "seconds": elapsed,
+               "videos_per_sec": len(paths) / elapsed,
+               "stages": stages,
+               "counters": counters,
+               "peak_rss_mb": peak_rss_mb() }
+    if case["benchmark"] == "predict_on_video_set":
+        # The largest decoder process. (This can't be less than the RSS of
+        # the benchmark's main process when it started this one, which is
+        # why that one stays light.)
+        result["peak_rss_workers_mb"] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return result
+
+
+def run_in_subprocess(case):
+    fd, result_path = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__),
+                               "--case", json.dumps(case), "--result-file", result_path],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if proc.returncode != 0:
+            return { "error": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "failed" }
+        with open(result_path) as f:
+            return json.load(f)
+    finally:
+        os.remove(result_path)
+
+
+def case_key(result):
+    return (result["benchmark"], result["video_name"], result["frames_per_video"], result["workers"])
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=HELPERS,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def parse_resolution(text):
+    w, h = text.lower().split("x")
+    return int(w), int(h)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--resolutions", nargs="+", default=["1920x1080", "1280x720", "640x360"])
+    parser.add_argument("--lengths", type=int, nargs="+", default=[300], help="frames per video")
+    parser.add_argument("--codecs", nargs="+", default=["mp4v", "MJPG"],
+                        help="fourcc codes; the ones OpenCV can't write are skipped")
+    parser.add_argument("--faces", type=int, default=1, help="faces drawn in every video")
+    parser.add_argument("--frames-per-video", type=int, nargs="+", default=[16, 32, 64])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--videos", type=int, default=8, help="videos per measurement")
+    parser.add_argument("--detector-batch-size", type=int, default=256, help="tiles per face detector batch")
+    parser.add_argument("--benchmarks", nargs="+",
+                        default=["read_frames", "process_videos", "predict_on_video_set",
+                                 "predict_on_videos"])
+    parser.add_argument("--blazeface-dir", help="use the real BlazeFace from this folder")
+    parser.add_argument("--model", help="classifier weights; random weights if not given")
+    parser.add_argument("--backend", default="eager", choices=["eager", "torchscript", "onnx"])
+    parser.add_argument("--threads", type=int, help="number of torch CPU threads")
+    parser.add_argument("--quick", action="store_true", help="a small run, for trying things out")
+    parser.add_argument("--cache-dir", default=os.path.join(tempfile.gettempdir(), "deepfake_bench"))
+    parser.add_argument("--output", default="bench_pipeline.json")
+    parser.add_argument("--compare", help="an earlier output file to compare with")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case is not None:
+        result = run_case(json.loads(args.case))
+        with open(args.result_file, "w") as f:
+            json.dump(result, f)
+        return
+
+    if args.quick:
+        args.resolutions = ["640x360"]
+        args.lengths = [60]
+        args.codecs = ["mp4v"]
+        args.frames_per_video = [8, 16]
+        args.workers = [1, 2]
+        args.videos = 4
+
+    from synthetic import cached_video
+
+    videos = []
+    for resolution in args.resolutions:
+        width, height = parse_resolution(resolution)
+        for length in args.lengths:
+            for codec in args.codecs:
+                path = cached_video(args.cache_dir, length, width, height, fourcc=codec,
+                                    num_faces=args.faces)
+                if path is None:
+                    print("skipping codec %s, OpenCV can't write it here" % codec)
+                    continue
+                videos.append((path, "%s_%df_%s" % (resolution, length, codec)))
+    if len(videos) == 0:
+        sys.exit("no videos could be generated")
+
+    cases = []
+    for benchmark in args.benchmarks:
+        end_to_end = benchmark in ("predict_on_video_set", "predict_on_videos")
+        for video, video_name in (videos[:1] if end_to_end else videos):
+            for fpv in args.frames_per_video:
+                workers = args.workers if end_to_end else [None]
+                for w in workers:
+                    cases.append({ "benchmark": benchmark,
+                                   "video": video,
+                                   "video_name": video_name,
+                                   "videos": args.videos,
+                                   "frames_per_video": fpv,
+                                   "workers": w,
+                                   "blazeface_dir": args.blazeface_dir,
+                                   "model": args.model,
+                                   "backend": args.backend,
+                                   "detector_batch_size": args.detector_batch_size,
+                                   "threads": args.threads })
+
+    previous = {}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = { case_key(r): r for r in json.load(f)["results"] if "videos_per_sec" in r }
+
+    print("%-22s %-22s %4s %7s %10s %10s %13s %9s" % ("benchmark", "video", "fpv", "workers",
+          "videos/s", "rss (MB)", "decoder (MB)", "vs old"))
+    results = []
+    for case in cases:
+        result = dict(case)
+        result.update(run_in_subprocess(case))
+        results.append(result)
+
+        if "error" in result:
+            print("%-22s %-22s %4d %7s   error: %s" % (case["benchmark"], case["video_name"],
+                  case["frames_per_video"], case["workers"] or "-", result["error"]))
+            continue
+        old = previous.get(case_key(result))
+        change = "%8.2fx" % (result["videos_per_sec"] / old["videos_per_sec"]) if old else "-"
+        workers_rss = "%.0f" % result["peak_rss_workers_mb"] if "peak_rss_workers_mb" in result else "-"
+        print("%-22s %-22s %4d %7s %10.2f %10.0f %13s %9s" % (case["benchmark"], case["video_name"],
+              case["frames_per_video"], case["workers"] or "-", result["videos_per_sec"],
+              result["peak_rss_mb"], workers_rss, change))
+
+    import cv2
+    import torch
+    output = { "commit": git_commit(),
+               "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+               "machine": { "platform": platform.platform(),
+                            "python": platform.python_version(),
+                            "cpu_count": os.cpu_count(),
+                            "torch": torch.__version__,
+                            "opencv": cv2.__version__ },
+               "detector": "blazeface" if args.blazeface_dir else "synthetic",
+               "classifier": args.model or "random weights",
+               "results": results }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print("\nwrote %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
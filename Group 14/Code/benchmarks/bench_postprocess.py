@@ -0,0 +1,152 @@
+"""Measures the per-frame cost of turning raw BlazeFace tile detections
+into face crops: projecting them back to frame coordinates, combining the
+tiles of each frame, adding the margins and cropping.
+
+The baseline is the old implementation, which looped over the tiles and
+the coordinate pairs in Python and moved every face box to the CPU on its
+own. NMS is the same in both versions, so it is left out here (the fake
+detector's nms() just passes the detections through).
+
+Usage:
+    python bench_postprocess.py [--frames 64] [--faces-per-tile 2] [--device cpu]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "modules", "helpers"))
+
+import numpy as np
+import torch
+from face_extract_1 import FaceExtractor
+
+
+class PassThroughDetector:
+    input_size = (128, 128)
+
+    def nms(self, detections):
+        return detections
+
+
+def baseline_postprocess(extractor, frames, detections, target_size, resize_info):
+    """The old _resize_detections / _untile_detections / _crop_faces code."""
+    target_w, target_h = target_size
+    scale_w, scale_h, offset_x, offset_y = resize_info
+
+    projected = []
+    for i in range(len(detections)):
+        detection = detections[i].clone()
+        for k in range(2):
+            detection[:, k*2    ] = (detection[:, k*2    ] * target_h - offset_y) * scale_h
+            detection[:, k*2 + 1] = (detection[:, k*2 + 1] * target_w - offset_x) * scale_w
+        for k in range(2, 8):
+            detection[:, k*2    ] = (detection[:, k*2    ] * target_w - offset_x) * scale_w
+            detection[:, k*2 + 1] = (detection[:, k*2 + 1] * target_h - offset_y) * scale_h
+        projected.append(detection)
+
+    num_frames = frames.shape[0]
+    frame_size = (frames.shape[2], frames.shape[1])
+    W, H = frame_size
+    _, _, origins = extractor._tile_grid(W, H, target_size)
+
+    combined = []
+    i = 0
+    for f in range(num_frames):
+        detections_for_frame = []
+        for ox, oy in origins:
+            x = ox * scale_w
+            y = oy * scale_h
+            detection = projected[i].clone()
+            if detection.shape[0] > 0:
+                for k in range(2):
+                    detection[:, k*2    ] += y
+                    detection[:, k*2 + 1] += x
+                for k in range(2, 8):
+                    detection[:, k*2    ] += x
+                    detection[:, k*2 + 1] += y
+            detections_for_frame.append(detection)
+            i += 1
+        combined.append(torch.cat(detections_for_frame))
+
+    result = []
+    for i in range(len(combined)):
+        boxes = extractor._add_margin_to_detections(combined[i], frame_size, 0.2)
+        faces = []
+        for j in range(len(boxes)):
+            ymin, xmin, ymax, xmax = boxes[j, :4].cpu().numpy().astype(int)
+            faces.append(frames[i][ymin:ymax, xmin:xmax, :])
+        scores = list(combined[i][:, 16].cpu().numpy())
+        result.append({ "faces": faces, "scores": scores })
+    return result
+
+
+def random_detections(num_tiles, faces_per_tile, device, rng):
+    detections = []
+    for _ in range(num_tiles):
+        d = torch.from_numpy(rng.uniform(0.1, 0.9, (faces_per_tile, 17)).astype(np.float32))
+        d[:, 2:4] = d[:, 0:2] + 0.1
+        detections.append(d.to(device))
+    return detections
+
+
+def timed(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=64)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--faces-per-tile", type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    extractor = FaceExtractor(None, PassThroughDetector())
+    target_size = extractor.facedet.input_size
+    frames = np.zeros((args.frames, args.height, args.width, 3), dtype=np.uint8)
+    tiles_shape = extractor.tiles_shape(args.frames, args.width, args.height, target_size)
+    num_tiles = tiles_shape[0]
+    resized_w, resized_h, _ = extractor._tile_grid(args.width, args.height, target_size)
+    resize_info = [args.width / resized_w, args.height / resized_h, 0, 0]
+    frame_idxs = list(range(args.frames))
+    rng = np.random.RandomState(0)
+
+    print("%d frames x %d tiles, %dx%d, device %s" % (args.frames, num_tiles // args.frames,
+                                                     args.width, args.height, device))
+    print()
+    print("%14s %16s %16s %9s %6s" % ("faces/tile", "before (us/frm)", "after (us/frm)", "speedup", "same"))
+    for faces_per_tile in args.faces_per_tile:
+        detections = random_detections(num_tiles, faces_per_tile, device, rng)
+
+        t_before, before = timed(lambda: baseline_postprocess(extractor, frames, detections,
+                                                              target_size, resize_info), args.repeats)
+        t_after, after = timed(lambda: extractor._process_detections(0, frames, frame_idxs, detections,
+                                                                    target_size, resize_info), args.repeats)
+
+        # The crops are views into frames, so the same box means the same
+        # shape and the same start address.
+        same = all(len(a["faces"]) == len(b["faces"])
+                   and all(fa.shape == fb.shape and 
+                           fa.__array_interface__["data"] == fb.__array_interface__["data"]
+                           for fa, fb in zip(a["faces"], b["faces"]))
+                   and np.allclose(a["scores"], b["scores"])
+                   for a, b in zip(before, after))
+
+        us_before = t_before / args.frames * 1e6
+        us_after = t_after / args.frames * 1e6
+        print("%14d %16.1f %16.1f %8.1fx %6s" % (faces_per_tile, us_before, us_after,
+                                                 us_before / us_after, same))
+
+
+if __name__ == "__main__":
+    main()
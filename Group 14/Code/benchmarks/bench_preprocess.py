@@ -0,0 +1,129 @@
+"""Compares the batched face crop preprocessing (preprocess.Preprocessor)
+against the old code in final_project.py, which resized and padded every
+crop on its own and then normalized the batch one face at a time.
+
+Usage:
+    python bench_preprocess.py [--faces 16 64 128] [--device cpu]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "modules", "helpers"))
+
+import cv2
+import numpy as np
+import torch
+from preprocess import Preprocessor
+
+
+mean = [0.485, 0.456, 0.406]
+std = [0.229, 0.224, 0.225]
+
+
+def resize_image(img, size, resample=cv2.INTER_AREA):
+    h, w = img.shape[:2]
+    if w > h:
+        h = h * size // w
+        w = size
+    else:
+        w = w * size // h
+        h = size
+
+    resized = cv2.resize(img, (w, h), interpolation=resample)
+    return resized
+
+
+def make_square_image(img):
+    h, w = img.shape[:2]
+    size = max(h, w)
+    t = 0
+    b = size - h
+    l = 0
+    r = size - w
+    return cv2.copyMakeBorder(img, t, b, l, r, cv2.BORDER_CONSTANT, value=0)
+
+
+def normalize_transform(x):
+    # What torchvision.transforms.Normalize(mean, std) does to a tensor.
+    m = torch.tensor(mean, dtype=x.dtype, device=x.device)[:, None, None]
+    s = torch.tensor(std, dtype=x.dtype, device=x.device)[:, None, None]
+    return (x - m) / s
+
+
+def baseline_normalize(x, device):
+    """The start of the old predict_on_batch()."""
+    x = torch.tensor(x, device=device).float()
+    x = x.permute((0, 3, 1, 2))
+    for i in range(len(x)):
+        x[i] = normalize_transform(x[i] / 255.)
+    return x
+
+
+def baseline_preprocess(crops, size, device):
+    """The old prepare_faces() followed by baseline_normalize()."""
+    x = np.stack([make_square_image(resize_image(face, size)) for face in crops])
+    return baseline_normalize(x, device)
+
+
+def random_crops(num_faces, rng):
+    crops = []
+    for _ in range(num_faces):
+        h = rng.randint(80, 400)
+        w = int(h * rng.uniform(0.7, 1.1))
+        crops.append(rng.randint(0, 256, (h, w, 3), dtype=np.uint8))
+    return crops
+
+
+def timed(fn, device, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--faces", type=int, nargs="+", default=[16, 64, 128])
+    parser.add_argument("--size", type=int, default=150)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    preprocessor = Preprocessor(args.size, mean, std, device=device)
+    rng = np.random.RandomState(0)
+
+    print("input %dx%d, device %s" % (args.size, args.size, device))
+    print()
+    print("%24s %24s" % ("crops -> batch (ms)", "uint8 -> batch (ms)"))
+    print("%6s %8s %8s %7s %8s %8s %7s %9s" % ("faces", "before", "after", "speedup",
+                                             "before", "after", "speedup", "max diff"))
+    for num_faces in args.faces:
+        crops = random_crops(num_faces, rng)
+        stacked = np.stack([make_square_image(resize_image(face, args.size)) for face in crops])
+
+        # From the variable-size crops, as prepare_faces() + predict_on_batch().
+        t_before, before = timed(lambda: baseline_preprocess(crops, args.size, device), device, args.repeats)
+        t_after, after = timed(lambda: preprocessor.from_crops(crops), device, args.repeats)
+        diff = (before - after).abs().max().item()
+
+        # Only the normalization of an already letterboxed uint8 batch, 
+        # which is the part predict_on_batch() does.
+        t_before2, before = timed(lambda: baseline_normalize(stacked, device), device, args.repeats)
+        t_after2, after = timed(lambda: preprocessor(stacked), device, args.repeats)
+        diff = max(diff, (before - after).abs().max().item())
+
+        print("%6d %8.2f %8.2f %6.1fx %8.2f %8.2f %6.1fx %9.2g" % (
+              num_faces, t_before * 1e3, t_after * 1e3, t_before / t_after,
+              t_before2 * 1e3, t_after2 * 1e3, t_before2 / t_after2, diff))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Compares reading frames with the keyframe seek planner against the
+old linear scan (grab every frame up to the last one we need).
+
+Usage:
+    python bench_seek_planner.py [--frames 3000] [--width 1920] [--height 1080]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "modules", "helpers"))
+
+import numpy as np
+from read_video_1 import VideoReader, read_mp4_keyframes
+from synthetic import cached_video
+
+
+def time_read(reader, path, num_frames, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = reader.read_frames(path, num_frames)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=3000, help="length of the synthetic video")
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--samples", type=int, nargs="+", default=[1, 4, 16, 64, 256])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--video", help="use this video instead of a synthetic one")
+    parser.add_argument("--cache-dir", default=os.path.join(tempfile.gettempdir(), "deepfake_bench"))
+    args = parser.parse_args()
+
+    path = args.video or cached_video(args.cache_dir, args.frames, args.width, args.height)
+    keyframes = read_mp4_keyframes(path)
+    print("video: %s" % path)
+    print("keyframes: %s" % ("unknown" if keyframes is None else len(keyframes)))
+    print()
+
+    scan_reader = VideoReader(verbose=False, keyframe_seek=False)
+    seek_reader = VideoReader(verbose=False, keyframe_seek=True)
+
+    print("%8s %12s %12s %9s %6s" % ("samples", "scan (s)", "planner (s)", "speedup", "same"))
+    for num_frames in args.samples:
+        t_scan, scan_result = time_read(scan_reader, path, num_frames, args.repeats)
+        t_seek, seek_result = time_read(seek_reader, path, num_frames, args.repeats)
+        same = (scan_result is not None and seek_result is not None
+                and scan_result[1] == seek_result[1]
+                and np.array_equal(scan_result[0], seek_result[0]))
+        print("%8d %12.3f %12.3f %8.1fx %6s" % (num_frames, t_scan, t_seek, t_scan / t_seek, same))
+
+
+if __name__ == "__main__":
+    main()
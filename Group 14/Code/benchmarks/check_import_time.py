@@ -0,0 +1,83 @@
+"""Checks that the deepfake-detect command starts quickly.
+
+Runs the command with python -X importtime for a few cheap invocations,
+like --help, and fails (exit code 1) if one of them imports a heavy
+dependency or spends more than the budget on imports or in total.
+
+Usage:
+    python check_import_time.py [--budget 0.25] [--wall-budget 1.0]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+ENTRY_POINT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "deepfake-detect")
+
+# These must only be imported by the stage that needs them.
+HEAVY_MODULES = ["torch", "cv2", "numpy", "pandas", "matplotlib", "pytorchcv",
+                 "torchvision", "onnxruntime", "blazeface"]
+
+INVOCATIONS = [["--help"],
+               ["score", "--help"],
+               ["serve", "--help"],
+               ["job", "--help"],
+               ["merge", "--help"],
+               ["score"]]     # an argument error
+
+
+def parse_importtime(stderr):
+    """Returns the total import time in seconds and the set of top-level
+    module names that were imported."""
+    total_us = 0
+    modules = set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(parts[1])
+        except ValueError:
+            continue    # the header line
+        name = parts[2]
+        modules.add(name.strip().split(".")[0])
+
+        # Nested imports are indented; only count the outermost ones.
+        if not name[1:].startswith(" "):
+            total_us += cumulative
+    return total_us / 1e6, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget", type=float, default=0.25, help="seconds of import time")
+    parser.add_argument("--wall-budget", type=float, default=1.0, help="seconds from start to exit")
+    args = parser.parse_args()
+
+    failed = False
+    print("%-20s %12s %10s  %s" % ("arguments", "imports (s)", "wall (s)", "heavy modules"))
+    for invocation in INVOCATIONS:
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-X", "importtime", ENTRY_POINT] + invocation,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        wall = time.perf_counter() - start
+
+        import_time, modules = parse_importtime(proc.stderr)
+        heavy = [name for name in HEAVY_MODULES if name in modules]
+        ok = import_time <= args.budget and wall <= args.wall_budget and len(heavy) == 0
+        failed = failed or not ok
+
+        print("%-20s %12.3f %10.3f  %s%s" % (" ".join(invocation), import_time, wall,
+                                            ", ".join(heavy) or "-", "" if ok else "   FAIL"))
+
+    if failed:
+        print("\nOver budget: import time %.2f s, wall time %.2f s, no heavy modules." % (
+              args.budget, args.wall_budget))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Generates synthetic test videos for the benchmarks, so they can run
+without the real dataset.
+
+The videos can have cartoon faces drawn into them. SyntheticFaceDetector
+finds those faces again, so the whole pipeline can be benchmarked without
+the BlazeFace weights.
+"""
+
+import os
+import cv2
+import numpy as np
+
+
+# The color the faces are drawn in (RGB, as VideoReader returns frames).
+SKIN_COLOR = (224, 172, 140)
+
+
+def draw_face(frame, cx, cy, size):
+    """Draws a cartoon face of size x size pixels centered at (cx, cy) into
+    a BGR frame: a skin-colored oval with eyes, a nose and a mouth."""
+    skin = SKIN_COLOR[::-1]
+    dark = (40, 30, 30)
+    half = size // 2
+    cv2.ellipse(frame, (cx, cy), (int(half * 0.8), half), 0, 0, 360, skin, -1)
+
+    eye_y = cy - size // 8
+    eye_r = max(1, size // 14)
+    cv2.circle(frame, (cx - size // 5, eye_y), eye_r, dark, -1)
+    cv2.circle(frame, (cx + size // 5, eye_y), eye_r, dark, -1)
+    cv2.line(frame, (cx, eye_y + eye_r), (cx, cy + size // 10), dark, max(1, size // 40))
+    cv2.ellipse(frame, (cx, cy + size // 5), (size // 5, size // 12), 0, 0, 180, dark, max(1, size // 30))
+
+
+def make_video(path, num_frames=250, width=1920, height=1080, fps=30, fourcc="mp4v", num_faces=0):
+    """Writes a video with the frame number drawn into every frame, so that
+    decoding can't be skipped and it's easy to check that the right frame
+    was read. Without faces, a moving blob is drawn instead; with
+    num_faces > 0, that many faces move around.
+
+    Returns the path, or None if OpenCV could not open a writer for this
+    codec.
+    """
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+    if not writer.isOpened():
+        return None
+
+    rng = np.random.RandomState(0)
+    background = rng.randint(0, 64, (height, width, 3)).astype(np.uint8)
+    radius = min(width, height) // 6
+
+    for i in range(num_frames):
+        frame = background.copy()
+        if num_faces == 0:
+            cx = int(width / 2 + width / 4 * np.sin(i / 20.0))
+            cy = int(height / 2 + height / 8 * np.cos(i / 15.0))
+            cv2.circle(frame, (cx, cy), radius, (160, 180, 210), -1)
+
+        for f in range(num_faces):
+            # Spread the faces out horizontally, and let them drift a bit.
+            cx = int(width * (f + 0.5) / num_faces + width / (8 * num_faces) * np.sin(i / 20.0 + f))
+            cy = int(height / 2 + height / 10 * np.cos(i / 15.0 + f))
+            draw_face(frame, cx, cy, int(min(width / num_faces, height) * 0.4))
+
+        cv2.putText(frame, "%d" % i, (20, 60), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+        writer.write(frame)
+
+    writer.release()
+    return path
+
+
+# Codecs that MP4 files can't hold, and the container to use instead.
+CONTAINERS = { "MJPG": ".avi", "XVID": ".avi" }
+
+
+def cached_video(cache_dir, num_frames, width, height, fps=30, fourcc="mp4v", num_faces=0):
+    """Like make_video(), but reuses the file if it was already generated."""
+    os.makedirs(cache_dir, exist_ok=True)
+    name = "synthetic_%dx%d_%df_%s" % (width, height, num_frames, fourcc)
+    if num_faces > 0:
+        name += "_%dfaces" % num_faces
+    path = os.path.join(cache_dir, name + CONTAINERS.get(fourcc, ".mp4"))
+    if os.path.exists(path):
+        return path
+    return make_video(path, num_frames, width, height, fps, fourcc, num_faces)
+
+
+class SyntheticFaceDetector:
+    """Stands in for BlazeFace on videos made with num_faces > 0.
+
+    Finds the skin-colored blobs in each tile and returns them in the same
+    format as BlazeFace: one tensor of shape (num_faces, 17) per tile with
+    normalized ymin, xmin, ymax, xmax, six keypoints and a score. It is
+    much cheaper than the real detector, so the "detect" stage is not
+    representative; everything around it is.
+
+    (torch is imported only when the detector runs, so that generating the
+    videos doesn't need it.)
+    """
+
+    input_size = (128, 128)
+    min_score_thresh = 0.5
+    min_suppression_threshold = 0.3
+
+    def __init__(self, tolerance=40, min_area=64):
+        self.lower = np.array([max(0, c - tolerance) for c in SKIN_COLOR], dtype=np.uint8)
+        self.upper = np.array([min(255, c + tolerance) for c in SKIN_COLOR], dtype=np.uint8)
+        self.min_area = min_area
+
+    def predict_on_batch(self, x, apply_nms=True):
+        import torch
+        if isinstance(x, torch.Tensor):
+            x = x.permute(0, 2, 3, 1).numpy() if x.shape[1] == 3 else x.numpy()
+
+        detections = [self._detect(tile) for tile in x]
+        return self.nms(detections) if apply_nms else detections
+
+    def _detect(self, tile):
+        import torch
+        h, w = tile.shape[:2]
+        mask = cv2.inRange(tile, self.lower, self.upper)
+        _, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+
+        found = []
+        for left, top, bw, bh, area in stats[1:]:
+            if area < self.min_area: continue
+            ymin, xmin, ymax, xmax = top / h, left / w, (top + bh) / h, (left + bw) / w
+            cx, cy = (xmin + xmax) / 2, (ymin + ymax) / 2
+            fw, fh = xmax - xmin, ymax - ymin
+
+            # Eyes, nose, mouth and ears, roughly where draw_face() puts them.
+            keypoints = [cx - 0.2 * fw, cy - 0.12 * fh, cx + 0.2 * fw, cy - 0.12 * fh,
+                         cx, cy + 0.05 * fh, cx, cy + 0.2 * fh,
+                         xmin, cy, xmax, cy]
+            score = min(1.0, area / (0.75 * bw * bh))    # an ellipse fills ~79%
+            found.append([ymin, xmin, ymax, xmax] + keypoints + [score])
+
+        if len(found) == 0:
+            return torch.zeros((0, 17))
+        return torch.tensor(found, dtype=torch.float32)
+
+    def nms(self, detections):
+        """Greedy non-maximum suppression, separately for each tensor."""
+        return [self._nms(d) for d in detections]
+
+    def _nms(self, detections):
+        import torch
+        if len(detections) == 0: return detections
+        order = torch.argsort(detections[:, 16], descending=True)
+        detections = detections[order]
+
+        ymin, xmin, ymax, xmax = detections[:, 0], detections[:, 1], detections[:, 2], detections[:, 3]
+        area = (ymax - ymin) * (xmax - xmin)
+        keep = []
+        suppressed = torch.zeros(len(detections), dtype=torch.bool)
+        for i in range(len(detections)):
+            if suppressed[i]: continue
+            keep.append(i)
+            iw = (torch.min(xmax[i], xmax) - torch.max(xmin[i], xmin)).clamp(min=0)
+            ih = (torch.min(ymax[i], ymax) - torch.max(ymin[i], ymin)).clamp(min=0)
+            inter = iw * ih
+            iou = inter / (area[i] + area - inter)
+            suppressed |= iou > self.min_suppression_threshold
+        return detections[keep]
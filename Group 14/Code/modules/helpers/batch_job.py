@@ -0,0 +1,219 @@
+"""Sharded, resumable scoring of large video folders.
+
+predict_on_video_set() in final_project.py scores every video and writes
+result.csv once, at the very end. If the run dies after ten thousand
+videos, all of that is lost, and the work can't be split over machines.
+
+Here the sorted list of videos is split into num_shards shards, and each
+shard is scored on its own, for example one per machine or per GPU. Every
+shard appends a row to its own CSV file as soon as a video is scored, and
+flushes it to disk. When a shard is started again, it skips the videos
+that already have a row, so a crashed or preempted run simply picks up
+where it left off. Videos that only got the 0.5 fallback because of an
+error (or because they couldn't be read, which may be a passing I/O
+problem) are not done, and are tried again. Finally, merge_shards() puts
+all the rows together in the usual result.csv format (filename, label,
+result).
+
+    videos = shard_videos(all_videos, shard=3, num_shards=16)
+    predict_fn = lambda paths: detector.predict_on_videos(paths, with_reasons=True)
+    run_shard(predict_fn, videos, shard_path("out", 3, 16), fake_threshold=0.6)
+    ...
+    merge_shards("out", "result.csv")
+
+Sharding "by index" takes every num_shards-th video of the sorted list, so
+all machines must see the same list. Sharding "by hash" puts a video in a
+shard based on a hash of its file name, so a video stays in the same shard
+when other videos are added or removed.
+
+Only the standard library is used, so the deepfake-detect CLI can import
+this up front.
+"""
+
+import csv
+import glob
+import hashlib
+import os
+import tempfile
+
+
+FIELDNAMES = ["filename", "label", "result"]
+
+# The shard files also say why a video got the 0.5 fallback, if it did.
+SHARD_FIELDNAMES = FIELDNAMES + ["fallback"]
+
+# Videos whose fallback had one of these reasons are scored again when the
+# shard is resumed.
+RETRY_REASONS = ("error", "unreadable")
+
+
+def shard_of(filename, num_shards):
+    """The shard a video belongs to when sharding by hash. Only the file
+    name counts, not the folder it is in."""
+    digest = hashlib.blake2b(os.path.basename(filename).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % num_shards
+
+
+def shard_videos(videos, shard, num_shards, by="index"):
+    """Returns the videos of one shard, in sorted order.
+
+    Arguments:
+        videos: the video files (or names) of the whole job
+        shard: which shard, from 0 to num_shards - 1
+        num_shards: into how many shards the job is split
+        by: "index" or "hash", see the module docstring
+    """
+    assert 0 <= shard < num_shards, "shard must be between 0 and %d" % (num_shards - 1)
+    videos = sorted(videos)
+    if by == "index":
+        return videos[shard::num_shards]
+    if by == "hash":
+        return [video for video in videos if shard_of(video, num_shards) == shard]
+    raise ValueError("unknown sharding '%s', use 'index' or 'hash'" % by)
+
+
+def shard_path(output_dir, shard, num_shards):
+    """The CSV file that one shard writes its results to."""
+    return os.path.join(output_dir, "shard-%05d-of-%05d.csv" % (shard, num_shards))
+
+
+def _repair(path):
+    """If the last row of a shard file was only partly written (the process
+    died in the middle of it), cuts it off. Returns the column names from
+    the header, or None if the file has no header yet."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb+") as f:
+        data = f.read()
+        if len(data) > 0 and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+        end = data.find(b"\n")
+        if end <= 0:
+            return None
+        return next(csv.reader([data[:end].decode("utf-8").rstrip("\r")]))
+
+
+def read_results(path):
+    """Returns a dictionary with the rows of a shard file (or result.csv)
+    by file name. The values are kept as the strings they were written as.
+    If a video has more than one row (it was tried again), the last one
+    counts. A missing file has no rows."""
+    if not os.path.exists(path):
+        return {}
+    rows = {}
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            if row.get("result") in ("FAKE", "REAL"):
+                rows[row["filename"]] = row
+    return rows
+
+
+def run_shard(predict_fn, videos, output_path, fake_threshold=0.60, verbose=True):
+    """Scores the videos that aren't done in output_path yet, and appends a
+    row for each one as soon as it is scored.
+
+    Arguments:
+        predict_fn: takes a list of video paths and yields their fake
+            probabilities in the same order, or (probability, fallback
+            reason) pairs, for example DeepfakeDetector.predict_on_videos
+            with with_reasons=True; only with the reasons can failed
+            videos be told apart and tried again
+        videos: the video paths of this shard, see shard_videos()
+        output_path: the shard's CSV file, see shard_path()
+        fake_threshold: videos with a probability above this are FAKE
+
+    Every row is flushed and synced to disk before the next video, so at
+    most the video that was being written when the process died is lost.
+
+    Returns (number of videos scored now, number skipped because they were
+    already done).
+    """
+    fieldnames = _repair(output_path)
+    rows = read_results(output_path)
+    done = set(filename for filename, row in rows.items()
+               if row.get("fallback") not in RETRY_REASONS)
+    todo = [video for video in videos if os.path.basename(video) not in done]
+    skipped = len(videos) - len(todo)
+    if verbose and skipped > 0:
+        print("%s: %d of %d videos already done" % (output_path, skipped, len(videos)))
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    scored = 0
+    failed = 0
+    with open(output_path, "a", newline="") as f:
+        # Files from before the fallback column keep their columns.
+        writer = csv.DictWriter(f, fieldnames=fieldnames or SHARD_FIELDNAMES, extrasaction="ignore")
+        if fieldnames is None:
+            writer.writeheader()
+        for video, prediction in zip(todo, predict_fn(todo)):
+            probability, reason = prediction if isinstance(prediction, tuple) else (prediction, None)
+            writer.writerow({ "filename": os.path.basename(video),
+                              "label": probability,
+                              "result": "FAKE" if probability > fake_threshold else "REAL",
+                              "fallback": reason or "" })
+            f.flush()
+            os.fsync(f.fileno())
+            scored += 1
+            if reason in RETRY_REASONS:
+                failed += 1
+
+    if verbose:
+        print("%s: scored %d videos" % (output_path, scored))
+        if failed > 0:
+            print("%s: %d videos failed and will be tried again next time" % (output_path, failed))
+    return scored, skipped
+
+
+def merge_shards(output_dir, output_path, videos=None):
+    """Combines the shard files in output_dir into one CSV file in the
+    result.csv format, sorted by file name.
+
+    Arguments:
+        output_dir: the folder with the shard-*-of-*.csv files
+        output_path: the CSV file to write
+        videos: optionally, the video files of the whole job; a warning is
+            printed for every one that has no result
+
+    Returns the number of rows written. A warning is also printed if some
+    shard files are missing.
+    """
+    paths = sorted(glob.glob(os.path.join(output_dir, "shard-*-of-*.csv")))
+    rows = {}
+    shards = {}
+    for path in paths:
+        name = os.path.basename(path)[len("shard-"):-len(".csv")]
+        shard, num_shards = [int(x) for x in name.split("-of-")]
+        shards.setdefault(num_shards, set()).add(shard)
+        rows.update(read_results(path))
+
+    for num_shards, found in sorted(shards.items()):
+        missing = sorted(set(range(num_shards)) - found)
+        if len(missing) > 0:
+            print("WARNING: no results for %d of %d shards: %s" % (len(missing), num_shards,
+                                                                   ", ".join(str(s) for s in missing)))
+    if videos is not None:
+        missing = [os.path.basename(video) for video in videos
+                   if os.path.basename(video) not in rows]
+        if len(missing) > 0:
+            print("WARNING: %d videos have no result, e.g. %s" % (len(missing), missing[0]))
+
+    # Every merge writes its own temporary file, so shards that finish at
+    # the same time and both merge don't write into each other's file.
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    with tempfile.NamedTemporaryFile("w", newline="", dir=output_dir, delete=False,
+                                     prefix=os.path.basename(output_path) + ".",
+                                     suffix=".tmp") as f:
+        tmp_path = f.name
+        try:
+            writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+            writer.writeheader()
+            for filename in sorted(rows):
+                writer.writerow({ key: rows[filename][key] for key in FIELDNAMES })
+        except:
+            f.close()
+            os.remove(tmp_path)
+            raise
+    # NamedTemporaryFile is only readable by its owner.
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, output_path)
+    return len(rows)
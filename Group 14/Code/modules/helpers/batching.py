@@ -0,0 +1,402 @@
+"""Cross-video dynamic batching for the classifier and the face detector.
+
+Running the classifier once per video means most batches are only partly
+filled with faces. DynamicBatcher instead collects the face crops from many
+videos and runs the model on full batches. Afterwards, the scores are split
+up again per video.
+
+Typical use:
+
+    batcher = DynamicBatcher(predict_fn, max_batch_size=64, max_wait=0.1)
+    for key, crops in ...:
+        batcher.submit(key, crops)
+        batcher.poll()
+    batcher.flush()
+    scores = batcher.pop_results()
+
+The batchers have no thread of their own: a partial batch only runs when
+poll() is called after its max_wait is up. So a consumer that waits for
+input between submits should wait at most wait_time() seconds, and call
+poll() then, even if nothing new came in (see the timeout argument of
+decode_pool.decode_videos()). Otherwise max_wait only holds at arrivals.
+
+DetectionBatcher does the same for the face detector: it collects the tiles
+of many videos, runs BlazeFace on full batches of tiles, and hands back the
+faces of each video as soon as all of its tiles have been through the
+detector. It has the same submit / poll / flush / pop_results methods.
+"""
+
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+class DynamicBatcher:
+    """Collects face crops from several videos into full classifier batches."""
+
+    def __init__(self, predict_fn, max_batch_size=64, max_wait=0.1, reduce_fn=np.mean):
+        """Creates a new DynamicBatcher.
+
+        Arguments:
+            predict_fn: a function that takes a uint8 NumPy array of shape
+                (n, H, W, 3) with n <= max_batch_size, and returns a NumPy
+                array with n scores (for example, the fake probabilities)
+            max_batch_size: the model runs as soon as this many crops are
+                waiting
+            max_wait: maximum number of seconds the oldest waiting crop may
+                sit in the queue before poll() runs a partial batch; None
+                means only full batches run until flush() is called. This
+                only holds if poll() is called in time, see wait_time().
+            reduce_fn: combines the scores of one video into a single value
+        """
+        assert max_batch_size > 0
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.reduce_fn = reduce_fn
+
+        # Waiting crops, as [key, crops, start, arrival time] segments.
+        self._queue = deque()
+        self._num_waiting = 0
+
+        # Scores that came back so far, and how many are still missing.
+        self._scores = {}
+        self._remaining = {}
+        self._reduce_fns = {}
+
+        self._results = {}
+        self._buffer = None
+        self._lock = threading.RLock()
+
+        self.num_batches = 0
+        self.num_crops = 0
+
+    def submit(self, key, crops, reduce_fn=None):
+        """Adds the face crops for one video.
+
+        Arguments:
+            key: identifies the video in the results (for example its index
+                in the list of videos); must not already be in flight
+            crops: uint8 NumPy array of shape (n, H, W, 3), already resized
+                to the model's input size. If n is 0, the video's result is
+                None.
+            reduce_fn: combines this video's scores instead of the 
+                batcher's reduce_fn (for example per identity, see 
+                identities.py)
+
+        Runs the model on as many full batches as are available. If the 
+        model raises an exception, the videos in that batch get None as 
+        their result and the exception is passed on.
+        """
+        with self._lock:
+            assert key not in self._remaining, "video %s was already submitted" % str(key)
+            if len(crops) == 0:
+                self._results[key] = None
+                return
+
+            self._scores[key] = []
+            self._remaining[key] = len(crops)
+            if reduce_fn is not None:
+                self._reduce_fns[key] = reduce_fn
+            self._queue.append([key, crops, 0, time.monotonic()])
+            self._num_waiting += len(crops)
+
+            while self._num_waiting >= self.max_batch_size:
+                self._run_batch()
+
+    def poll(self):
+        """Runs a partial batch if the oldest crop has waited longer than
+        max_wait. Returns True if the model was run."""
+        with self._lock:
+            if self._num_waiting == 0 or self.max_wait is None:
+                return False
+            if time.monotonic() - self._queue[0][3] < self.max_wait:
+                return False
+            self._run_batch()
+            return True
+
+    def wait_time(self):
+        """The number of seconds until poll() would run a partial batch (0
+        if it would now), or None if no crops are waiting or max_wait is
+        None."""
+        with self._lock:
+            if self._num_waiting == 0 or self.max_wait is None:
+                return None
+            return max(0.0, self._queue[0][3] + self.max_wait - time.monotonic())
+
+    def flush(self):
+        """Runs the model on all the crops that are still waiting."""
+        with self._lock:
+            while self._num_waiting > 0:
+                self._run_batch()
+
+    def pop_results(self):
+        """Returns a dictionary with the combined score for every video that
+        is finished, and forgets about those videos."""
+        with self._lock:
+            results = self._results
+            self._results = {}
+            return results
+
+    def pending(self):
+        """The number of videos that don't have a result yet."""
+        with self._lock:
+            return len(self._remaining)
+
+    def _run_batch(self):
+        n = min(self._num_waiting, self.max_batch_size)
+
+        # Copy the next n crops into the batch buffer, remembering which
+        # video each slice of the batch belongs to.
+        segments = []
+        filled = 0
+        while filled < n:
+            segment = self._queue[0]
+            key, crops, start, _ = segment
+            count = min(len(crops) - start, n - filled)
+
+            if self._buffer is None or self._buffer.shape[1:] != crops.shape[1:]:
+                self._buffer = np.empty((self.max_batch_size,) + crops.shape[1:], dtype=np.uint8)
+            self._buffer[filled:filled + count] = crops[start:start + count]
+
+            segments.append((key, filled, count))
+            filled += count
+            segment[2] += count
+            if segment[2] == len(crops):
+                self._queue.popleft()
+
+        self._num_waiting -= n
+
+        try:
+            scores = np.asarray(self.predict_fn(self._buffer[:n])).reshape(-1)
+        except:
+            # Give up on every video that had crops in this batch, so they
+            # don't wait for scores that will never come.
+            failed = set(key for key, _, _ in segments)
+            self._queue = deque(seg for seg in self._queue if seg[0] not in failed)
+            self._num_waiting = sum(len(seg[1]) - seg[2] for seg in self._queue)
+            for key in failed:
+                del self._scores[key]
+                del self._remaining[key]
+                self._reduce_fns.pop(key, None)
+                self._results[key] = None
+            raise
+
+        self.num_batches += 1
+        self.num_crops += n
+
+        for key, offset, count in segments:
+            self._scores[key].append(scores[offset:offset + count])
+            self._remaining[key] -= count
+            if self._remaining[key] == 0:
+                video_scores = np.concatenate(self._scores.pop(key))
+                del self._remaining[key]
+                reduce_fn = self._reduce_fns.pop(key, self.reduce_fn)
+                self._results[key] = float(reduce_fn(video_scores))
+
+
+class DetectionBatcher:
+    """Collects the tiles of several videos into full face detector batches."""
+
+    def __init__(self, face_extractor, max_batch_size=256, max_wait=0.1, face_sets=False):
+        """Creates a new DetectionBatcher.
+
+        Arguments:
+            face_extractor: the FaceExtractor whose face detector runs the
+                batches and that turns the detections into faces
+            max_batch_size: the detector runs as soon as this many tiles
+                are waiting; a video's tiles may be split over two batches
+            max_wait: maximum number of seconds the oldest waiting tile may
+                sit in the queue before poll() runs a partial batch; None
+                means only full batches run until flush() is called. This
+                only holds if poll() is called in time, see wait_time().
+            face_sets: if True, the results are FaceSets (see face_set.py)
+                instead of the per-frame dictionaries
+
+        The frames of a video are kept until its faces are popped, so
+        max_batch_size also bounds how many videos' frames are held here:
+        about max_batch_size / (tiles per video) + 1.
+        """
+        assert max_batch_size > 0
+        self.face_extractor = face_extractor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.face_sets = face_sets
+
+        # The detector needs tiles of one shape in a batch. With BlazeFace
+        # every tile has the same shape, whatever the video resolution, so
+        # normally there is just one bucket.
+        self._buckets = {}
+        self._num_waiting = {}
+        self._buffers = {}
+
+        # Per video: what _face_set() needs, plus the detections
+        # that came back so far and how many tiles are still missing.
+        self._videos = {}
+
+        self._results = {}
+        self._lock = threading.RLock()
+
+        self.num_batches = 0
+        self.num_tiles = 0
+
+    def submit(self, key, frames, frame_idxs, tiles=None, resize_info=None):
+        """Adds the frames of one video.
+
+        Arguments:
+            key: identifies the video in the results (for example its index
+                in the list of videos); must not already be in flight
+            frames: NumPy array of shape (num_frames, H, W, 3); it must stay
+                valid until the video's faces have been popped, because the
+                face crops are views into it
+            frame_idxs: list with the index of each frame in the video
+            tiles, resize_info: the output of _tile_frames() for these
+                frames, if that was already done (e.g. by decode_pool.py);
+                otherwise the frames are tiled here
+
+        Runs the detector on as many full batches as are available. If the
+        detector raises an exception, the videos in that batch get None as
+        their result and the exception is passed on.
+        """
+        with self._lock:
+            assert key not in self._videos, "video %s was already submitted" % str(key)
+            extractor = self.face_extractor
+            tiles, resize_info, detected = extractor._tiles_to_detect(frames, tiles, resize_info)
+
+            self._videos[key] = { "frames": frames,
+                                  "frame_idxs": frame_idxs,
+                                  "resize_info": resize_info,
+                                  "detected": detected,
+                                  "detections": [None] * len(tiles),
+                                  "remaining": len(tiles) }
+            if len(tiles) == 0:
+                self._finish(key)
+                return
+
+            shape = tiles.shape[1:]
+            self._buckets.setdefault(shape, deque()).append([key, tiles, 0, time.monotonic()])
+            self._num_waiting[shape] = self._num_waiting.get(shape, 0) + len(tiles)
+
+            while self._num_waiting[shape] >= self.max_batch_size:
+                self._run_batch(shape)
+
+    def poll(self):
+        """Runs a partial batch for every bucket whose oldest tile has waited
+        longer than max_wait. Returns True if the detector was run."""
+        with self._lock:
+            if self.max_wait is None:
+                return False
+            ran = False
+            now = time.monotonic()
+            for shape, bucket in list(self._buckets.items()):
+                if len(bucket) > 0 and now - bucket[0][3] >= self.max_wait:
+                    self._run_batch(shape)
+                    ran = True
+            return ran
+
+    def wait_time(self):
+        """The number of seconds until poll() would run a partial batch (0
+        if it would now), or None if no tiles are waiting or max_wait is
+        None."""
+        with self._lock:
+            if self.max_wait is None:
+                return None
+            oldest = [bucket[0][3] for bucket in self._buckets.values() if len(bucket) > 0]
+            if len(oldest) == 0:
+                return None
+            return max(0.0, min(oldest) + self.max_wait - time.monotonic())
+
+    def flush(self):
+        """Runs the detector on all the tiles that are still waiting."""
+        with self._lock:
+            for shape in list(self._buckets):
+                while self._num_waiting[shape] > 0:
+                    self._run_batch(shape)
+
+    def pop_results(self):
+        """Returns a dictionary with the faces of every video that is
+        finished, in the same format as FaceExtractor.process_frames() (or
+        as a FaceSet, with face_sets=True), and forgets about those videos.
+        The faces are None if detection failed for a video."""
+        with self._lock:
+            results = self._results
+            self._results = {}
+            return results
+
+    def pending(self):
+        """The number of videos that don't have a result yet."""
+        with self._lock:
+            return len(self._videos)
+
+    def __contains__(self, key):
+        """Whether a video is in flight or has a result that wasn't popped."""
+        with self._lock:
+            return key in self._videos or key in self._results
+
+    def _run_batch(self, shape):
+        bucket = self._buckets[shape]
+        n = min(self._num_waiting[shape], self.max_batch_size)
+
+        # If the batch is all from one video, its tiles can go in as they
+        # are; otherwise copy them into the batch buffer.
+        key, tiles, start, _ = bucket[0]
+        if len(tiles) - start >= n:
+            batch = tiles[start:start + n]
+            segments = [(key, start, 0, n)]
+        else:
+            buffer = self._buffers.get(shape)
+            if buffer is None:
+                buffer = self._buffers[shape] = np.empty((self.max_batch_size,) + shape, dtype=np.uint8)
+            segments = []
+            filled = 0
+            for key, tiles, start, _ in bucket:
+                count = min(len(tiles) - start, n - filled)
+                buffer[filled:filled + count] = tiles[start:start + count]
+                segments.append((key, start, filled, count))
+                filled += count
+                if filled == n: break
+            batch = buffer[:n]
+
+        # Take the tiles out of the queue.
+        for key, start, _, count in segments:
+            segment = bucket[0]
+            segment[2] += count
+            if segment[2] == len(segment[1]):
+                bucket.popleft()
+        self._num_waiting[shape] -= n
+
+        try:
+            detections = self.face_extractor._detect_tiles(batch)
+        except:
+            # Give up on every video that had tiles in this batch.
+            failed = set(key for key, _, _, _ in segments)
+            self._buckets[shape] = deque(seg for seg in bucket if seg[0] not in failed)
+            self._num_waiting[shape] = sum(len(seg[1]) - seg[2] for seg in self._buckets[shape])
+            for key in failed:
+                del self._videos[key]
+                self._results[key] = None
+            raise
+
+        self.num_batches += 1
+        self.num_tiles += n
+
+        for key, start, offset, count in segments:
+            video = self._videos[key]
+            video["detections"][start:start + count] = detections[offset:offset + count]
+            video["remaining"] -= count
+            if video["remaining"] == 0:
+                self._finish(key)
+
+    def _finish(self, key):
+        video = self._videos.pop(key)
+        extractor = self.face_extractor
+        try:
+            faces = extractor._face_set(
+                key, video["frames"], video["frame_idxs"], video["detections"],
+                extractor.facedet.input_size, video["resize_info"], detected=video["detected"])
+            self._results[key] = faces if self.face_sets else faces.to_dicts()
+        except Exception as e:
+            print("Face detection error on video %s: %s: %s" % (str(key), type(e).__name__, str(e)))
+            self._results[key] = None
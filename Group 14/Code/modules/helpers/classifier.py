@@ -0,0 +1,247 @@
+"""The Xception + Head fake/real classifier, and ways to run it.
+
+build_model() creates the model that model.ipynb trains, and loads its
+weights on any device. For inference there are three backends with the
+same interface:
+
+    EagerBackend        the PyTorch model as is
+    TorchScriptBackend  a frozen, traced TorchScript file
+    OnnxBackend         an ONNX file, run with ONNX Runtime on the CPU
+
+The TorchScript and ONNX files are made by export_model(). Before tracing,
+the BatchNorm layers are folded into the convolution and linear layers next
+to them and the dropout layers are removed. Loading an exported file also
+skips pytorchcv and building the model in Python, so startup is faster.
+On the CPU, ONNX Runtime is the fastest of the three by a wide margin (see
+benchmarks/bench_backends.py).
+
+To export:
+
+    python classifier.py model.pth --torchscript model.ts --onnx model.onnx
+"""
+
+import argparse
+import copy
+import os
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from metrics import metrics
+
+
+class Head(torch.nn.Module):
+    def __init__(self, in_f, out_f, dropout=0.5):
+        super(Head, self).__init__()
+
+        self.f = nn.Flatten()
+        self.l = nn.Linear(in_f, 512)
+        self.d = nn.Dropout(dropout)
+        self.o = nn.Linear(512, out_f)
+        self.b1 = nn.BatchNorm1d(in_f)
+        self.b2 = nn.BatchNorm1d(512)
+        self.r = nn.ReLU()
+
+    def forward(self, x):
+        x = self.f(x)
+        x = self.b1(x)
+        x = self.d(x)
+
+        x = self.l(x)
+        x = self.r(x)
+        x = self.b2(x)
+        x = self.d(x)
+
+        out = self.o(x)
+        return out
+
+
+class FCN(torch.nn.Module):
+    def __init__(self, base, in_f, dropout=0.5):
+        super(FCN, self).__init__()
+        self.base = base
+        self.h1 = Head(in_f, 1, dropout)
+
+    def forward(self, x):
+        x = self.base(x)
+        return self.h1(x)
+
+
+def build_model(weights_path=None, device="cpu", pretrained=False):
+    """Creates the classifier and optionally loads trained weights.
+
+    Arguments:
+        weights_path: a state dict saved by model.ipynb, or None
+        device: the device to put the model on; the weights are mapped to
+            it too, so weights saved on a GPU also load on a CPU-only machine
+        pretrained: whether pytorchcv should download ImageNet weights for
+            the Xception base (only useful for training)
+
+    Returns the model in eval mode.
+    """
+    from pytorchcv.model_provider import get_model
+
+    base = get_model("xception", pretrained=pretrained)
+    base = nn.Sequential(*list(base.children())[:-1]) # Remove original output layer
+    base[0].final_block.pool = nn.Sequential(nn.AdaptiveAvgPool2d((1, 1)))
+
+    model = FCN(base, 2048)
+    if weights_path is not None:
+        model.load_state_dict(torch.load(weights_path, map_location=device))
+    return model.to(device).eval()
+
+
+def _fold_bn_into_linear(bn, linear):
+    """Returns a Linear layer that computes linear(bn(x))."""
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+
+    fused = nn.Linear(linear.in_features, linear.out_features)
+    fused.weight.data = linear.weight * scale[None, :]
+    fused.bias.data = linear.bias + linear.weight @ shift
+    return fused
+
+
+def fold_model(model):
+    """Returns an inference-only copy of the classifier.
+
+    Every BatchNorm2d in the Xception base is folded into the convolution
+    just before it, and the two BatchNorm1d layers of the head are folded
+    into the linear layers just after them. Dropout is left out. The result
+    gives the same output as model in eval mode, up to rounding.
+    """
+    model = copy.deepcopy(model).eval()
+
+    with torch.no_grad():
+        # pytorchcv puts the BatchNorm next to its convolution as "conv" and
+        # "bn" in ConvBlock and DwsConvBlock. For a depthwise separable
+        # convolution, the BatchNorm goes into the pointwise part.
+        for module in model.base.modules():
+            conv = getattr(module, "conv", None)
+            bn = getattr(module, "bn", None)
+            if not isinstance(bn, nn.BatchNorm2d):
+                continue
+            if isinstance(conv, nn.Conv2d):
+                module.conv = fuse_conv_bn_eval(conv, bn)
+            elif isinstance(getattr(conv, "pw_conv", None), nn.Conv2d):
+                conv.pw_conv = fuse_conv_bn_eval(conv.pw_conv, bn)
+            else:
+                continue
+            module.bn = nn.Identity()
+
+        head = model.h1
+        model.h1 = nn.Sequential(nn.Flatten(),
+                                 _fold_bn_into_linear(head.b1, head.l),
+                                 nn.ReLU(),
+                                 _fold_bn_into_linear(head.b2, head.o))
+    return model
+
+
+def export_model(model, input_size=150, torchscript_path=None, onnx_path=None):
+    """Folds the model and saves it as TorchScript and/or ONNX.
+
+    The TorchScript file is traced on the CPU and frozen. The ONNX file
+    has a dynamic batch dimension; its input is called "input" and its
+    output "logits".
+    """
+    folded = fold_model(model).cpu()
+    example = torch.zeros((1, 3, input_size, input_size))
+
+    if torchscript_path is not None:
+        with torch.no_grad():
+            traced = torch.jit.freeze(torch.jit.trace(folded, example))
+        traced.save(torchscript_path)
+
+    if onnx_path is not None:
+        torch.onnx.export(folded, (example,), onnx_path,
+                          input_names=["input"], output_names=["logits"],
+                          dynamic_axes={ "input": { 0: "batch" }, "logits": { 0: "batch" } },
+                          opset_version=17, dynamo=False)
+
+
+class EagerBackend:
+    """Runs the PyTorch model directly."""
+
+    def __init__(self, model, device):
+        self.model = model
+        self.device = torch.device(device)
+
+    def __call__(self, x):
+        """Takes a normalized float batch of shape (N, 3, H, W) and returns
+        a NumPy array with N fake probabilities."""
+        metrics.count("faces_classified", len(x))
+        with metrics.stage("classify"), torch.no_grad():
+            y_pred = self.model(x.to(self.device))
+            return torch.sigmoid(y_pred[:, 0]).cpu().numpy()
+
+
+class TorchScriptBackend(EagerBackend):
+    """Runs a TorchScript file made by export_model()."""
+
+    def __init__(self, path, device):
+        model = torch.jit.load(path, map_location=device)
+        super(TorchScriptBackend, self).__init__(model, device)
+
+
+class OnnxBackend:
+    """Runs an ONNX file made by export_model() with ONNX Runtime on the
+    CPU."""
+
+    def __init__(self, path, num_threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.device = torch.device("cpu")
+
+    def __call__(self, x):
+        metrics.count("faces_classified", len(x))
+        with metrics.stage("classify"):
+            x = x.detach().cpu().numpy()
+            logits = self.session.run(["logits"], { "input": x })[0]
+            return torch.sigmoid(torch.from_numpy(logits[:, 0])).numpy()
+
+
+def load_backend(kind, path, device="cpu"):
+    """Creates an inference backend.
+
+    Arguments:
+        kind: "eager" (path is a state dict from model.ipynb),
+            "torchscript" or "onnx" (path is a file from export_model())
+        path: the file to load
+        device: where to run the model; the ONNX backend always runs on
+            the CPU
+    """
+    if kind == "eager":
+        return EagerBackend(build_model(path, device), device)
+    if kind == "torchscript":
+        return TorchScriptBackend(path, device)
+    if kind == "onnx":
+        return OnnxBackend(path)
+    raise ValueError("unknown backend '%s'" % kind)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Exports the classifier for inference.")
+    parser.add_argument("weights", help="state dict saved by model.ipynb")
+    parser.add_argument("--torchscript", help="where to save the TorchScript file")
+    parser.add_argument("--onnx", help="where to save the ONNX file")
+    parser.add_argument("--input-size", type=int, default=150)
+    args = parser.parse_args(argv)
+
+    if args.torchscript is None and args.onnx is None:
+        parser.error("nothing to do, give --torchscript and/or --onnx")
+
+    model = build_model(args.weights, "cpu")
+    export_model(model, args.input_size, args.torchscript, args.onnx)
+    for path in (args.torchscript, args.onnx):
+        if path is not None:
+            print("Wrote %s (%.1f MB)" % (path, os.path.getsize(path) / 1e6))
+
+
+if __name__ == "__main__":
+    main()
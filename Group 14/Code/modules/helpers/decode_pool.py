@@ -0,0 +1,235 @@
+"""Multi-process video decoding.
+
+OpenCV decoding, the cv2.resize calls in tiling.tile_frames() and the 
+Python loops around them all hold the GIL, so running them in threads
+next to the model doesn't scale. Here they run in a pool of decoder
+processes instead. Each worker decodes the frames of a video straight into
+a block of shared memory and puts the tiles right behind them, and only a
+small description of that block is sent back to the parent (no pickling
+of the frames themselves). The workers don't import PyTorch.
+
+The parent process owns the face detector and the classifier, and consumes
+the decoded videos as they come in:
+
+    for i, video in decode_videos(paths, num_frames=64, target_size=(128, 128)):
+        if video is None: continue     # reading failed
+        try:
+            faces = face_extractor.process_frames(video.frames, video.frame_idxs, i,
+                                                  video.tiles, video.resize_info)
+            ...
+        finally:
+            video.close()
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import tiling
+from read_video_1 import VideoReader
+from face_cache import hash_file
+
+
+# Per-process state for the decoder workers, set up by _init_worker().
+_reader = None
+
+
+def _init_worker(insets, verbose):
+    global _reader
+    _reader = VideoReader(verbose=verbose, insets=insets)
+
+
+def _decode_video(path, num_frames, target_size, jitter, seed, hash_video, detect_every):
+    """Runs in a worker process. Reads and tiles the frames of one video
+    into a new shared memory block. With hash_video, the file is hashed 
+    first, for the face cache key. In tracking mode (detect_every > 1),
+    only the frames that go through the face detector are tiled.
+
+    Returns a dictionary that describes the block, or None if reading the
+    video failed.
+    """
+    # Hashing first means the decoder reads the file from the page cache.
+    digest = hash_file(path) if hash_video else None
+
+    # Frames and tiles share a single block, tiles come right after frames.
+    # How large the frames are is only known once the first one has been
+    # decoded, so that's when the reader asks for the block, and then it
+    # decodes straight into it.
+    block = {}
+    def num_tiled(n):
+        positions = tiling.positions_to_detect(n, detect_every)
+        return n if positions is None else len(positions)
+
+    def allocate(shape):
+        n, H, W, _ = shape
+        frames_size = int(np.prod(shape))
+        tiles_size = int(np.prod(tiling.tiles_shape(num_tiled(n), W, H, target_size)))
+        block["shm"] = shared_memory.SharedMemory(create=True, size=frames_size + tiles_size)
+        block["tiles_offset"] = frames_size
+        return np.ndarray(shape, dtype=np.uint8, buffer=block["shm"].buf)
+
+    try:
+        result = _reader.read_frames(path, num_frames, jitter=jitter, seed=seed,
+                                     allocate=allocate)
+        shm = block.get("shm")
+        if result is None:
+            _discard(shm)
+            return None
+
+        # If reading stopped early, frames is a view of the first rows of
+        # the block and only those frames are tiled.
+        frames, frame_idxs = result
+        num_frames, H, W, _ = frames.shape
+        positions = tiling.positions_to_detect(num_frames, detect_every)
+        tiles_offset = block["tiles_offset"]
+        tiles_shape = tiling.tiles_shape(num_tiled(num_frames), W, H, target_size)
+        shared_tiles = np.ndarray(tiles_shape, dtype=np.uint8, buffer=shm.buf, offset=tiles_offset)
+        to_tile = frames if positions is None else frames[positions]
+        _, resize_info = tiling.tile_frames(to_tile, target_size, out=shared_tiles)
+        frames_shape = frames.shape
+        del frames, to_tile, shared_tiles, result
+    except:
+        _discard(block.get("shm"))
+        raise
+
+    # The parent is responsible for unlinking the block.
+    shm.close()
+    return { "shm_name": shm.name,
+             "frames_shape": frames_shape,
+             "tiles_shape": tiles_shape,
+             "tiles_offset": tiles_offset,
+             "frame_idxs": list(frame_idxs),
+             "resize_info": resize_info,
+             "digest": digest }
+
+
+def _discard(shm):
+    """Frees a block that a worker made but won't hand over."""
+    if shm is None: return
+    shm.unlink()
+    try:
+        shm.close()
+    except BufferError:
+        pass
+
+
+class DecodedVideo:
+    """The frames and tiles of one video, living in shared memory.
+
+    Attributes:
+        frames: NumPy array of shape (num_frames, H, W, 3)
+        frame_idxs: list with the index of each frame in the video
+        tiles: NumPy array with the detector tiles, see tiling.tile_frames();
+            in tracking mode only for the frames that are detected
+        resize_info: [scale_w, scale_h, offset_x, offset_y] for the tiles
+        digest: the hash_file() of the video if it was asked for, else None
+
+    Call close() when done with it, otherwise the shared memory is leaked.
+    """
+
+    def __init__(self, info):
+        self._shm = shared_memory.SharedMemory(name=info["shm_name"])
+        self.frames = np.ndarray(info["frames_shape"], dtype=np.uint8, buffer=self._shm.buf)
+        self.tiles = np.ndarray(info["tiles_shape"], dtype=np.uint8, buffer=self._shm.buf,
+                                offset=info["tiles_offset"])
+        self.frame_idxs = info["frame_idxs"]
+        self.resize_info = info["resize_info"]
+        self.digest = info.get("digest")
+
+    def close(self):
+        """Frees the shared memory. Any face crops that are still views into
+        frames keep the pages mapped until they are garbage collected."""
+        if self._shm is None: return
+        self.frames = None
+        self.tiles = None
+        self._shm.unlink()
+        try:
+            self._shm.close()
+        except BufferError:
+            pass
+        self._shm = None
+
+
+def _release(info):
+    """Frees a block that was decoded but will never be consumed."""
+    if info is None: return
+    try:
+        shm = shared_memory.SharedMemory(name=info["shm_name"])
+        shm.close()
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def decode_videos(paths, num_frames, target_size, num_workers=4, max_pending=None,
+                  insets=(0, 0), jitter=0, seed=None, verbose=True, mp_context="spawn",
+                  hash_videos=None, timeout=None, detect_every=1):
+    """Decodes and tiles videos in a pool of worker processes.
+
+    Arguments:
+        paths: list of video files
+        num_frames: how many evenly spaced frames to read from each video
+        target_size: (width, height) of the face detector input
+        num_workers: number of decoder processes
+        max_pending: maximum number of videos that are being decoded or
+            waiting to be consumed; this bounds the amount of shared memory
+            in use. Defaults to twice the number of workers.
+        insets, verbose: passed to the VideoReader in each worker
+        jitter, seed: passed to VideoReader.read_frames()
+        mp_context: the multiprocessing start method; "spawn" is the safe
+            choice when the parent process has already initialized CUDA
+        hash_videos: optional list with a bool for each path; the videos
+            for which it is True are also hashed (see DecodedVideo.digest)
+        timeout: if given, a function that returns how many seconds to wait
+            for the next video at most (or None to wait for it). When no
+            video is done in time, (None, None) is yielded, so that the
+            consumer can run the batches that are due in between.
+        detect_every: the FaceExtractor's detect_every; in tracking mode,
+            only the frames that go through the face detector are tiled
+
+    Yields (index into paths, DecodedVideo) tuples in the order the videos
+    finish decoding, which is not necessarily the order of paths. The
+    DecodedVideo is None if the video could not be read, and both are None
+    for a timeout.
+    """
+    if max_pending is None:
+        max_pending = 2 * num_workers
+
+    context = multiprocessing.get_context(mp_context)
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=context,
+                             initializer=_init_worker, initargs=(insets, verbose)) as ex:
+        pending = {}
+        next_idx = 0
+        try:
+            while next_idx < len(paths) or len(pending) > 0:
+                # Keep the pool busy, but don't let it run too far ahead.
+                while next_idx < len(paths) and len(pending) < max_pending:
+                    hash_video = hash_videos is not None and hash_videos[next_idx]
+                    future = ex.submit(_decode_video, paths[next_idx], num_frames,
+                                       target_size, jitter, seed, hash_video, detect_every)
+                    pending[future] = next_idx
+                    next_idx += 1
+
+                done, _ = wait(pending, timeout=timeout() if timeout is not None else None,
+                               return_when=FIRST_COMPLETED)
+                if len(done) == 0:
+                    yield None, None
+                for future in done:
+                    i = pending.pop(future)
+                    try:
+                        info = future.result()
+                    except Exception as e:
+                        if verbose:
+                            print("Decoder error on video %s: %s" % (paths[i], str(e)))
+                        info = None
+                    yield i, (DecodedVideo(info) if info is not None else None)
+        finally:
+            # If the consumer stopped early, free whatever is still in flight.
+            for future in pending:
+                if not future.cancel():
+                    try:
+                        _release(future.result())
+                    except Exception:
+                        pass
@@ -0,0 +1,172 @@
+"""The deepfake-detect command line tool.
+
+    deepfake-detect score VIDEO_OR_DIR... --blazeface-dir DIR --model FILE [-o result.csv]
+    deepfake-detect job VIDEO_OR_DIR... --output-dir DIR --shard K --num-shards N ...
+    deepfake-detect merge DIR -o result.csv
+    deepfake-detect serve ...     (see server.py)
+    deepfake-detect export ...    (see classifier.py)
+
+Only the standard library is imported up front. torch, OpenCV, pytorchcv,
+BlazeFace and the rest load when the command that needs them runs, so
+--help and argument errors come back right away. check_import_time.py in
+the benchmarks folder keeps it that way.
+"""
+
+import argparse
+import os
+import sys
+
+
+def find_videos(paths):
+    """Expands folders into the .mp4 files they contain, sorted by name."""
+    videos = []
+    for path in paths:
+        if os.path.isdir(path):
+            videos += sorted(os.path.join(path, x) for x in os.listdir(path) if x[-4:] == ".mp4")
+        else:
+            videos.append(path)
+    return videos
+
+
+def make_detector(args):
+    from pipeline import DeepfakeDetector
+    return DeepfakeDetector(args.blazeface_dir, args.model, backend=args.backend,
+                            device=args.device, frames_per_video=args.frames_per_video,
+                            fake_threshold=args.threshold, face_cache_dir=args.face_cache_dir,
+                            multi_face=args.multi_face, detect_every=args.detect_every,
+                            adaptive=args.adaptive)
+
+
+def score(args):
+    import csv
+    from metrics import metrics
+
+    if args.metrics is not None:
+        metrics.enable()
+
+    videos = find_videos(args.videos)
+    detector = make_detector(args)
+
+    out = open(args.output, "w", newline="") if args.output is not None else sys.stdout
+    try:
+        writer = csv.DictWriter(out, fieldnames=["filename", "label", "result"])
+        writer.writeheader()
+
+        # The next videos are read while the current one is classified.
+        probabilities = detector.predict_on_videos(videos, decode_threads=args.decode_threads,
+                                                   queue_size=args.queue_size)
+        for video_path, probability in zip(videos, probabilities):
+            writer.writerow({ "filename": os.path.basename(video_path),
+                              "label": probability,
+                              "result": detector.result(probability) })
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    if args.metrics is not None:
+        with open(args.metrics, "w") as f:
+            f.write(metrics.to_json(indent=2))
+
+
+def job(args):
+    import batch_job
+    from metrics import metrics
+
+    if args.metrics is not None:
+        metrics.enable()
+
+    videos = batch_job.shard_videos(find_videos(args.videos), args.shard, args.num_shards,
+                                    by=args.shard_by)
+    output_path = batch_job.shard_path(args.output_dir, args.shard, args.num_shards)
+    detector = make_detector(args)
+    predict_fn = lambda paths: detector.predict_on_videos(paths, decode_threads=args.decode_threads,
+                                                          queue_size=args.queue_size,
+                                                          with_reasons=True)
+    batch_job.run_shard(predict_fn, videos, output_path, fake_threshold=args.threshold)
+
+    if args.metrics is not None:
+        with open(args.metrics, "w") as f:
+            f.write(metrics.to_json(indent=2))
+
+
+def merge(args):
+    import batch_job
+    videos = find_videos(args.videos) if args.videos else None
+    n = batch_job.merge_shards(args.output_dir, args.output, videos=videos)
+    print("wrote %d rows to %s" % (n, args.output))
+
+
+def add_scoring_arguments(p):
+    """The options for loading the models and scoring, shared by score and job."""
+    p.add_argument("--blazeface-dir", required=True)
+    p.add_argument("--model", required=True, help="classifier weights or exported model")
+    p.add_argument("--backend", default="eager", choices=["eager", "torchscript", "onnx"])
+    p.add_argument("--device", help="defaults to the GPU if there is one")
+    p.add_argument("--frames-per-video", type=int, default=64)
+    p.add_argument("--threshold", type=float, default=0.60, help="fake probability above which a video is FAKE")
+    p.add_argument("--face-cache-dir")
+    p.add_argument("--multi-face", action="store_true",
+                   help="score every person in a video, not just the best face per frame")
+    p.add_argument("--detect-every", type=int, default=1,
+                   help="run the face detector on every Nth frame only and track the faces in between")
+    p.add_argument("--adaptive", action="store_true",
+                   help="start with a few frames and only read more while a video is too close to call")
+    p.add_argument("--decode-threads", type=int, default=2, help="videos read at the same time")
+    p.add_argument("--queue-size", type=int, default=2, help="videos waiting in front of each stage")
+    p.add_argument("--metrics", help="write per-stage timings and counters to this JSON file")
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog="deepfake-detect",
+                                     description="Finds out whether videos are deepfakes.")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    commands.required = True
+
+    p = commands.add_parser("score", help="score videos and write result.csv rows")
+    p.add_argument("videos", nargs="+", help="video files or folders with .mp4 files")
+    p.add_argument("-o", "--output", help="CSV file to write; default is standard output")
+    add_scoring_arguments(p)
+
+    p = commands.add_parser("job", help="score one shard of a large job, resuming where it left off")
+    p.add_argument("videos", nargs="+", help="video files or folders with .mp4 files (of the whole job)")
+    p.add_argument("--output-dir", required=True, help="folder for the per-shard CSV files")
+    p.add_argument("--shard", type=int, default=0, help="which shard to score, from 0")
+    p.add_argument("--num-shards", type=int, default=1)
+    p.add_argument("--shard-by", default="index", choices=["index", "hash"],
+                   help="split the sorted videos by position or by a hash of the file name")
+    add_scoring_arguments(p)
+
+    p = commands.add_parser("merge", help="combine the shard files of a job into one result.csv")
+    p.add_argument("output_dir", help="the --output-dir of the job")
+    p.add_argument("-o", "--output", required=True, help="CSV file to write")
+    p.add_argument("--videos", nargs="+", help="warn about these videos if they have no result")
+
+    # These two pass their arguments on, so their options live in one place.
+    commands.add_parser("serve", help="run the scoring server (server.py)", add_help=False)
+    commands.add_parser("export", help="export the classifier (classifier.py)", add_help=False)
+    return parser
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if len(argv) > 0 and argv[0] == "serve":
+        import server
+        return server.main(argv[1:])
+    if len(argv) > 0 and argv[0] == "export":
+        import classifier
+        return classifier.main(argv[1:])
+
+    args = make_parser().parse_args(argv)
+    if args.command == "score":
+        score(args)
+    elif args.command == "job":
+        job(args)
+    elif args.command == "merge":
+        merge(args)
+
+
+if __name__ == "__main__":
+    main()
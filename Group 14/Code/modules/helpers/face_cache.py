@@ -0,0 +1,284 @@
+"""Persistent on-disk cache for the output of FaceExtractor.process_video().
+
+Decoding a video and running BlazeFace on it is by far the slowest part of
+a run, and its result only depends on the video file and on the frame
+sampling and detector settings, not on the classifier. So the results are
+cached under a key made from a hash of the video's contents plus those
+settings. When only the classifier weights change, the next run can skip
+decoding and face detection completely.
+
+Each cache entry is a directory with three files:
+
+    meta.json    the per-frame fields (frame_idx, frame_w, frame_h)
+    faces.npy    one record per face: frame number, score, box, and where
+                 its pixels are in pixels.npy
+    pixels.npy   the pixels of all face crops, back to back, as uint8
+
+The .npy files are memory-mapped when an entry is loaded, so the face crops
+are only read from disk when they're actually used. Entries are evicted in
+least-recently-used order once the cache grows past max_bytes.
+
+Hashing a video means reading all of it, so every hash is remembered in
+.hashes in the cache folder, under the file's path, size and modification
+time. A file that hasn't changed since is never hashed again, and the key
+of a video that was seen before costs one os.stat(). For new videos,
+predict_on_video_set() leaves the hashing to the decoder processes, which
+read the file anyway (see decode_pool.py and known_digest()).
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+_FACE_DTYPE = np.dtype([("frame", np.int32),
+                        ("offset", np.int64),
+                        ("height", np.int32),
+                        ("width", np.int32),
+                        ("score", np.float32),
+                        ("box", np.int32, (4,))])
+
+# Bump this whenever the format of the entries changes.
+_FORMAT_VERSION = 1
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """Returns a hex digest of the contents of the file."""
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk: break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class FaceCache:
+    """Content-addressed cache of face crops, with LRU eviction."""
+
+    def __init__(self, cache_dir, max_bytes=10 * 1024**3):
+        """Creates a new FaceCache.
+
+        Arguments:
+            cache_dir: the folder to keep the cache entries in
+            max_bytes: maximum total size of all entries; None means there
+                is no limit
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # File hashes by (path, size, modification time), loaded from
+        # .hashes the first time they're needed.
+        self._hashes = None
+
+        # The total size of all entries, counted once and then kept up to
+        # date by put() and evict().
+        self._total_bytes = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def _file_id(self, video_path):
+        stat = os.stat(video_path)
+        return (os.path.abspath(video_path), stat.st_size, stat.st_mtime_ns)
+
+    def _load_hashes(self):
+        self._hashes = {}
+        try:
+            with open(os.path.join(self.cache_dir, ".hashes")) as f:
+                for line in f:
+                    # digest, size, mtime, path; the path may contain spaces.
+                    parts = line.rstrip("\n").split(" ", 3)
+                    if len(parts) == 4 and line.endswith("\n"):
+                        self._hashes[(parts[3], int(parts[1]), int(parts[2]))] = parts[0]
+        except (OSError, ValueError):
+            pass
+
+    def known_digest(self, video_path):
+        """Returns the hash of the video if it was hashed before and the file
+        hasn't changed since, otherwise None. Only stats the file."""
+        if self._hashes is None:
+            self._load_hashes()
+        return self._hashes.get(self._file_id(video_path))
+
+    def remember_digest(self, video_path, digest):
+        """Remembers the hash of a video that was hashed somewhere else, for
+        example by hash_file() in a decoder process."""
+        if self._hashes is None:
+            self._load_hashes()
+        file_id = self._file_id(video_path)
+        if self._hashes.get(file_id) == digest: return
+        self._hashes[file_id] = digest
+        try:
+            with open(os.path.join(self.cache_dir, ".hashes"), "a") as f:
+                f.write("%s %d %d %s\n" % (digest, file_id[1], file_id[2], file_id[0]))
+        except OSError:
+            pass
+
+    def key(self, video_path, params, digest=None):
+        """Makes the cache key for a video.
+
+        Arguments:
+            video_path: the video file
+            params: a dictionary with everything else that affects the
+                result, such as frames_per_video, insets, the face margin,
+                jitter and seed, and the detector settings. Values must be
+                JSON serializable.
+            digest: the video's hash_file(), if it is already known; else
+                it is looked up, and the file is only hashed if it's new
+        """
+        if digest is None:
+            digest = self.known_digest(video_path)
+        if digest is None:
+            digest = hash_file(video_path)
+            self.remember_digest(video_path, digest)
+
+        settings = json.dumps(params, sort_keys=True, default=str)
+        h = hashlib.blake2b(digest_size=20)
+        h.update(("%d:%s:%s" % (_FORMAT_VERSION, digest, settings)).encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, key, video_idx=0):
+        """Loads a cache entry.
+
+        Returns the same list of dictionaries as process_video(), with the
+        face crops as read-only views into a memory-mapped file, or None if
+        the key is not in the cache.
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry_dir, "meta.json")) as f:
+                meta = json.load(f)
+            faces = np.load(os.path.join(entry_dir, "faces.npy"), mmap_mode="r")
+            pixels = np.load(os.path.join(entry_dir, "pixels.npy"), mmap_mode="r")
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        # Mark the entry as recently used.
+        try:
+            os.utime(entry_dir)
+        except OSError:
+            pass
+        self.hits += 1
+
+        result = []
+        for frame_info in meta["frames"]:
+            result.append({ "video_idx": video_idx,
+                            "frame_idx": frame_info["frame_idx"],
+                            "frame_w": frame_info["frame_w"],
+                            "frame_h": frame_info["frame_h"],
+                            "faces": [],
+                            "scores": [],
+                            "boxes": [] })
+
+        for face in faces:
+            offset, h, w = int(face["offset"]), int(face["height"]), int(face["width"])
+            frame_data = result[face["frame"]]
+            frame_data["faces"].append(pixels[offset:offset + h*w*3].reshape(h, w, 3))
+            frame_data["scores"].append(float(face["score"]))
+            frame_data["boxes"].append(np.array(face["box"]))
+
+        return result
+
+    def put(self, key, frames):
+        """Stores the output of process_video(), or a FaceSet, under the 
+        given key, then evicts old entries if the cache has grown too large."""
+        if hasattr(frames, "to_dicts"):
+            frames = frames.to_dicts()
+        num_faces = sum(len(frame_data["faces"]) for frame_data in frames)
+        records = np.zeros(num_faces, dtype=_FACE_DTYPE)
+        pixels = np.empty(sum(face.size for frame_data in frames
+                                        for face in frame_data["faces"]), dtype=np.uint8)
+
+        meta = { "version": _FORMAT_VERSION, "frames": [] }
+        i = 0
+        offset = 0
+        for f, frame_data in enumerate(frames):
+            meta["frames"].append({ "frame_idx": int(frame_data["frame_idx"]),
+                                    "frame_w": int(frame_data["frame_w"]),
+                                    "frame_h": int(frame_data["frame_h"]) })
+            boxes = frame_data.get("boxes")
+            for j, face in enumerate(frame_data["faces"]):
+                h, w = face.shape[:2]
+                records[i] = (f, offset, h, w, frame_data["scores"][j],
+                              boxes[j] if boxes is not None else (-1, -1, -1, -1))
+                pixels[offset:offset + face.size] = face.reshape(-1)
+                offset += face.size
+                i += 1
+
+        # Write into a temporary folder first, so that other processes
+        # never see a half-written entry.
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+        try:
+            np.save(os.path.join(tmp_dir, "faces.npy"), records)
+            np.save(os.path.join(tmp_dir, "pixels.npy"), pixels)
+            with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+                json.dump(meta, f)
+            size = sum(e.stat().st_size for e in os.scandir(tmp_dir))
+            os.rename(tmp_dir, os.path.join(self.cache_dir, key))
+        except OSError:
+            # Most likely another process stored the same key first.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        if self._total_bytes is not None:
+            self._total_bytes += size
+        self.evict()
+
+    def get_or_compute(self, video_path, params, compute_fn, video_idx=0):
+        """Returns the cached faces for this video, or calls compute_fn() to
+        make them and stores the result. Results from compute_fn() that are
+        None are not cached."""
+        key = self.key(video_path, params)
+        result = self.get(key, video_idx)
+        if result is None:
+            result = compute_fn()
+            if result is not None:
+                self.put(key, result)
+        return result
+
+    def size(self):
+        """The total size in bytes of all entries."""
+        return sum(size for _, _, size in self._entries())
+
+    def evict(self, low_water=0.9):
+        """Deletes the least recently used entries if the cache is larger
+        than max_bytes, until it is no larger than low_water * max_bytes.
+
+        Only the running total of the entry sizes is checked, so this is
+        cheap until the cache is full. Then all entries are listed once to
+        find the oldest ones, and the total is counted again (which also
+        picks up the entries written by other processes). Evicting a bit
+        more than needed means that doesn't happen on every put().
+        """
+        if self.max_bytes is None: return
+        if self._total_bytes is None:
+            self._total_bytes = self.size()
+        if self._total_bytes <= self.max_bytes: return
+
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        total = sum(size for _, _, size in entries)
+        target = low_water * self.max_bytes if total > self.max_bytes else self.max_bytes
+        for entry_dir, _, size in entries:
+            if total <= target: break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+        self._total_bytes = total
+
+    def _entries(self):
+        """Yields (folder, last used time, size in bytes) for each entry."""
+        for name in os.listdir(self.cache_dir):
+            if name.startswith("."): continue
+            entry_dir = os.path.join(self.cache_dir, name)
+            try:
+                last_used = os.stat(entry_dir).st_mtime
+                size = sum(e.stat().st_size for e in os.scandir(entry_dir))
+            except OSError:
+                continue
+            yield entry_dir, last_used, size
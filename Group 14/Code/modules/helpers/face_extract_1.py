@@ -8,15 +8,21 @@ Original file is located at
 """
 
 import os
-import cv2
 import numpy as np
 import torch
 
+import tiling
+from metrics import metrics
+from nms import weighted_nms
+from face_set import FaceSet
+
 
 class FaceExtractor:
     """Wrapper for face extraction workflow."""
     
-    def __init__(self, video_read_fn, facedet):
+    def __init__(self, video_read_fn, facedet, video_iter_fn=None, 
+                 detect_every=1, track_iou=0.5, margin=0.2, batched_nms=True,
+                 face_filter=None):
         """Creates a new FaceExtractor.
 
         Arguments:
@@ -25,9 +31,38 @@ class FaceExtractor:
                 (num_frames, H, W, 3) and a list of frame indices, or None
                 in case of an error
             facedet: the face detector object
+            video_iter_fn: optional function that takes in a path to a video
+                file and returns an iterator of the same kind of tuples, but
+                for a chunk of frames at a time (see VideoReader.iter_frames).
+                Needed for process_video_streaming().
+            detect_every: if more than 1, turns on tracking mode: the face
+                detector only runs on every Nth frame (and the last one), 
+                and the face boxes for the frames in between are filled in 
+                by interpolation (see _track_faces)
+            track_iou: in tracking mode, how much a face box must overlap
+                with the same face on the next detected frame before we 
+                trust the interpolation; otherwise the detector also runs 
+                on the frames in between
+            margin: how much to expand the face boxes by before cropping,
+                see _add_margin_to_detections
+            batched_nms: if True and the face detector does BlazeFace's
+                weighted NMS (it has a min_suppression_threshold), do that
+                NMS for all frames at once with nms.weighted_nms() instead
+                of calling facedet.nms(), which loops over the frames
+            face_filter: optional FaceFilter (see face_filter.py) that throws
+                out unlikely faces after the NMS, before they are cropped
         """
         self.video_read_fn = video_read_fn
         self.facedet = facedet
+        self.video_iter_fn = video_iter_fn
+        self.detect_every = detect_every
+        self.track_iou = track_iou
+        self.margin = margin
+        self.batched_nms = batched_nms
+        self.face_filter = face_filter
+
+        # How many tiles went through the face detector so far.
+        self.tiles_detected = 0
     
     def process_videos(self, input_dir, filenames, video_idxs):
         """For the specified selection of videos, grabs one or more frames 
@@ -52,6 +87,8 @@ class FaceExtractor:
             - frame_w, frame_h: original dimensions of the frame
             - faces: a list containing zero or more NumPy arrays with a face crop
             - scores: a list array with the confidence score for each face crop
+            - boxes: for each face crop, the rectangle it was cropped from as
+              a NumPy array [ymin, xmin, ymax, xmax] in frame coordinates
 
         If reading a video failed for some reason, it will not appear in the 
         output array. Note that there's no guarantee a given video will actually
@@ -63,7 +100,8 @@ class FaceExtractor:
         videos_read = []
         frames_read = []
         frames = []
-        tiles = []
+        detected = []
+        num_tiles = []
         resize_info = []
 
         for video_idx in video_idxs:
@@ -82,60 +120,43 @@ class FaceExtractor:
             frames.append(my_frames)
             frames_read.append(my_idxs)
 
-            # Split the frames into several tiles. Resize the tiles to 128x128.
-            my_tiles, my_resize_info = self._tile_frames(my_frames, target_size)
-            tiles.append(my_tiles)
-            resize_info.append(my_resize_info)
+            # Not all videos may have the same number of tiles. In tracking
+            # mode, only some of the frames get tiled.
+            H, W = my_frames.shape[1:3]
+            positions = self._positions_to_detect(my_frames.shape[0])
+            detected.append(positions)
+            num_frames = my_frames.shape[0] if positions is None else len(positions)
+            num_tiles.append(self.tiles_shape(num_frames, W, H, target_size)[0])
+
+        if len(frames) == 0:
+            return []
 
         # Put all the tiles for all the frames from all the videos into
-        # a single batch.
-        batch = np.concatenate(tiles)
+        # a single batch. Split the frames into several tiles, resize the 
+        # tiles to 128x128, and write them straight into the batch.
+        batch = np.empty((sum(num_tiles), target_size[1], target_size[0], 3), dtype=np.uint8)
+        offs = 0
+        for v in range(len(frames)):
+            my_frames = frames[v] if detected[v] is None else frames[v][detected[v]]
+            _, my_resize_info = self._tile_frames(my_frames, target_size,
+                                                  out=batch[offs:offs + num_tiles[v]])
+            resize_info.append(my_resize_info)
+            offs += num_tiles[v]
 
         # Run the face detector. The result is a list of PyTorch tensors, 
         # one for each image in the batch.
-        all_detections = self.facedet.predict_on_batch(batch, apply_nms=False)
+        all_detections = self._detect_tiles(batch)
 
         result = []
         offs = 0
-        for v in range(len(tiles)):
-            # Not all videos may have the same number of tiles, so find which 
-            # detections go with which video.
-            num_tiles = tiles[v].shape[0]
-            detections = all_detections[offs:offs + num_tiles]
-            offs += num_tiles
-
-            # Convert the detections from 128x128 back to the original frame size.
-            detections = self._resize_detections(detections, target_size, resize_info[v])
-
-            # Because we have several tiles for each frame, combine the predictions
-            # from these tiles. The result is a list of PyTorch tensors, but now one
-            # for each frame (rather than each tile).
-            num_frames = frames[v].shape[0]
-            frame_size = (frames[v].shape[2], frames[v].shape[1])
-            detections = self._untile_detections(num_frames, frame_size, detections)
-
-            # The same face may have been detected in multiple tiles, so filter out
-            # overlapping detections. This is done separately for each frame.
-            detections = self.facedet.nms(detections)
-
-            for i in range(len(detections)):
-                # Crop the faces out of the original frame.
-                faces = self._add_margin_to_detections(detections[i], frame_size, 0.2)
-                faces = self._crop_faces(frames[v][i], faces)
-
-                # Add additional information about the frame and detections.
-                scores = list(detections[i][:, 16].cpu().numpy())
-                frame_dict = { "video_idx": videos_read[v],
-                               "frame_idx": frames_read[v][i],
-                               "frame_w": frame_size[0],
-                               "frame_h": frame_size[1],
-                               "faces": faces, 
-                               "scores": scores }
-                result.append(frame_dict)
-
-                # TODO: could also add:
-                # - face rectangle in original frame coordinates
-                # - the keypoints (in crop coordinates)
+        for v in range(len(frames)):
+            # Find which detections go with which video.
+            detections = all_detections[offs:offs + num_tiles[v]]
+            offs += num_tiles[v]
+
+            result.extend(self._process_detections(videos_read[v], frames[v], frames_read[v],
+                                                   detections, target_size, resize_info[v],
+                                                   detected=detected[v]))
 
         return result
 
@@ -145,147 +166,358 @@ class FaceExtractor:
         filenames = [ os.path.basename(video_path) ]
         return self.process_videos(input_dir, filenames, [0])
 
-    def _tile_frames(self, frames, target_size):
-        """Splits each frame into several smaller, partially overlapping tiles
-        and resizes each tile to target_size.
+    def process_frames(self, frames, frame_idxs, video_idx=0, tiles=None, resize_info=None):
+        """Runs the face detector on frames that were already read, for 
+        example by a decoder running in another process.
+
+        Arguments:
+            frames: NumPy array of shape (num_frames, H, W, 3)
+            frame_idxs: list with the index of each frame in the video
+            video_idx: stored in the "video_idx" field of the results
+            tiles, resize_info: the output of _tile_frames() for these
+                frames, if that was already done; otherwise the frames 
+                are tiled here. In tracking mode, this may also be the
+                tiles of only the frames that _positions_to_detect() picks.
+
+        Returns the same list of dictionaries as process_videos(). The face
+        crops are views into frames.
+        """
+        return self.find_faces(frames, frame_idxs, video_idx, tiles, resize_info).to_dicts()
+
+    def find_faces(self, frames, frame_idxs, video_idx=0, tiles=None, resize_info=None):
+        """Like process_frames(), but returns the faces as a FaceSet (see 
+        face_set.py) instead of one dictionary per frame. The FaceSet keeps
+        a reference to frames and only crops the faces when asked to."""
+        target_size = self.facedet.input_size
+        tiles, resize_info, detected = self._tiles_to_detect(frames, tiles, resize_info)
+        detections = self._detect_tiles(tiles)
+        return self._face_set(video_idx, frames, frame_idxs, detections,
+                              target_size, resize_info, detected=detected)
+
+    def find_faces_in_video(self, video_path, video_idx=0):
+        """Reads the frames of a video with video_read_fn and returns the 
+        faces as a FaceSet, or None if the video could not be read."""
+        result = self.video_read_fn(video_path)
+        if result is None: return None
+        return self.find_faces(*result, video_idx=video_idx)
+
+    def _tiles_to_detect(self, frames, tiles=None, resize_info=None):
+        """Returns the tiles that go through the face detector for these
+        frames, their resize_info, and the positions of the frames they
+        were made from (None for all frames, see _positions_to_detect).
+        The frames are tiled here if tiles is None. In tracking mode, the
+        tiles passed in may be those of all frames or of just the frames
+        that are detected (decode_pool.py only tiles those)."""
+        detected = self._positions_to_detect(frames.shape[0])
+        if tiles is None:
+            my_frames = frames if detected is None else frames[detected]
+            tiles, resize_info = self._tile_frames(my_frames, self.facedet.input_size)
+        elif detected is not None and tiles.shape[0] != len(detected) * self._tiles_per_frame(frames):
+            # Only keep the tiles of the frames we run the detector on.
+            tiles_per_frame = tiles.shape[0] // frames.shape[0]
+            tiles = tiles.reshape((frames.shape[0], tiles_per_frame) + tiles.shape[1:])
+            tiles = tiles[detected].reshape((-1,) + tiles.shape[2:])
+        return tiles, resize_info, detected
+
+    def _tiles_per_frame(self, frames):
+        _, _, origins = self._tile_grid(frames.shape[2], frames.shape[1], self.facedet.input_size)
+        return len(origins)
+
+    def process_video_streaming(self, video_path, video_idx=0):
+        """Does face extraction on a single video, one chunk of frames at a
+        time. Uses video_iter_fn instead of video_read_fn.
+
+        Only one chunk of full-size frames (plus its tiles) is in memory at
+        any time, so peak memory stays flat no matter how many frames are 
+        sampled from the video. Because the chunk buffer is reused by the 
+        reader, the face crops are copied out of the frames.
+
+        Returns the same list of dictionaries as process_videos(). If the
+        video could not be read at all, the list is empty.
+        """
+        assert self.video_iter_fn is not None, "need a video_iter_fn for streaming"
+
+        target_size = self.facedet.input_size
+        tiles = None
 
-        After a bunch of experimentation, I found that for a 1920x1080 video,
-        BlazeFace works better on three 1080x1080 windows. These overlap by 420
-        pixels. (Two windows also work but it's best to have a clean center crop
-        in there as well.)
+        result = []
+        for frames, frame_idxs in self.video_iter_fn(video_path):
+            # Tile into the same array every time, unless the chunk size changed.
+            detected = self._positions_to_detect(frames.shape[0])
+            my_frames = frames if detected is None else frames[detected]
+            tiles, resize_info = self._tile_frames(my_frames, target_size, out=tiles)
+            detections = self._detect_tiles(tiles)
+
+            result.extend(self._process_detections(video_idx, frames, frame_idxs,
+                                                   detections, target_size, resize_info,
+                                                   copy_faces=True, detected=detected))
+        return result
 
-        I also tried 6 windows of size 720x720 (horizontally: 720|360, 360|720;
-        vertically: 720|1200, 480|720|480, 1200|720) but that gives many false
-        positives when a window has no face in it.
+    def _process_detections(self, video_idx, frames, frame_idxs, detections,
+                            target_size, resize_info, copy_faces=False, detected=None):
+        """Turns the raw detections for the tiles of one video's frames into 
+        the per-frame dictionaries returned by process_videos().
 
-        For a video in portrait orientation (1080x1920), we only take a single
-        crop of the top-most 1080 pixels. If we split up the video vertically,
-        then we might get false positives again.
+        Arguments:
+            video_idx: the video these frames were taken from
+            frames: NumPy array of shape (num_frames, H, W, 3)
+            frame_idxs: list with the index of each frame in the video
+            detections: a list of PyTorch tensors, one for each tile
+            target_size: (width, height) of the tiles
+            resize_info: [scale_w, scale_h, offset_x, offset_y]
+            copy_faces: if True, the face crops are copies instead of views
+                into frames (needed when frames is a reused buffer)
+            detected: in tracking mode, the positions in frames that the 
+                tiles were made from; None means all frames
+        """
+        faces = self._face_set(video_idx, frames, frame_idxs, detections,
+                               target_size, resize_info, detected=detected)
+        if copy_faces:
+            faces = faces.materialize()
+        return faces.to_dicts()
+
+    def _face_set(self, video_idx, frames, frame_idxs, detections,
+                  target_size, resize_info, detected=None):
+        """Like _process_detections(), but returns a FaceSet. No crops are
+        made here; the FaceSet refers to frames."""
+        frame_size = (frames.shape[2], frames.shape[1])
+        detections = self._frame_detections(detections, frame_size, target_size, resize_info)
+
+        # Tracking mode: fill in the frames that weren't detected.
+        if detected is not None:
+            with metrics.stage("track"):
+                detections = self._track_faces(frames, frame_idxs, detected, detections, target_size)
+
+        # (The NMS may return empty CPU tensors for frames without faces, so
+        # leave those out.)
+        num_frames = len(detections)
+        counts = [len(d) for d in detections]
+        nonempty = [d for d in detections if len(d) > 0]
+        if len(nonempty) > 0:
+            all_detections = torch.cat(nonempty)
+            device = all_detections.device
+            frame_ids = torch.repeat_interleave(torch.arange(num_frames, device=device),
+                                                torch.tensor(counts, device=device))
+
+            # Throw out the unlikely faces before anything is cropped.
+            if self.face_filter is not None:
+                with metrics.stage("filter"):
+                    keep = self.face_filter(all_detections, frame_ids, num_frames, frame_size)
+                    all_detections, frame_ids = all_detections[keep], frame_ids[keep]
+
+        with metrics.stage("crop"):
+            # Add the margins for all frames at once, and move the boxes, the
+            # scores and the frame numbers to the CPU in a single transfer.
+            if len(nonempty) > 0:
+                boxes = self._add_margin_to_detections(all_detections, frame_size, self.margin)
+                host = torch.cat([boxes[:, :4], all_detections[:, 16:17],
+                                  frame_ids[:, None].to(all_detections.dtype)], dim=1).cpu().numpy()
+            else:
+                host = np.zeros((0, 6), dtype=np.float32)
+
+            # TODO: could also add the keypoints (in crop coordinates)
+            faces = FaceSet(host[:, :4].astype(int), host[:, 4], host[:, 5].astype(np.int64),
+                            frame_idxs, frame_size, frames, video_idx)
+
+        metrics.count("faces_found", len(faces))
+        return faces
 
-        (NOTE: Not all videos are necessarily 1080p but the code can handle this.)
+    def _detect_tiles(self, tiles):
+        """Runs the face detector on a batch of tiles. Returns a list of 
+        PyTorch tensors with the raw detections, one for each tile."""
+        self.tiles_detected += len(tiles)
+        with metrics.stage("detect"):
+            return self.facedet.predict_on_batch(tiles, apply_nms=False)
+
+    def _frame_detections(self, detections, frame_size, target_size, resize_info):
+        """Turns the raw detections for the tiles into the final detections
+        for each frame, in original frame coordinates."""
+        # Convert the detections from 128x128 back to the original frame size.
+        # Because we have several tiles for each frame, this also combines
+        # the predictions from these tiles. The result is a list of PyTorch 
+        # tensors, but now one for each frame (rather than each tile).
+        _, _, origins = self._tile_grid(frame_size[0], frame_size[1], target_size)
+        num_frames = len(detections) // len(origins)
+        detections, frame_ids = self._project_detections(detections, num_frames, frame_size,
+                                                         target_size, resize_info)
+
+        # The same face may have been detected in multiple tiles, so filter out
+        # overlapping detections. This is done separately for each frame.
+        with metrics.stage("nms"):
+            threshold = getattr(self.facedet, "min_suppression_threshold", None)
+            if self.batched_nms and threshold is not None:
+                return weighted_nms(detections, frame_ids, num_frames, threshold)
+
+            frame_counts = torch.bincount(frame_ids, minlength=num_frames)
+            return self.facedet.nms(list(torch.split(detections, frame_counts.tolist())))
+
+    def _positions_to_detect(self, num_frames):
+        """In tracking mode, returns the positions of the frames that go 
+        through the face detector: every Nth frame, plus the last one so 
+        there is something to interpolate towards. Returns None if the 
+        detector should run on every frame."""
+        return tiling.positions_to_detect(num_frames, self.detect_every)
+
+    def _track_faces(self, frames, frame_idxs, detected, detections, target_size):
+        """Tracking mode: fills in the detections for the frames that did not
+        go through the face detector.
+
+        Between two detected frames, the faces are matched up by how much 
+        their boxes overlap, and the boxes, keypoints and scores are then 
+        linearly interpolated (by frame index) for the frames in between. 
+        For a talking-head video the face barely moves, so this is nearly 
+        as good as running the detector.
+
+        If the two detected frames don't have the same number of faces, or
+        a face can't be matched with an IoU of at least track_iou, then the
+        tracking isn't trustworthy. The detector then runs on the frames in 
+        between after all (all such frames go into a single batch).
 
         Arguments:
-            frames: NumPy array of shape (num_frames, height, width, 3)
-            target_size: (width, height)
-
-        Returns:
-            - a new (num_frames * N, target_size[1], target_size[0], 3) array
-              where N is the number of tiles used.
-            - a list [scale_w, scale_h, offset_x, offset_y] that describes how
-              to map the resized and cropped tiles back to the original image 
-              coordinates. This is needed for scaling up the face detections 
-              from the smaller image to the original image, so we can take the 
-              face crops in the original coordinate space.    
+            frames: NumPy array of shape (num_frames, H, W, 3)
+            frame_idxs: list with the index of each frame in the video
+            detected: the positions in frames of the detected frames
+            detections: the detections for those frames, in frame coordinates
+
+        Returns a list of PyTorch tensors of shape (num_faces, 17), one for
+        every frame.
         """
-        num_frames, H, W, _ = frames.shape
-
-        # Settings for 6 overlapping windows:
-        # split_size = 720
-        # x_step = 480
-        # y_step = 360
-        # num_v = 2
-        # num_h = 3
-
-        # Settings for 2 overlapping windows:
-        # split_size = min(H, W)
-        # x_step = W - split_size
-        # y_step = H - split_size
-        # num_v = 1
-        # num_h = 2 if W > H else 1
-
-        split_size = min(H, W)
-        x_step = (W - split_size) // 2
-        y_step = (H - split_size) // 2
-        num_v = 1
-        num_h = 3 if W > H else 1
-
-        splits = np.zeros((num_frames * num_v * num_h, target_size[1], target_size[0], 3), dtype=np.uint8)
-
-        i = 0
-        for f in range(num_frames):
-            y = 0
-            for v in range(num_v):
-                x = 0
-                for h in range(num_h):
-                    crop = frames[f, y:y+split_size, x:x+split_size, :]
-                    splits[i] = cv2.resize(crop, target_size, interpolation=cv2.INTER_AREA)
-                    x += x_step
-                    i += 1
-                y += y_step
-
-        resize_info = [split_size / target_size[0], split_size / target_size[1], 0, 0]
-        return splits, resize_info
-
-    def _resize_detections(self, detections, target_size, resize_info):
-        """Converts a list of face detections back to the original 
-        coordinate system.
+        result = [None] * frames.shape[0]
+        for p, d in zip(detected, detections):
+            result[p] = d
+
+        fallback = []
+        for k in range(len(detected) - 1):
+            a, b = detected[k], detected[k + 1]
+            if b - a <= 1: continue
+
+            da, db = detections[k], detections[k + 1]
+            matches = self._match_faces(da, db)
+            if matches is None:
+                fallback.extend(range(a + 1, b))
+                continue
+
+            db = db[matches]
+            span = float(frame_idxs[b] - frame_idxs[a])
+            for p in range(a + 1, b):
+                t = (frame_idxs[p] - frame_idxs[a]) / span if span > 0 else 0.0
+                result[p] = da * (1.0 - t) + db * t
+
+        if len(fallback) > 0:
+            frame_size = (frames.shape[2], frames.shape[1])
+            tiles, resize_info = self._tile_frames(frames[fallback], target_size)
+            fallback_detections = self._frame_detections(self._detect_tiles(tiles), frame_size,
+                                                         target_size, resize_info)
+            for p, d in zip(fallback, fallback_detections):
+                result[p] = d
+
+        return result
+
+    def _match_faces(self, da, db):
+        """Pairs up the faces detected in two frames. Returns a tensor with,
+        for each face in da, the index of the same face in db; or None if 
+        the faces can't all be matched with an IoU of at least track_iou."""
+        if len(da) != len(db):
+            return None
+        if len(da) == 0:
+            return torch.zeros(0, dtype=torch.long)
+
+        box_a = da[:, :4].unsqueeze(1)
+        box_b = db[:, :4].unsqueeze(0).to(da.device)
+        ymin = torch.max(box_a[..., 0], box_b[..., 0])
+        xmin = torch.max(box_a[..., 1], box_b[..., 1])
+        ymax = torch.min(box_a[..., 2], box_b[..., 2])
+        xmax = torch.min(box_a[..., 3], box_b[..., 3])
+        inter = torch.clamp(ymax - ymin, min=0) * torch.clamp(xmax - xmin, min=0)
+        area_a = (box_a[..., 2] - box_a[..., 0]) * (box_a[..., 3] - box_a[..., 1])
+        area_b = (box_b[..., 2] - box_b[..., 0]) * (box_b[..., 3] - box_b[..., 1])
+        ious = (inter / (area_a + area_b - inter).clamp(min=1e-6)).cpu()
+
+        # Greedy matching, most confident faces first. There are only a
+        # handful of faces per frame, so this loop is tiny.
+        matches = torch.zeros(len(da), dtype=torch.long)
+        taken = set()
+        for i in torch.argsort(da[:, 16].cpu(), descending=True).tolist():
+            order = torch.argsort(ious[i], descending=True).tolist()
+            j = next((j for j in order if j not in taken), None)
+            if j is None or ious[i, j] < self.track_iou:
+                return None
+            matches[i] = j
+            taken.add(j)
+        return matches.to(db.device)
+
+    def _tile_frames(self, frames, target_size, out=None):
+        """Splits each frame into several smaller, partially overlapping tiles
+        and resizes each tile to target_size. See tiling.tile_frames() for
+        how the frames are split up, the arguments and the return values."""
+        return tiling.tile_frames(frames, target_size, out=out)
+
+    def _tile_layout(self, W, H):
+        """See tiling.tile_layout()."""
+        return tiling.tile_layout(W, H)
+
+    def _tile_grid(self, W, H, target_size):
+        """See tiling.tile_grid()."""
+        return tiling.tile_grid(W, H, target_size)
+
+    def tiles_shape(self, num_frames, W, H, target_size):
+        """The shape of the array that _tile_frames() returns for num_frames
+        frames of W x H pixels. Handy for preallocating the tiles."""
+        return tiling.tiles_shape(num_frames, W, H, target_size)
+
+    # Which of the 16 coordinate columns of a detection are x-coordinates:
+    # ymin, xmin, ymax, xmax, followed by 6 keypoints that are x,y.
+    _X_COLUMNS = [False, True, False, True] + [True, False] * 6
+
+    def _project_detections(self, detections, num_frames, frame_size, target_size, resize_info):
+        """Converts the face detections for all tiles of all frames back to 
+        the original coordinate system, and works out which frame each one
+        belongs to; this is the complement to _tile_frames().
+
+        All detections are transformed in one tensor operation. Each tile
+        has an entry in a small table with its position in the frame, and
+        every detection looks up its tile in that table.
 
         Arguments:
-            detections: a list containing PyTorch tensors of shape (num_faces, 17) 
-            target_size: (width, height)
+            detections: a list with one PyTorch tensor of shape (num_faces, 17)
+                for each tile, in the order _tile_frames() made them
+            num_frames: how many frames the tiles came from
+            frame_size: (width, height) of the original frames
+            target_size: (width, height) of the tiles
             resize_info: [scale_w, scale_h, offset_x, offset_y]
+
+        Returns a PyTorch tensor of shape (num_detections, 17) with the
+        detections of all frames, in frame order, and a tensor with the 
+        frame number of each detection.
         """
-        projected = []
         target_w, target_h = target_size
         scale_w, scale_h, offset_x, offset_y = resize_info
+        W, H = frame_size
+        _, _, origins = self._tile_grid(W, H, target_size)
+        tiles_per_frame = len(origins)
 
-        for i in range(len(detections)):
-            detection = detections[i].clone()
+        all_detections = torch.cat(detections)
+        device = all_detections.device
 
-            # ymin, xmin, ymax, xmax
-            for k in range(2):
-                detection[:, k*2    ] = (detection[:, k*2    ] * target_h - offset_y) * scale_h
-                detection[:, k*2 + 1] = (detection[:, k*2 + 1] * target_w - offset_x) * scale_w
+        # Where each tile of a frame starts, as (x, y) in frame coordinates.
+        origins = torch.tensor([[x * scale_w, y * scale_h] for x, y in origins],
+                               dtype=all_detections.dtype, device=device)
 
-            # keypoints are x,y
-            for k in range(2, 8):
-                detection[:, k*2    ] = (detection[:, k*2    ] * target_w - offset_x) * scale_w
-                detection[:, k*2 + 1] = (detection[:, k*2 + 1] * target_h - offset_y) * scale_h
+        counts = torch.tensor([len(d) for d in detections], device=device)
+        tile_idxs = torch.repeat_interleave(torch.arange(len(detections), device=device), counts)
 
-            projected.append(detection)
+        is_x = torch.tensor(self._X_COLUMNS, device=device)
+        target = torch.where(is_x, float(target_w), float(target_h)).to(all_detections.dtype)
+        offset = torch.where(is_x, float(offset_x), float(offset_y)).to(all_detections.dtype)
+        scale = torch.where(is_x, float(scale_w), float(scale_h)).to(all_detections.dtype)
+        origin = origins[tile_idxs % tiles_per_frame][:, (~is_x).long()]
 
-        return projected    
-    
-    def _untile_detections(self, num_frames, frame_size, detections):
-        """With N tiles per frame, there also are N times as many detections.
-        This function groups together the detections for a given frame; it is
-        the complement to tile_frames().
-        """
-        combined_detections = []
+        projected = all_detections.clone()
+        projected[:, :16] = (all_detections[:, :16] * target - offset) * scale + origin
+
+        # The tiles are in frame order, so the detections already are too.
+        return projected, tile_idxs // tiles_per_frame
 
-        W, H = frame_size
-        split_size = min(H, W)
-        x_step = (W - split_size) // 2
-        y_step = (H - split_size) // 2
-        num_v = 1
-        num_h = 3 if W > H else 1
-
-        i = 0
-        for f in range(num_frames):
-            detections_for_frame = []
-            y = 0
-            for v in range(num_v):
-                x = 0
-                for h in range(num_h):
-                    # Adjust the coordinates based on the split positions.
-                    detection = detections[i].clone()
-                    if detection.shape[0] > 0:
-                        for k in range(2):
-                            detection[:, k*2    ] += y
-                            detection[:, k*2 + 1] += x
-                        for k in range(2, 8):
-                            detection[:, k*2    ] += x
-                            detection[:, k*2 + 1] += y
-
-                    detections_for_frame.append(detection)
-                    x += x_step
-                    i += 1
-                y += y_step
-
-            combined_detections.append(torch.cat(detections_for_frame))
-
-        return combined_detections
-    
     def _add_margin_to_detections(self, detections, frame_size, margin=0.2):
         """Expands the face bounding box.
 
@@ -307,24 +539,6 @@ class FaceExtractor:
         detections[:, 3] = torch.clamp(detections[:, 3] + offset, max=frame_size[0])  # xmax
         return detections
     
-    def _crop_faces(self, frame, detections):
-        """Copies the face region(s) from the given frame into a set
-        of new NumPy arrays.
-
-        Arguments:
-            frame: a NumPy array of shape (H, W, 3)
-            detections: a PyTorch tensor of shape (num_detections, 17)
-
-        Returns a list of NumPy arrays, one for each face crop. If there
-        are no faces detected for this frame, returns an empty list.
-        """
-        faces = []
-        for i in range(len(detections)):
-            ymin, xmin, ymax, xmax = detections[i, :4].cpu().numpy().astype(np.int)
-            face = frame[ymin:ymax, xmin:xmax, :]
-            faces.append(face)
-        return faces
-
     def remove_large_crops(self, crops, pct=0.1):
         """Removes faces from the results if they take up more than X% 
         of the video. Such a face is likely a false positive.
@@ -336,28 +550,48 @@ class FaceExtractor:
             crops: a list of dictionaries with face crop data
             pct: maximum portion of the frame a crop may take up
         """
-        for i in range(len(crops)):
-            frame_data = crops[i]
+        for frame_data in crops:
             video_area = frame_data["frame_w"] * frame_data["frame_h"]
-            faces = frame_data["faces"]
-            scores = frame_data["scores"]
-            new_faces = []
-            new_scores = []
-            for j in range(len(faces)):
-                face = faces[j]
-                face_H, face_W, _ = face.shape
-                face_area = face_H * face_W
-                if face_area / video_area < 0.1:
-                    new_faces.append(face)
-                    new_scores.append(scores[j])
-            frame_data["faces"] = new_faces
-            frame_data["scores"] = new_scores
+            self._keep_faces(frame_data, [face.shape[0] * face.shape[1] / video_area < pct
+                                          for face in frame_data["faces"]])
+
+    def filter_by_score(self, crops, min_score):
+        """Removes faces with a confidence score lower than min_score.
+
+        This is an optional postprocessing step. Modifies the original
+        data structure. (FaceFilter does this, and more, before the faces
+        are even cropped.)
+        """
+        for frame_data in crops:
+            self._keep_faces(frame_data, [score >= min_score for score in frame_data["scores"]])
+
+    def filter_likely_false_positives(self, crops, fraction=0.5):
+        """If only some frames have more than one face, the extra faces are
+        likely false positives; if most frames do, it's probably two people.
+        So if more than fraction of the frames with faces have a second 
+        face, this keeps the two best faces of every frame, otherwise only
+        the best one.
+
+        This is an optional postprocessing step. Modifies the original
+        data structure.
+        """
+        with_faces = sum(1 for frame_data in crops if len(frame_data["faces"]) > 0)
+        with_more = sum(1 for frame_data in crops if len(frame_data["faces"]) > 1)
+        allowed = 2 if with_faces > 0 and with_more / with_faces > fraction else 1
+        for frame_data in crops:
+            self._keep_faces(frame_data, [j < allowed for j in range(len(frame_data["faces"]))])
+
+    def _keep_faces(self, frame_data, keep):
+        """Keeps only the faces of one frame for which keep is True."""
+        for field in ("faces", "scores", "boxes"):
+            if field in frame_data:
+                frame_data[field] = [x for x, k in zip(frame_data[field], keep) if k]
 
     def keep_only_best_face(self, crops):
         """For each frame, only keeps the face with the highest confidence. 
         
         This gets rid of false positives, but obviously is problematic for 
-        videos with two people!
+        videos with two people! (See identities.py for that.)
 
         This is an optional postprocessing step. Modifies the original
         data structure.
@@ -367,13 +601,5 @@ class FaceExtractor:
             if len(frame_data["faces"]) > 0:
                 frame_data["faces"] = frame_data["faces"][:1]
                 frame_data["scores"] = frame_data["scores"][:1]
-
-    # TODO: def filter_likely_false_positives(self, crops):
-    #   if only some frames have more than 1 face, it's likely a false positive
-    #   if most frames have more than 1 face, it's probably two people
-    #   so find the % of frames with > 1 face; if > 0.X, keep the two best faces
-
-    # TODO: def filter_by_score(self, crops, min_score) to remove any
-    # crops with a confidence score lower than min_score
-
-    # TODO: def sort_by_histogram(self, crops) for videos with 2 people.
\ No newline at end of file
+                if "boxes" in frame_data:
+                    frame_data["boxes"] = frame_data["boxes"][:1]
\ No newline at end of file
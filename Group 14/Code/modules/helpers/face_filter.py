@@ -0,0 +1,185 @@
+"""Throws out face detections that are unlikely to be real faces.
+
+Every false positive that survives the face detector costs a forward pass
+of the classifier, and if it is the best "face" of a frame it also takes
+the place of the real one. FaceFilter checks the detections of all frames
+of a video at once, as a few tensor operations on the (N, 17) detection
+tensor, right after the NMS and before anything is cropped:
+
+    score     the detector's confidence is at least min_score
+    size      the box is at least min_size pixels high and wide, and takes
+              up at most max_area of the frame
+    aspect    height / width of the box is between min_aspect and
+              max_aspect (BlazeFace's boxes are close to square)
+    keypoints the six keypoints lie inside the box, give or take
+              keypoint_margin times its size, and with eyes_above_mouth
+              both eyes are above the mouth
+    extra     if only a few frames have more than one face, the extra
+              faces are likely false positives: when at most
+              extra_face_fraction of the frames with faces have a second
+              face, only the best face of every frame is kept, otherwise
+              the best two
+
+Every check is off unless it's given a value. For example:
+
+    face_filter = FaceFilter(min_score=0.8, max_area=0.1, min_aspect=0.5,
+                             max_aspect=2.0, keypoint_margin=0.25)
+    face_extractor = FaceExtractor(video_read_fn, facedet, face_filter=face_filter)
+    ...
+    print(face_filter.report())
+
+The filter keeps count of what it threw out, and of the classifier
+evaluations that saved: every frame that had faces but has none left is
+one less crop for the classifier when it looks at the best face per frame.
+The same numbers go to metrics as "faces_filtered", "faces_filtered_<check>"
+and "classifier_evals_saved".
+"""
+
+import torch
+
+from metrics import metrics
+
+
+# The keypoints are x, y pairs after ymin, xmin, ymax, xmax, in this order.
+_RIGHT_EYE, _LEFT_EYE, _NOSE, _MOUTH, _RIGHT_EAR, _LEFT_EAR = range(6)
+
+_CHECKS = ["score", "size", "aspect", "keypoints", "extra"]
+
+
+class FaceFilter:
+    """Decides which detections to keep, for all frames of a video at once."""
+
+    def __init__(self, min_score=None, min_size=None, max_area=None, min_aspect=None,
+                 max_aspect=None, keypoint_margin=None, eyes_above_mouth=False,
+                 extra_face_fraction=None):
+        """Creates a new FaceFilter. Leave an argument at None to skip that
+        check.
+
+        Arguments:
+            min_score: the lowest detector confidence to keep
+            min_size: the smallest height and width of a box, in pixels
+            max_area: the largest part of the frame a box may take up, for
+                example 0.1 for 10%
+            min_aspect, max_aspect: the allowed range of height / width
+            keypoint_margin: how far the keypoints may lie outside the box,
+                as a fraction of its height (vertically) or width
+            eyes_above_mouth: also require both eyes to be above the mouth
+            extra_face_fraction: see the module docstring
+        """
+        self.min_score = min_score
+        self.min_size = min_size
+        self.max_area = max_area
+        self.min_aspect = min_aspect
+        self.max_aspect = max_aspect
+        self.keypoint_margin = keypoint_margin
+        self.eyes_above_mouth = eyes_above_mouth
+        self.extra_face_fraction = extra_face_fraction
+
+        self.faces_seen = 0
+        self.faces_filtered = 0
+        self.filtered_by = { check: 0 for check in _CHECKS }
+        self.evals_saved = 0
+
+    def settings(self):
+        """The settings as a dictionary, for example for the face cache key."""
+        return { "min_score": self.min_score,
+                 "min_size": self.min_size,
+                 "max_area": self.max_area,
+                 "min_aspect": self.min_aspect,
+                 "max_aspect": self.max_aspect,
+                 "keypoint_margin": self.keypoint_margin,
+                 "eyes_above_mouth": self.eyes_above_mouth,
+                 "extra_face_fraction": self.extra_face_fraction }
+
+    def __call__(self, detections, frame_ids, num_frames, frame_size):
+        """Returns a boolean tensor that is True for the detections to keep.
+
+        Arguments:
+            detections: PyTorch tensor of shape (N, 17) with the detections
+                of all frames in frame coordinates, sorted by frame and,
+                within a frame, from the most to the least confident
+            frame_ids: PyTorch tensor with the frame of each detection
+            num_frames: the number of frames
+            frame_size: (width, height) of the frames
+        """
+        n = len(detections)
+        if n == 0:
+            return torch.ones(0, dtype=torch.bool, device=detections.device)
+
+        ymin, xmin, ymax, xmax = detections[:, 0], detections[:, 1], detections[:, 2], detections[:, 3]
+        h, w = ymax - ymin, xmax - xmin
+        passed = torch.ones((len(_CHECKS), n), dtype=torch.bool, device=detections.device)
+
+        if self.min_score is not None:
+            passed[0] = detections[:, 16] >= self.min_score
+
+        if self.min_size is not None:
+            passed[1] &= (h >= self.min_size) & (w >= self.min_size)
+        if self.max_area is not None:
+            passed[1] &= h * w <= self.max_area * frame_size[0] * frame_size[1]
+
+        aspect = h / w.clamp(min=1e-6)
+        if self.min_aspect is not None:
+            passed[2] &= aspect >= self.min_aspect
+        if self.max_aspect is not None:
+            passed[2] &= aspect <= self.max_aspect
+
+        keypoints_x = detections[:, 4:16:2]
+        keypoints_y = detections[:, 5:16:2]
+        if self.keypoint_margin is not None:
+            mx = (self.keypoint_margin * w)[:, None]
+            my = (self.keypoint_margin * h)[:, None]
+            inside = ((keypoints_x >= xmin[:, None] - mx) & (keypoints_x <= xmax[:, None] + mx) &
+                      (keypoints_y >= ymin[:, None] - my) & (keypoints_y <= ymax[:, None] + my))
+            passed[3] &= inside.all(dim=1)
+        if self.eyes_above_mouth:
+            eyes_y = torch.max(keypoints_y[:, _RIGHT_EYE], keypoints_y[:, _LEFT_EYE])
+            passed[3] &= eyes_y < keypoints_y[:, _MOUTH]
+
+        keep = passed[:4].all(dim=0)
+        if self.extra_face_fraction is not None:
+            passed[4] = self._best_faces(keep, frame_ids, num_frames)
+            keep &= passed[4]
+
+        self._count(passed, keep, frame_ids, num_frames)
+        return keep
+
+    def _best_faces(self, keep, frame_ids, num_frames):
+        """The "extra" check: False for the kept faces that are not among the
+        best one or two of their frame."""
+        kept_ids = frame_ids[keep]
+        counts = torch.bincount(kept_ids, minlength=num_frames)
+        with_faces = (counts > 0).sum().clamp(min=1)
+        fraction = (counts > 1).sum() / with_faces
+        allowed = torch.where(fraction > self.extra_face_fraction, 2, 1)
+
+        # The position of every kept face within its frame.
+        starts = torch.cumsum(counts, 0) - counts
+        rank = torch.full_like(frame_ids, -1)
+        rank[keep] = torch.arange(len(kept_ids), device=keep.device) - starts[kept_ids]
+        return rank < allowed
+
+    def _count(self, passed, keep, frame_ids, num_frames):
+        # Everything comes back to the CPU in one transfer.
+        frames_before = torch.bincount(frame_ids, minlength=num_frames) > 0
+        frames_after = torch.bincount(frame_ids[keep], minlength=num_frames) > 0
+        numbers = torch.cat([(~passed).sum(dim=1), (~keep).sum()[None],
+                             (frames_before & ~frames_after).sum()[None]]).tolist()
+        failed, filtered, saved = numbers[:len(_CHECKS)], numbers[-2], numbers[-1]
+
+        self.faces_seen += len(keep)
+        self.faces_filtered += filtered
+        self.evals_saved += saved
+        metrics.count("faces_filtered", filtered)
+        metrics.count("classifier_evals_saved", saved)
+        for check, count in zip(_CHECKS, failed):
+            self.filtered_by[check] += count
+            metrics.count("faces_filtered_" + check, count)
+
+    def report(self):
+        """A one-line summary of what was filtered so far."""
+        by_check = ", ".join("%s: %d" % (check, self.filtered_by[check]) for check in _CHECKS
+                             if self.filtered_by[check] > 0)
+        return "filtered %d of %d faces%s, saved %d classifier evaluations" % (
+            self.faces_filtered, self.faces_seen, " (%s)" % by_check if by_check else "",
+            self.evals_saved)
@@ -0,0 +1,187 @@
+"""The faces found in one video, as a struct of arrays.
+
+FaceExtractor.process_video() returns one dictionary per frame, each with
+its own lists of face crops, scores and boxes. The crops are views into the
+frames, so as long as any one of those dictionaries is alive, so is the
+whole (num_frames, H, W, 3) frame array. And keep_only_best_face() and
+remove_large_crops() rebuild the lists inside every dictionary.
+
+A FaceSet keeps one array per field instead, with one entry per face:
+
+    boxes    int (num_faces, 4): ymin, xmin, ymax, xmax in frame coordinates
+    scores   float32 (num_faces,): the detector's confidence
+    frame    int (num_faces,): the position of the face's frame in frame_idxs
+    video    (num_faces,): the video the face was found in
+
+plus the frame indices, the frame size and a reference to the frames. The
+faces are always in frame order. No crops are made until they're needed:
+letterbox() resizes the faces straight out of the frames into the
+classifier's input batch, and after that release() lets go of the frames.
+Filtering works on the arrays, with select().
+
+    faces = face_extractor.find_faces(frames, frame_idxs)
+    crops = faces.best_per_frame().letterbox(150, max_faces=64)
+    faces.release()
+
+to_dicts() and FaceSet.from_dicts() convert to and from the per-frame
+dictionaries of process_video(), for code that still uses those.
+"""
+
+import numpy as np
+
+from preprocess import letterbox_batch
+
+
+class FaceSet:
+    """The faces found in the frames of one video, one array per field."""
+
+    def __init__(self, boxes, scores, frame, frame_idxs, frame_size, frames=None,
+                 video_idx=0, crops=None):
+        """Creates a new FaceSet.
+
+        Arguments:
+            boxes: integer array of shape (num_faces, 4) with the rectangle
+                each face is cropped from, as ymin, xmin, ymax, xmax
+            scores: the confidence score of each face
+            frame: for each face, the position of its frame in frame_idxs
+                (and in frames); must be sorted
+            frame_idxs: the index in the video of every frame that was
+                looked at, including the frames without faces
+            frame_size: (width, height) of the frames
+            frames: the NumPy array of shape (num_frames, H, W, 3) the faces
+                were found in; the crops are taken from it when needed
+            video_idx: the video the frames were taken from
+            crops: instead of frames, a list with a ready-made crop for
+                each face (for example from the FaceCache)
+        """
+        self.boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        self.scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+        self.frame = np.asarray(frame, dtype=np.int64).reshape(-1)
+        self.video = np.full(len(self.frame), video_idx)
+        self.frame_idxs = np.asarray(frame_idxs, dtype=np.int64).reshape(-1)
+        self.frame_size = (int(frame_size[0]), int(frame_size[1]))
+        self.frames = frames
+        self.video_idx = video_idx
+        self._crops = crops
+
+    def __len__(self):
+        """The number of faces."""
+        return len(self.scores)
+
+    @property
+    def num_frames(self):
+        """The number of frames that were looked at, with or without faces."""
+        return len(self.frame_idxs)
+
+    def crop(self, i):
+        """Returns the crop of face i, as a view into the frames."""
+        if self._crops is not None:
+            return self._crops[i]
+        assert self.frames is not None, "the frames were released"
+        ymin, xmin, ymax, xmax = self.boxes[i]
+        return self.frames[self.frame[i], ymin:ymax, xmin:xmax]
+
+    def crops(self):
+        """Returns a list with the crop of every face."""
+        return [self.crop(i) for i in range(len(self))]
+
+    def select(self, keep):
+        """Returns a new FaceSet with only some of the faces.
+
+        Arguments:
+            keep: a boolean mask with an entry for every face, or an
+                increasing array of face positions
+
+        The new FaceSet shares the frames with this one, nothing is copied.
+        """
+        keep = np.asarray(keep)
+        if keep.dtype == bool:
+            keep = np.flatnonzero(keep)
+        crops = None if self._crops is None else [self._crops[i] for i in keep]
+        return FaceSet(self.boxes[keep], self.scores[keep], self.frame[keep], self.frame_idxs,
+                       self.frame_size, self.frames, self.video_idx, crops)
+
+    def best_per_frame(self):
+        """Keeps only the first face of every frame, which is the one the
+        face detector was the most confident about. This is what
+        FaceExtractor.keep_only_best_face() does to the dictionaries."""
+        first = np.ones(len(self), dtype=bool)
+        first[1:] = self.frame[1:] != self.frame[:-1]
+        return self.select(first)
+
+    def letterbox(self, size, out=None, max_faces=None):
+        """Resizes the faces straight from the frames into a batch for the
+        classifier, see preprocess.letterbox_batch().
+
+        Arguments:
+            size: the classifier's input size
+            out: optional uint8 array of shape (>= num_faces, size, size, 3)
+                to write the batch into
+            max_faces: if given, only the first max_faces faces are used
+
+        Returns a uint8 array of shape (num_faces, size, size, 3). It does
+        not refer to the frames, so they can be released afterwards.
+        """
+        n = len(self) if max_faces is None else min(len(self), max_faces)
+        return letterbox_batch([self.crop(i) for i in range(n)], size, out=out)
+
+    def materialize(self):
+        """Returns a FaceSet with copies of the crops, which doesn't need
+        the frames anymore (for when the frames are a reused buffer)."""
+        crops = [self.crop(i).copy() for i in range(len(self))]
+        return FaceSet(self.boxes, self.scores, self.frame, self.frame_idxs, self.frame_size,
+                       None, self.video_idx, crops)
+
+    def release(self):
+        """Lets go of the frames (and crops), so that their memory can be
+        freed. The boxes, scores and indices stay."""
+        self.frames = None
+        self._crops = None
+
+    def to_dicts(self):
+        """Returns the same list of dictionaries as process_video(), one for
+        each frame. The crops are views into the frames."""
+        starts = np.searchsorted(self.frame, np.arange(self.num_frames + 1))
+        frame_idxs = self.frame_idxs.tolist()
+        result = []
+        for f in range(self.num_frames):
+            a, b = starts[f], starts[f + 1]
+            result.append({ "video_idx": self.video_idx,
+                            "frame_idx": frame_idxs[f],
+                            "frame_w": self.frame_size[0],
+                            "frame_h": self.frame_size[1],
+                            "faces": [self.crop(i) for i in range(a, b)],
+                            "scores": list(self.scores[a:b]),
+                            "boxes": list(self.boxes[a:b]) })
+        return result
+
+    @classmethod
+    def from_dicts(cls, frames):
+        """Makes a FaceSet out of the per-frame dictionaries returned by
+        process_video() or FaceCache.get(). The crops are used as they are."""
+        frame, crops, scores, boxes = [], [], [], []
+        for f, frame_data in enumerate(frames):
+            frame_boxes = frame_data.get("boxes")
+            for j, face in enumerate(frame_data["faces"]):
+                frame.append(f)
+                crops.append(face)
+                scores.append(frame_data["scores"][j])
+                boxes.append(frame_boxes[j] if frame_boxes is not None
+                             else (0, 0, face.shape[0], face.shape[1]))
+
+        if len(frames) > 0:
+            frame_size = (frames[0]["frame_w"], frames[0]["frame_h"])
+            video_idx = frames[0]["video_idx"]
+        else:
+            frame_size = (0, 0)
+            video_idx = 0
+        return cls(boxes, scores, frame, [frame_data["frame_idx"] for frame_data in frames],
+                   frame_size, None, video_idx, crops)
+
+
+def as_face_set(faces):
+    """Returns faces as a FaceSet, converting the per-frame dictionaries of
+    process_video() if needed. None stays None."""
+    if faces is None or isinstance(faces, FaceSet):
+        return faces
+    return FaceSet.from_dicts(faces)
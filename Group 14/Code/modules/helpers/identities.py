@@ -0,0 +1,170 @@
+"""Scoring videos with more than one person in them.
+
+keep_only_best_face() keeps only the most confident face of every frame.
+With two people in a video, that is whichever face BlazeFace happens to
+like best, so a fake face can hide behind a real one. Instead, the faces
+here are grouped into identities: a face in one frame is linked to the
+face in the earlier frames that is nearby and looks the same. Every
+identity is then classified, all in one batch, and the video gets the fake
+probability of its most fake-looking identity.
+
+"Looks the same" is a cheap color histogram of the crop (hue and
+saturation), and "nearby" is the distance between the face centers in
+units of the face size. People in these videos hardly move, so that is
+enough to tell them apart; no face embedding model is needed. The cost is
+one small histogram per face plus a comparison with every identity so far,
+so it grows linearly with the number of faces.
+
+Identities that only show up in a few frames are likely false positives
+and are left out.
+
+    labels = cluster_identities(faces)
+    faces, labels = sample_identities(faces, labels, max_faces=64)
+    scores = predict(faces.letterbox(150))
+    probability = max_identity_score(scores, labels)
+"""
+
+import cv2
+import numpy as np
+
+
+def face_histograms(faces, bins=(16, 8), size=32):
+    """Returns a float32 array of shape (num_faces, bins[0] * bins[1]) with
+    a hue/saturation histogram of every face in a FaceSet, normalized to
+    sum to 1. The crops are shrunk to size x size first, which is plenty
+    for a histogram and keeps this cheap for large faces."""
+    result = np.zeros((len(faces), bins[0] * bins[1]), dtype=np.float32)
+    for i in range(len(faces)):
+        crop = faces.crop(i)
+        if crop.shape[0] == 0 or crop.shape[1] == 0: continue
+        small = cv2.resize(np.ascontiguousarray(crop), (size, size), interpolation=cv2.INTER_AREA)
+        hsv = cv2.cvtColor(small, cv2.COLOR_RGB2HSV)
+        hist = cv2.calcHist([hsv], [0, 1], None, list(bins), [0, 180, 0, 256]).reshape(-1)
+        result[i] = hist / max(hist.sum(), 1.0)
+    return result
+
+
+def cluster_identities(faces, max_shift=1.0, max_cost=1.0, min_fraction=0.25):
+    """Groups the faces of a FaceSet into identities, frame by frame.
+
+    Every face is compared with every identity seen so far: the cost of
+    linking them is how far the face's center is from where the identity
+    was last seen (in face sizes) plus one minus how much their histograms
+    overlap. Within a frame, the cheapest links are made first, and two
+    faces of the same frame never get the same identity. A face that can't
+    be linked for less than max_cost starts a new identity.
+
+    Arguments:
+        faces: a FaceSet
+        max_shift: faces that moved more than this many face sizes are
+            never linked
+        max_cost: the highest cost at which a face is still linked to an
+            identity
+        min_fraction: identities that are in fewer than this fraction of
+            the frames with faces are dropped, except for the largest one
+
+    Returns an integer NumPy array with the identity of every face, from 0
+    up, in the order the identities first appear; dropped faces get -1.
+    """
+    n = len(faces)
+    labels = np.full(n, -1, dtype=np.int64)
+    if n == 0:
+        return labels
+
+    histograms = face_histograms(faces)
+    boxes = faces.boxes.astype(np.float32)
+    centers = np.stack([(boxes[:, 1] + boxes[:, 3]) / 2, (boxes[:, 0] + boxes[:, 2]) / 2], axis=1)
+    sizes = np.maximum(np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]), 1.0)
+
+    # Per identity: where it was last seen, how big it was, and the mean
+    # of its histograms so far.
+    id_centers, id_sizes, id_histograms, id_counts = [], [], [], []
+
+    starts = np.searchsorted(faces.frame, np.arange(faces.num_frames + 1))
+    for f in range(faces.num_frames):
+        members = np.arange(starts[f], starts[f + 1])
+        if len(members) == 0: continue
+
+        links = []
+        if len(id_counts) > 0:
+            shift = np.linalg.norm(centers[members, None] - np.array(id_centers)[None], axis=2)
+            shift /= (sizes[members, None] + np.array(id_sizes)[None]) / 2
+            overlap = np.minimum(histograms[members, None], np.array(id_histograms)[None]).sum(axis=2)
+            cost = shift + (1.0 - overlap)
+            cost[shift > max_shift] = np.inf
+
+            order = np.argsort(cost, axis=None)
+            rows, cols = np.unravel_index(order, cost.shape)
+            links = [(r, c) for r, c in zip(rows, cols) if cost[r, c] <= max_cost]
+
+        taken_faces, taken_ids = set(), set()
+        for r, c in links:
+            if r in taken_faces or c in taken_ids: continue
+            taken_faces.add(r)
+            taken_ids.add(c)
+            labels[members[r]] = c
+
+        for r, i in enumerate(members):
+            if r not in taken_faces:
+                labels[i] = len(id_counts)
+                id_centers.append(centers[i])
+                id_sizes.append(sizes[i])
+                id_histograms.append(histograms[i].copy())
+                id_counts.append(1)
+            else:
+                c = labels[i]
+                id_centers[c] = centers[i]
+                id_sizes[c] = sizes[i]
+                id_counts[c] += 1
+                id_histograms[c] += (histograms[i] - id_histograms[c]) / id_counts[c]
+
+    # Leave out the identities that are only in a few frames.
+    counts = np.array(id_counts)
+    frames_with_faces = len(np.unique(faces.frame))
+    keep = counts >= min_fraction * frames_with_faces
+    keep[np.argmax(counts)] = True
+    new_ids = np.where(keep, np.cumsum(keep) - 1, -1)
+    return new_ids[labels]
+
+
+def sample_identities(faces, labels, max_faces=None):
+    """Picks the faces to classify: up to max_faces in total, shared evenly
+    by the identities and spread out evenly over each identity's frames.
+    If there are more identities than max_faces, only the max_faces
+    identities with the most faces are kept, with one face each. Faces with
+    label -1 are left out.
+
+    Returns the selected FaceSet and their labels.
+    """
+    num_identities = labels.max() + 1 if len(labels) > 0 else 0
+    if num_identities == 0 or max_faces == 0:
+        return faces.select(np.zeros(len(faces), dtype=bool)), labels[:0]
+
+    identities = np.arange(num_identities)
+    if max_faces is not None and num_identities > max_faces:
+        counts = np.bincount(labels[labels >= 0], minlength=num_identities)
+        identities = np.sort(np.argsort(-counts, kind="stable")[:max_faces])
+
+    keep = []
+    per_identity = None if max_faces is None else max(1, max_faces // len(identities))
+    for k in identities:
+        members = np.flatnonzero(labels == k)
+        if per_identity is not None and len(members) > per_identity:
+            members = members[np.linspace(0, len(members) - 1, per_identity).round().astype(int)]
+        keep.append(members)
+    keep = np.sort(np.concatenate(keep))
+    return faces.select(keep), labels[keep]
+
+
+def identity_scores(scores, labels):
+    """The mean score of every identity, given a score and a label for
+    every face."""
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    counts = np.bincount(labels)
+    return np.bincount(labels, weights=scores) / np.maximum(counts, 1)
+
+
+def max_identity_score(scores, labels):
+    """The fake probability of a video: the mean score of its most
+    fake-looking identity."""
+    return float(identity_scores(scores, labels).max())
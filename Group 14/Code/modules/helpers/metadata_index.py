@@ -0,0 +1,201 @@
+"""Index of the face images in the DeepFake training set.
+
+The training set consists of 50 shards. Shard nn has a metadata file
+metadatann.json and a directory DeepFakenn/DeepFakenn/ with one face image
+per video. Loading the 50 metadata files one after the other and calling
+os.path.exists() for every video is very slow on a network filesystem.
+
+build_index() instead loads the shards in parallel, lists each image
+directory only once, and saves the result as a small columnar index:
+
+    path      the face image of the video
+    label     0 = REAL, 1 = FAKE
+    original  the video a fake was made from ("" for real videos)
+    split     "train" or "val"
+    shard     the shard number
+
+Along with the index, it stores the size and modification time of every
+shard's metadata file and image directory. On the next run, only shards
+where these changed are read again, so loading an up-to-date index takes
+milliseconds.
+
+Typical use:
+
+    index = build_index("../input/deepfake", "deepfake_index.npz")
+    train = index["split"] == "train"
+    paths, y = list(index["path"][train]), list(index["label"][train])
+"""
+
+import json
+import os
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+LABELS = ["REAL", "FAKE"]
+
+COLUMNS = ["path", "label", "original", "split", "shard"]
+
+_FORMAT_VERSION = 1
+
+
+def shard_paths(input_dir, shard):
+    """Returns the metadata file and the image directory of a shard."""
+    name = "DeepFake%02d" % shard
+    return (os.path.join(input_dir, "metadata%d.json" % shard),
+            os.path.join(input_dir, name, name))
+
+
+def _stamp(path):
+    """Something that changes when the file or directory is modified."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _shard_stamp(input_dir, shard):
+    metadata_path, image_dir = shard_paths(input_dir, shard)
+    return [os.path.abspath(input_dir), _stamp(metadata_path), _stamp(image_dir)]
+
+
+def _read_shard(input_dir, shard, split):
+    """Reads one shard. Returns a dictionary with a list for each column."""
+    metadata_path, image_dir = shard_paths(input_dir, shard)
+    columns = { name: [] for name in COLUMNS }
+
+    try:
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+        images = set(os.listdir(image_dir))
+    except OSError:
+        return columns
+
+    for video, info in metadata.items():
+        image = os.path.splitext(video)[0] + ".jpg"
+        if image not in images or info.get("label") not in LABELS:
+            continue
+        columns["path"].append(os.path.join(image_dir, image))
+        columns["label"].append(LABELS.index(info["label"]))
+        columns["original"].append(info.get("original") or "")
+        columns["split"].append(split)
+        columns["shard"].append(shard)
+    return columns
+
+
+def _to_arrays(columns):
+    return { "path": np.array(columns["path"], dtype=str),
+             "label": np.array(columns["label"], dtype=np.int8),
+             "original": np.array(columns["original"], dtype=str),
+             "split": np.array(columns["split"], dtype=str),
+             "shard": np.array(columns["shard"], dtype=np.int16) }
+
+
+def load_index(index_path):
+    """Loads an index that was saved by build_index().
+
+    Returns a dictionary with a NumPy array for each column, plus the
+    shard stamps under "_stamps", or None if the file is missing, damaged
+    (for example only partly written), or was written by an incompatible
+    version. build_index() then builds the index again.
+    """
+    try:
+        with np.load(index_path) as data:
+            index = { name: data[name] for name in data.files }
+        meta = json.loads(str(index.pop("_meta")))
+        if meta.get("version") != _FORMAT_VERSION or any(name not in index for name in COLUMNS):
+            return None
+        index["_stamps"] = meta["stamps"]
+    except (OSError, ValueError, EOFError, KeyError, AttributeError, zipfile.BadZipFile):
+        return None
+    return index
+
+
+def save_index(index, index_path):
+    """Writes the index atomically, so readers never see a partial file."""
+    meta = { "version": _FORMAT_VERSION, "stamps": index["_stamps"] }
+
+    # Every save writes its own temporary file, so two runs that refresh
+    # the same index don't write into each other's file. Writing through
+    # the file object also stops np.savez from adding ".npz" to the name.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_path)),
+                                    prefix=os.path.basename(index_path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, _meta=np.array(json.dumps(meta)),
+                     **{ name: index[name] for name in COLUMNS })
+    except:
+        os.remove(tmp_path)
+        raise
+    # mkstemp makes the file readable by its owner only.
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, index_path)
+
+
+def build_index(input_dir, index_path=None, shards=range(50), val_shards=(47, 48, 49),
+                num_workers=16, verbose=True):
+    """Builds or refreshes the index of the training set.
+
+    Arguments:
+        input_dir: the directory with the metadata files and the DeepFakenn
+            directories
+        index_path: where to keep the index; if None, the index is always
+            built from scratch and not saved
+        shards: the shard numbers to include
+        val_shards: the shards that go into the "val" split; all others
+            are "train"
+        num_workers: number of threads that read shards; this is all I/O
+            waiting, so using many threads helps on a network filesystem
+
+    Returns the index as a dictionary of NumPy arrays, see load_index().
+    Rows are sorted by shard, and within a shard they are in the order of
+    the metadata file.
+    """
+    shards = list(shards)
+    assert len(shards) > 0
+    val_shards = set(val_shards)
+
+    old = load_index(index_path) if index_path is not None else None
+
+    # Stat the shards in parallel too; on a network filesystem even that
+    # adds up.
+    with ThreadPoolExecutor(max_workers=num_workers) as ex:
+        stamps = dict(zip(shards, ex.map(lambda s: _shard_stamp(input_dir, s), shards)))
+
+    def split_of(shard):
+        return "val" if shard in val_shards else "train"
+
+    # A shard can be kept as it is when its stamp and split didn't change.
+    reuse = set()
+    if old is not None:
+        for shard in shards:
+            if old["_stamps"].get(str(shard)) == [split_of(shard)] + stamps[shard]:
+                reuse.add(shard)
+
+    if old is not None and reuse == set(shards) and len(old["_stamps"]) == len(shards):
+        return old
+
+    to_read = [shard for shard in shards if shard not in reuse]
+    if verbose:
+        print("Indexing %d of %d shards" % (len(to_read), len(shards)))
+    with ThreadPoolExecutor(max_workers=num_workers) as ex:
+        read = dict(zip(to_read, ex.map(lambda s: _read_shard(input_dir, s, split_of(s)), to_read)))
+
+    parts = []
+    for shard in shards:
+        if shard in reuse:
+            rows = old["shard"] == shard
+            parts.append({ name: old[name][rows] for name in COLUMNS })
+        else:
+            parts.append(_to_arrays(read[shard]))
+
+    index = { name: np.concatenate([part[name] for part in parts]) for name in COLUMNS }
+    index["_stamps"] = { str(shard): [split_of(shard)] + stamps[shard] for shard in shards }
+
+    if index_path is not None:
+        save_index(index, index_path)
+    return index
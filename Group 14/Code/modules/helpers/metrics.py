@@ -0,0 +1,266 @@
+"""Per-stage timers, counters and histograms for the detection pipeline.
+
+The pipeline reports into the shared `metrics` object in this module:
+
+    with metrics.stage("decode"):       # time a stage
+        ...
+    metrics.count("frames_decoded", n)  # add to a counter
+    metrics.observe("faces_per_video", n)  # add a value to a histogram
+
+All of this is switched off by default, and then every call returns right
+away, so leaving the calls in costs next to nothing. To collect numbers:
+
+    from metrics import metrics
+    metrics.enable()
+    ... run the pipeline ...
+    print(metrics.to_json())
+    open("metrics.prom", "w").write(metrics.to_prometheus())
+
+Stage timings are wall-clock times in the calling thread. CUDA work runs
+asynchronously, so for honest GPU timings enable with synchronize=True,
+which waits for the GPU at the end of every stage (this slows things down
+a little). The decoder processes of decode_pool.py have their own copy of
+this module, so their decode and tiling times are not included.
+
+metrics.profile() additionally records the stages as torch.profiler
+ranges, so they show up by name in the profiler trace.
+"""
+
+import bisect
+import contextlib
+import json
+import threading
+import time
+
+
+# Upper bounds of the histogram buckets, as in Prometheus.
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                1.0, 2.5, 5.0, 10.0, float("inf"))
+VALUE_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, float("inf"))
+
+
+class Histogram:
+    """Counts values into fixed buckets, and keeps their sum, min and max.
+    With keep_samples=True it also keeps every value, so the quantiles are
+    exact instead of estimated from the buckets."""
+
+    def __init__(self, buckets, keep_samples=False):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.samples = [] if keep_samples else None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value < self.min: self.min = value
+        if value > self.max: self.max = value
+        if self.samples is not None:
+            self.samples.append(value)
+
+    def quantile(self, q):
+        """Estimates a quantile by interpolating inside its bucket, or
+        computes it from the samples if they were kept."""
+        if self.count == 0: return None
+        if self.samples is not None:
+            samples = sorted(self.samples)
+            pos = q * (len(samples) - 1)
+            i = int(pos)
+            if i + 1 >= len(samples): return samples[-1]
+            return samples[i] + (samples[i + 1] - samples[i]) * (pos - i)
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n > 0:
+                lower = self.buckets[i - 1] if i > 0 else self.min
+                upper = self.buckets[i]
+                lower, upper = max(lower, self.min), min(upper, self.max)
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.max
+
+    def to_dict(self):
+        return { "count": self.count,
+                 "sum": self.sum,
+                 "min": self.min if self.count > 0 else None,
+                 "max": self.max if self.count > 0 else None,
+                 "mean": self.sum / self.count if self.count > 0 else None,
+                 "p50": self.quantile(0.5),
+                 "p90": self.quantile(0.9),
+                 "p99": self.quantile(0.99),
+                 "buckets": { _format_bound(b): n for b, n in zip(self.buckets, self.counts) } }
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+class _NullContext:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_context = _NullContext()
+
+
+class _Stage:
+    __slots__ = ("metrics", "name", "start", "record")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.record = None
+
+    def __enter__(self):
+        if self.metrics._record_function is not None:
+            self.record = self.metrics._record_function(self.name)
+            self.record.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.metrics._synchronize is not None:
+            self.metrics._synchronize()
+        elapsed = time.perf_counter() - self.start
+        if self.record is not None:
+            self.record.__exit__(*exc)
+        self.metrics._add_time(self.name, elapsed)
+        return False
+
+
+class Metrics:
+    """A set of stage timers, counters and histograms."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.keep_samples = False
+        self._lock = threading.Lock()
+        self._synchronize = None
+        self._record_function = None
+        self.reset()
+
+    def enable(self, synchronize=False, keep_samples=False):
+        """Starts collecting. With synchronize=True, every stage waits for
+        pending CUDA work before it stops its timer. With keep_samples=True,
+        every value is kept for exact percentiles (for benchmarks; a long
+        running process would keep growing)."""
+        self.keep_samples = keep_samples
+        self._synchronize = None
+        if synchronize:
+            import torch
+            if torch.cuda.is_available():
+                self._synchronize = torch.cuda.synchronize
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        """Forgets everything collected so far."""
+        with self._lock:
+            self.stages = {}
+            self.counters = {}
+            self.histograms = {}
+
+    def stage(self, name):
+        """A context manager that times a stage of the pipeline."""
+        if not self.enabled:
+            return _null_context
+        return _Stage(self, name)
+
+    def count(self, name, n=1):
+        """Adds n to a counter."""
+        if not self.enabled: return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        """Adds a value to a histogram."""
+        if not self.enabled: return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(VALUE_BUCKETS, self.keep_samples)
+            histogram.observe(value)
+
+    def _add_time(self, name, elapsed):
+        with self._lock:
+            histogram = self.stages.get(name)
+            if histogram is None:
+                histogram = self.stages[name] = Histogram(TIME_BUCKETS, self.keep_samples)
+            histogram.observe(elapsed)
+
+    @contextlib.contextmanager
+    def profile(self, **profiler_args):
+        """Runs torch.profiler.profile() and records every stage as a named
+        range in it. Collecting is enabled for the duration.
+
+            with metrics.profile(activities=[ProfilerActivity.CPU]) as prof:
+                ...
+            prof.export_chrome_trace("trace.json")
+        """
+        import torch
+
+        was_enabled = self.enabled
+        self.enabled = True
+        self._record_function = torch.profiler.record_function
+        try:
+            with torch.profiler.profile(**profiler_args) as prof:
+                yield prof
+        finally:
+            self._record_function = None
+            self.enabled = was_enabled
+
+    def to_dict(self):
+        with self._lock:
+            return { "stages": { name: h.to_dict() for name, h in self.stages.items() },
+                     "counters": dict(self.counters),
+                     "histograms": { name: h.to_dict() for name, h in self.histograms.items() } }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def to_prometheus(self, prefix="deepfake_"):
+        """Returns everything in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            if len(self.stages) > 0:
+                name = prefix + "stage_seconds"
+                lines.append("# TYPE %s histogram" % name)
+                for stage, h in sorted(self.stages.items()):
+                    lines += _prometheus_histogram(name, h, 'stage="%s"' % stage)
+
+            for counter, value in sorted(self.counters.items()):
+                name = prefix + counter + "_total"
+                lines.append("# TYPE %s counter" % name)
+                lines.append("%s %s" % (name, value))
+
+            for histogram, h in sorted(self.histograms.items()):
+                name = prefix + histogram
+                lines.append("# TYPE %s histogram" % name)
+                lines += _prometheus_histogram(name, h, "")
+        return "\n".join(lines) + "\n"
+
+
+def _prometheus_histogram(name, histogram, labels):
+    sep = "," if labels else ""
+    lines = []
+    cumulative = 0
+    for bound, n in zip(histogram.buckets, histogram.counts):
+        cumulative += n
+        lines.append('%s_bucket{%s%sle="%s"} %d' % (name, labels, sep, _format_bound(bound), cumulative))
+    braces = "{%s}" % labels if labels else ""
+    lines.append("%s_sum%s %r" % (name, braces, histogram.sum))
+    lines.append("%s_count%s %d" % (name, braces, histogram.count))
+    return lines
+
+
+# The instance the pipeline reports into.
+metrics = Metrics()
@@ -0,0 +1,104 @@
+"""Weighted non-maximum suppression for the detections of many frames at once.
+
+BlazeFace.nms() loops over the frames in Python, and for each frame over
+the faces it keeps: take the detection with the highest score, average it
+with every other detection that overlaps it by more than the threshold
+(weighted by score), drop those, and repeat. The same face usually shows up
+in two or three overlapping tiles, so this is also what merges the tiles.
+
+weighted_nms() does exactly the same, but for all frames in one go. The
+detections are put in a padded (num_frames, max_faces, 17) tensor, sorted
+by score within each frame, and every step of the loop handles the current
+best detection of every frame at the same time. So the Python loop runs
+as often as the largest number of faces kept in a single frame, instead of
+once per face in every frame.
+"""
+
+import torch
+
+
+def _iou(boxes):
+    """The IoU between every pair of boxes in each frame, computed like
+    BlazeFace's jaccard(). boxes has shape (F, K, 4) with ymin, xmin, ymax,
+    xmax; the result has shape (F, K, K)."""
+    max_yx = torch.min(boxes[:, :, None, 2:], boxes[:, None, :, 2:])
+    min_yx = torch.max(boxes[:, :, None, :2], boxes[:, None, :, :2])
+    inter = torch.clamp(max_yx - min_yx, min=0)
+    inter = inter[..., 0] * inter[..., 1]
+    area = (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+    return inter / (area[:, :, None] + area[:, None, :] - inter)
+
+
+def weighted_nms(detections, frame_ids, num_frames, threshold=0.3):
+    """Weighted non-maximum suppression, separately for every frame.
+
+    Arguments:
+        detections: PyTorch tensor of shape (N, 17) with the detections of
+            all frames: ymin, xmin, ymax, xmax, six keypoints and the score
+        frame_ids: PyTorch tensor with N frame numbers in [0, num_frames);
+            the detections don't have to be sorted by frame
+        num_frames: number of frames
+        threshold: detections that overlap the best one by more than this
+            (IoU) are merged into it, like BlazeFace's
+            min_suppression_threshold
+
+    Returns a list with a tensor of shape (num_faces, 17) for each frame,
+    with the same detections in the same order as BlazeFace.nms() gives
+    (up to float rounding in the weighted averages).
+    """
+    device, dtype = detections.device, detections.dtype
+    if len(detections) == 0:
+        return [torch.zeros((0, 17), dtype=dtype, device=device) for _ in range(num_frames)]
+
+    # Sort by frame, and by score within each frame. sort() is stable, so
+    # this is a two-pass sort.
+    order = torch.sort(detections[:, 16], descending=True, stable=True)[1]
+    order = order[torch.sort(frame_ids[order], stable=True)[1]]
+    detections = detections[order]
+    frame_ids = frame_ids[order]
+
+    # Scatter into a padded (F, K, 17) tensor.
+    counts = torch.bincount(frame_ids, minlength=num_frames)
+    K = int(counts.max())
+    starts = torch.cumsum(counts, 0) - counts
+    slots = torch.arange(len(detections), device=device) - starts[frame_ids]
+    padded = torch.zeros((num_frames, K, 17), dtype=dtype, device=device)
+    padded[frame_ids, slots] = detections
+    remaining = torch.zeros((num_frames, K), dtype=torch.bool, device=device)
+    remaining[frame_ids, slots] = True
+
+    overlaps = _iou(padded[:, :, :4]) > threshold
+    frames = torch.arange(num_frames, device=device)
+    slot_range = torch.arange(K, device=device)
+    coordinates = padded[:, :, :16]
+    scores = padded[:, :, 16]
+
+    kept = []
+    kept_mask = []
+    while True:
+        active = remaining.any(dim=1)
+        if not active.any(): break
+
+        # The best remaining detection of each frame is the first one left.
+        pivot = torch.where(remaining, slot_range, K).min(dim=1)[0].clamp(max=K - 1)
+        cluster = overlaps[frames, pivot] & remaining
+        cluster[frames, pivot] |= active
+        remaining &= ~cluster
+
+        # Average the cluster, weighted by score. A pivot without overlaps
+        # is kept as is.
+        weights = torch.where(cluster, scores, torch.zeros_like(scores))
+        total = weights.sum(dim=1)
+        size = cluster.sum(dim=1)
+        merged = padded[frames, pivot].clone()
+        averaged = (coordinates * weights[:, :, None]).sum(dim=1) / total[:, None].clamp(min=1e-12)
+        multiple = size > 1
+        merged[:, :16] = torch.where(multiple[:, None], averaged, merged[:, :16])
+        merged[:, 16] = torch.where(multiple, total / size.clamp(min=1), merged[:, 16])
+
+        kept.append(merged)
+        kept_mask.append(active)
+
+    kept = torch.stack(kept, dim=1)
+    kept_mask = torch.stack(kept_mask, dim=1)
+    return list(torch.split(kept[kept_mask], kept_mask.sum(dim=1).tolist()))
@@ -0,0 +1,211 @@
+"""Packed face datasets for training the classifier.
+
+Reading 100k+ small JPEGs with cv2.imread() into Python lists every time
+the training notebook starts is slow, uses a lot of memory, and each
+DataLoader worker ends up with its own copy of those lists. Instead, the
+images are packed once into a single uint8 array of shape (N, H, W, 3)
+that is stored as a .npy file and memory-mapped during training. All the
+DataLoader workers then share the same pages through the OS page cache.
+
+A pack is a directory with these files:
+
+    images.npy   uint8 array of shape (N, H, W, 3), RGB
+    labels.npy   int8 array with N labels (0 = REAL, 1 = FAKE)
+    valid.npy    bool array that is False for images that could not be read
+    meta.json    image size, the source path of every image, and a
+                 fingerprint of the inputs; written last, so a pack without
+                 it is incomplete
+
+Typical use:
+
+    pack_images(paths, labels, "packed/train", size=(150, 150))
+    dataset = PackedFaceDataset("packed/train", transform=train_transform)
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+
+_FORMAT_VERSION = 1
+
+
+def _fingerprint(paths, labels, size):
+    h = hashlib.blake2b(digest_size=20)
+    h.update(("%d:%d:%d\n" % (_FORMAT_VERSION, size[0], size[1])).encode("utf-8"))
+    for path, label in zip(paths, labels):
+        h.update(("%s\t%d\n" % (path, int(label))).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _read_image(path, size):
+    img = cv2.imread(path)
+    if img is None: return None
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    if (img.shape[1], img.shape[0]) != size:
+        img = cv2.resize(img, size)
+    return img
+
+
+def is_packed(out_dir, paths, labels, size=(150, 150)):
+    """Returns True if out_dir already holds a complete pack of exactly
+    these images and labels."""
+    try:
+        with open(os.path.join(out_dir, "meta.json")) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return meta.get("fingerprint") == _fingerprint(paths, labels, size)
+
+
+def pack_images(paths, labels, out_dir, size=(150, 150), num_workers=8, chunk_size=256,
+                verbose=True):
+    """Reads a list of images and stores them as one packed dataset.
+
+    If out_dir already holds a pack of the same paths, labels and size,
+    nothing is done. Images that are not of the requested size are resized
+    with cv2.resize(). Images that can't be read are marked as invalid and
+    left out by PackedFaceDataset.
+
+    Arguments:
+        paths: list of image files
+        labels: list with a label for each image
+        out_dir: the directory to write the pack into
+        size: (width, height) of the packed images
+        num_workers: number of threads that read images; cv2.imread and
+            cv2.resize release the GIL, so threads are enough here
+        chunk_size: number of images each thread reads at a time
+
+    Returns out_dir.
+    """
+    assert len(paths) == len(labels)
+    size = tuple(size)
+    if is_packed(out_dir, paths, labels, size):
+        return out_dir
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Remove an old meta.json first, so that a pack that is interrupted
+    # halfway is never mistaken for a complete one.
+    meta_path = os.path.join(out_dir, "meta.json")
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    num_images = len(paths)
+    W, H = size
+    images = np.lib.format.open_memmap(os.path.join(out_dir, "images.npy"), mode="w+",
+                                       dtype=np.uint8, shape=(num_images, H, W, 3))
+    valid = np.zeros(num_images, dtype=bool)
+
+    def read_chunk(start):
+        for i in range(start, min(start + chunk_size, num_images)):
+            img = _read_image(paths[i], size)
+            if img is not None:
+                images[i] = img
+                valid[i] = True
+        return min(chunk_size, num_images - start)
+
+    starts = range(0, num_images, chunk_size)
+    with ThreadPoolExecutor(max_workers=num_workers) as ex:
+        done = ex.map(read_chunk, starts)
+        if verbose:
+            from tqdm import tqdm
+            done = tqdm(done, total=len(starts), desc="Packing %s" % out_dir)
+        for _ in done:
+            pass
+
+    images.flush()
+    del images
+
+    np.save(os.path.join(out_dir, "labels.npy"), np.asarray(labels, dtype=np.int8))
+    np.save(os.path.join(out_dir, "valid.npy"), valid)
+
+    meta = { "version": _FORMAT_VERSION,
+             "size": list(size),
+             "count": num_images,
+             "num_invalid": int(num_images - valid.sum()),
+             "fingerprint": _fingerprint(paths, labels, size),
+             "paths": list(paths) }
+    with open(meta_path + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(meta_path + ".tmp", meta_path)
+
+    if verbose and meta["num_invalid"] > 0:
+        print("%d of %d images could not be read" % (meta["num_invalid"], num_images))
+    return out_dir
+
+
+class PackedFaceDataset(Dataset):
+    """A Dataset that reads images from a pack made by pack_images().
+
+    Returns the same [image, label] pairs as the notebook's old
+    ImageDataset: the image is channels-first (3, H, W), the label a
+    float32 scalar.
+    """
+
+    def __init__(self, pack_dir, indices=None, transform=None):
+        """Creates a new PackedFaceDataset.
+
+        Arguments:
+            pack_dir: a directory that was written by pack_images()
+            indices: optional list of image numbers to use from the pack;
+                by default all valid images are used
+            transform: optional albumentations transform, called as
+                transform(image=img) on the (H, W, 3) uint8 image
+        """
+        self.pack_dir = pack_dir
+        self.transform = transform
+
+        with open(os.path.join(pack_dir, "meta.json")) as f:
+            meta = json.load(f)
+        self.size = tuple(meta["size"])
+
+        valid = np.load(os.path.join(pack_dir, "valid.npy"))
+        if indices is None:
+            indices = np.flatnonzero(valid)
+        else:
+            indices = np.asarray(indices, dtype=np.int64)
+            indices = indices[valid[indices]]
+        self.indices = indices
+        self.labels = np.load(os.path.join(pack_dir, "labels.npy"))[indices]
+
+        # Opened on first use, so that every DataLoader worker maps the
+        # file itself instead of getting a pickled copy of the images.
+        self._images = None
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    def images(self):
+        """The memory-mapped (N, H, W, 3) array with all images in the pack,
+        including the ones not selected by indices."""
+        if self._images is None:
+            self._images = np.load(os.path.join(self.pack_dir, "images.npy"), mmap_mode="r")
+        return self._images
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+
+        img = self.images()[self.indices[idx]]
+
+        if self.transform is not None:
+            img = self.transform(image=img)["image"]
+
+        # One contiguous copy, which also takes the image out of the
+        # read-only memory map.
+        img = np.ascontiguousarray(img.transpose(2, 0, 1))
+
+        label = np.float32(self.labels[idx])
+        return [img, label]
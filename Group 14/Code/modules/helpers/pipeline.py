@@ -0,0 +1,568 @@
+"""The complete video -> fake probability pipeline as one object.
+
+final_project.py builds the pipeline step by step as notebook globals.
+DeepfakeDetector does the same for code that needs to keep the models
+loaded and call them repeatedly, such as the scoring server in server.py:
+it reads the frames, finds the faces with BlazeFace, and averages the
+classifier's scores over the faces, exactly like predict_on_video().
+"""
+
+import os
+import sys
+
+import numpy as np
+import torch
+
+from batching import DynamicBatcher, DetectionBatcher
+from decode_pool import decode_videos
+
+from read_video_1 import VideoReader
+from face_extract_1 import FaceExtractor
+from face_cache import FaceCache
+from face_set import as_face_set
+from identities import cluster_identities, sample_identities, max_identity_score
+from preprocess import Preprocessor
+from classifier import load_backend
+from metrics import metrics
+from prefetch import Stage, StageError, pipelined
+
+
+mean = [0.485, 0.456, 0.406]
+std = [0.229, 0.224, 0.225]
+
+
+def sampling_rounds(num_frames, first_round):
+    """The rounds of adaptive sampling, as lists of positions in the
+    num_frames evenly spaced frames. Each round fills in the frames halfway
+    between the ones we already have, so reading every round reads exactly
+    the same frames as reading them all at once. E.g. for 64 frames and 
+    first_round=8: positions 0, 8, 16, ... first, then 4, 12, 20, ..., 
+    then 2, 6, 10, ..., and finally the odd ones."""
+    stride = max(1, num_frames // first_round)
+    taken = set()
+    rounds = []
+    while True:
+        positions = [p for p in range(0, num_frames, stride) if p not in taken]
+        if len(positions) > 0:
+            rounds.append(positions)
+            taken.update(positions)
+        if stride == 1: break
+        stride //= 2
+    return rounds
+
+
+def is_confident(scores, threshold, band, z):
+    """Whether the mean of scores is more than band away from threshold,
+    with z standard errors of slack for how much the scores disagree."""
+    if len(scores) == 0: return False
+    margin = band + z * scores.std() / np.sqrt(len(scores))
+    return abs(scores.mean() - threshold) > margin
+
+
+def load_blazeface(blazeface_dir, device):
+    """Loads BlazeFace from a folder with blazeface.py, blazeface.pth and
+    anchors.npy."""
+    if blazeface_dir not in sys.path:
+        sys.path.insert(0, blazeface_dir)
+    from blazeface import BlazeFace
+
+    facedet = BlazeFace().to(device)
+    facedet.load_weights(os.path.join(blazeface_dir, "blazeface.pth"))
+    facedet.load_anchors(os.path.join(blazeface_dir, "anchors.npy"))
+    facedet.train(False)
+    return facedet
+
+
+class DeepfakeDetector:
+    """Keeps BlazeFace and the classifier loaded and scores videos."""
+
+    # Adaptive sampling (see predict_on_video_adaptive): how many frames the
+    # first round looks at, and how far the mean score must be from the
+    # threshold, plus z standard errors, before we stop reading frames.
+    first_round = 8
+    band = 0.2
+    z = 2.0
+
+    def __init__(self, blazeface_dir, model_path, backend="eager", device=None,
+                 frames_per_video=64, input_size=150, fake_threshold=0.60,
+                 face_cache_dir=None, verbose=False, facedet=None, classifier=None,
+                 multi_face=False, face_filter=None, face_cache=None, detect_every=1,
+                 adaptive=False):
+        """Creates a new DeepfakeDetector.
+
+        Arguments:
+            blazeface_dir: folder with blazeface.py and its weights
+            model_path: the classifier weights (for the "eager" backend) or
+                exported model (for "torchscript" and "onnx")
+            backend: see classifier.load_backend()
+            device: where to run the models; defaults to the GPU if there
+                is one
+            frames_per_video: how many frames to look at per video
+            input_size: the classifier's input size
+            fake_threshold: videos with a probability above this are FAKE
+            face_cache_dir: if given, faces are cached there (see FaceCache)
+            facedet, classifier: an already loaded face detector and 
+                inference backend to use instead of loading them from 
+                blazeface_dir and model_path (for example in benchmarks)
+            multi_face: if True, every person in the video is classified
+                and the video gets the probability of the most fake-looking
+                one (see identities.py), instead of only looking at the
+                best face of every frame
+            face_filter: optional FaceFilter that throws out unlikely faces
+                before they are cropped (see face_filter.py)
+            face_cache: an already opened FaceCache to use instead of
+                opening one in face_cache_dir
+            detect_every: if more than 1, the face detector only runs on
+                every Nth frame and the faces are tracked in between (see
+                FaceExtractor)
+            adaptive: if True, predict_on_video() and predict_on_videos()
+                start with a few frames and only read more of them while
+                the video is too close to call (see 
+                predict_on_video_adaptive). predict_on_video_set() always
+                reads all frames_per_video frames.
+        """
+        if device is None:
+            device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.frames_per_video = frames_per_video
+        self.input_size = input_size
+        self.fake_threshold = fake_threshold
+        self.verbose = verbose
+        self.multi_face = multi_face
+        self.adaptive = adaptive
+
+        if facedet is None:
+            facedet = load_blazeface(blazeface_dir, self.device)
+        self.facedet = facedet
+        self.video_reader = VideoReader(verbose=verbose)
+        video_read_fn = lambda x: self.video_reader.read_frames(x, num_frames=frames_per_video)
+        self.face_extractor = FaceExtractor(video_read_fn, self.facedet, detect_every=detect_every,
+                                            face_filter=face_filter)
+
+        if classifier is None:
+            classifier = load_backend(backend, model_path, self.device)
+        self.classifier = classifier
+        self.preprocessor = Preprocessor(input_size, mean, std, device=self.classifier.device,
+                                         max_batch_size=frames_per_video)
+
+        if face_cache is None and face_cache_dir is not None:
+            face_cache = FaceCache(face_cache_dir)
+        self.face_cache = face_cache
+        self.face_cache_params = None
+        if face_cache is not None:
+            self.face_cache_params = { "frames_per_video": frames_per_video,
+                                       "insets": self.video_reader.insets,
+                                       "jitter": 0,
+                                       "seed": None,
+                                       "margin": self.face_extractor.margin,
+                                       "detect_every": self.face_extractor.detect_every,
+                                       "min_score_thresh": getattr(self.facedet, "min_score_thresh", None),
+                                       "min_suppression_threshold": getattr(self.facedet, "min_suppression_threshold", None) }
+            if face_filter is not None:
+                self.face_cache_params["face_filter"] = face_filter.settings()
+
+    def find_faces(self, video_path):
+        """Returns the faces in a video as a FaceSet, from the cache if there
+        is one, or None if the video could not be read."""
+        find = lambda: self.face_extractor.find_faces_in_video(video_path)
+        if self.face_cache is not None:
+            return as_face_set(self.face_cache.get_or_compute(video_path, self.face_cache_params, find))
+        return find()
+
+    def prepare_faces(self, faces):
+        """Keeps the best face per frame and letterboxes them straight into
+        a uint8 array of shape (num_faces, input_size, input_size, 3).
+        faces is a FaceSet or a list of per-frame dictionaries. Afterwards
+        the FaceSet no longer refers to the frames."""
+        faces = as_face_set(faces)
+        crops = faces.best_per_frame().letterbox(self.input_size, max_faces=self.frames_per_video)
+        faces.release()
+        return crops
+
+    def prepare_identities(self, faces):
+        """Groups the faces into identities and letterboxes up to
+        frames_per_video of them, shared evenly by the identities. Returns
+        the crops and the identity of each crop."""
+        faces = as_face_set(faces)
+        labels = cluster_identities(faces)
+        selected, labels = sample_identities(faces, labels, self.frames_per_video)
+        crops = selected.letterbox(self.input_size)
+        faces.release()
+        return crops, labels
+
+    def _prepare(self, faces):
+        """Returns the crops to classify for a video, and the function that
+        turns their scores into the video's fake probability."""
+        if self.multi_face:
+            crops, labels = self.prepare_identities(faces)
+            return crops, lambda scores: max_identity_score(scores, labels)
+        return self.prepare_faces(faces), np.mean
+
+    def predict_on_batch(self, crops):
+        """Returns the fake probability for each crop."""
+        return self.classifier(self.preprocessor(crops))
+
+    def predict_on_video(self, video_path):
+        """Returns the fake probability of a video. Like predict_on_video()
+        in final_project.py, this is 0.5 if something went wrong or no face
+        was found. Those fallbacks are counted in metrics, by reason."""
+        if self.adaptive:
+            return self.predict_on_video_adaptive(video_path)
+
+        with metrics.stage("video"):
+            try:
+                faces = self.find_faces(video_path)
+                if faces is None or faces.num_frames == 0:
+                    return self._fallback("unreadable")
+                crops, reduce_fn = self._prepare(faces)
+                metrics.observe("faces_per_video", len(crops))
+                if len(crops) > 0:
+                    return float(reduce_fn(self.predict_on_batch(crops)))
+                return self._fallback("no_faces")
+            except Exception as e:
+                print("Prediction error on video %s: %s: %s" % (video_path, type(e).__name__, str(e)))
+                return self._fallback("error")
+
+    def predict_on_video_adaptive(self, video_path):
+        """Like predict_on_video(), but stops reading frames as soon as the
+        video is clearly REAL or clearly FAKE.
+
+        Most videos are, after just a few frames. So first the best faces of
+        first_round evenly spaced frames are classified, and more frames are
+        only read and classified while the mean score is too close to the
+        FAKE threshold to call (see is_confident). The rounds are read over
+        one open video (see FrameRounds), so a video that never becomes
+        confident is decoded no more than with predict_on_video(), and ends
+        up with the same frames. The faces of every round are cached. Only 
+        the best face of every frame is looked at, also with multi_face.
+        """
+        with metrics.stage("video"):
+            try:
+                with self._open_rounds(video_path) as rounds:
+                    crops = self._round_crops(self._read_round(rounds, 0))
+                    return self._classify_rounds(rounds, crops)[0]
+            except Exception as e:
+                print("Prediction error on video %s: %s: %s" % (video_path, type(e).__name__, str(e)))
+                return self._fallback("error")
+
+    def _open_rounds(self, video_path):
+        rounds = sampling_rounds(self.frames_per_video, self.first_round)
+        return self.video_reader.open_rounds(video_path, self.frames_per_video, rounds)
+
+    def _read_round(self, rounds, r):
+        """Returns the faces of the frames of round r if they are in the
+        face cache, else the frames: a tuple of (cache key, FaceSet or None,
+        frames or None)."""
+        key = None
+        if self.face_cache is not None:
+            params = dict(self.face_cache_params, first_round=self.first_round, round=r)
+            key = self.face_cache.key(rounds.path, params)
+            faces = as_face_set(self.face_cache.get(key))
+            if faces is not None:
+                return None, faces, None
+        return key, None, rounds.read(r)
+
+    def _round_crops(self, round_data):
+        """Finds the faces in the output of _read_round(), if they weren't
+        cached, and returns the best face of every frame, letterboxed. None
+        if the frames couldn't be read."""
+        key, faces, frames = round_data
+        if faces is None:
+            if frames is None: return None
+            if len(frames[1]) == 0:
+                # All of this round's frames were in earlier rounds already.
+                return np.zeros((0, self.input_size, self.input_size, 3), dtype=np.uint8)
+            faces = self.face_extractor.find_faces(*frames)
+            if key is not None:
+                self.face_cache.put(key, faces)
+        return self.prepare_faces(faces)
+
+    def _classify_rounds(self, rounds, crops):
+        """Classifies the crops of the first round, then reads, finds and
+        classifies the faces of the next rounds until the video is 
+        confident or there are no rounds left. Returns the probability and
+        the fallback reason (None for a real prediction)."""
+        if crops is None:
+            return self._fallback("unreadable"), "unreadable"
+
+        scores = []
+        num_faces = 0
+        r = 0
+        while crops is not None:
+            num_faces += len(crops)
+            if len(crops) > 0:
+                scores.append(self.predict_on_batch(crops))
+                if is_confident(np.concatenate(scores), self.fake_threshold, self.band, self.z):
+                    break
+            r += 1
+            if r == rounds.num_rounds: break
+            crops = self._round_crops(self._read_round(rounds, r))
+
+        metrics.observe("faces_per_video", num_faces)
+        metrics.observe("rounds_per_video", min(r + 1, rounds.num_rounds))
+        if len(scores) == 0:
+            return self._fallback("no_faces"), "no_faces"
+        return float(np.concatenate(scores).mean()), None
+
+    def _fallback(self, reason):
+        metrics.count("fallback")
+        metrics.count("fallback_" + reason)
+        return 0.5
+
+    def predict_on_video_set(self, paths, num_workers=4, max_wait=0.5, detector_batch_size=256):
+        """Returns the fake probability of every video in paths, in order.
+
+        Decoding and tiling happen in num_workers processes, which hand the
+        frames over through shared memory (see decode_pool.py). The tiles of
+        all videos go through the face detector in full batches of
+        detector_batch_size tiles, and the face crops go through the
+        classifier in full batches of frames_per_video crops (see
+        batching.py). max_wait bounds how many seconds a video can wait for
+        a batch to fill up. Videos that are in the face cache skip decoding
+        and face detection. Videos without a prediction get 0.5, and are
+        counted in metrics by why: "unreadable", "no_faces" or "error".
+
+        predict_on_video_set() in final_project.py is this method.
+        """
+        predictions = [None] * len(paths)
+        fallback_reasons = {}
+        batcher = DynamicBatcher(self.predict_on_batch, max_batch_size=self.frames_per_video,
+                                 max_wait=max_wait)
+        detector_batcher = DetectionBatcher(self.face_extractor, max_batch_size=detector_batch_size,
+                                            max_wait=max_wait, face_sets=True)
+        decoded_videos = {}
+
+        def collect():
+            for i, score in batcher.pop_results().items():
+                if score is not None:
+                    predictions[i] = score
+
+        def classify_due():
+            # Runs the classifier on a partial batch if its max_wait is up.
+            try:
+                batcher.poll()
+            except Exception as e:
+                print("Prediction error: %s: %s" % (type(e).__name__, str(e)))
+            collect()
+
+        def submit(i, prepared):
+            crops, reduce_fn = prepared
+            metrics.observe("faces_per_video", len(crops))
+            if len(crops) == 0:
+                fallback_reasons[i] = "no_faces"
+            try:
+                batcher.submit(i, crops, reduce_fn=reduce_fn)
+            except Exception as e:
+                print("Prediction error: %s: %s" % (type(e).__name__, str(e)))
+            classify_due()
+
+        def detected():
+            # Crop the faces of the videos the detector is done with, and
+            # send them on to the classifier.
+            for i, faces in detector_batcher.pop_results().items():
+                decoded = decoded_videos.pop(i)
+                try:
+                    if faces is None: continue
+                    if i in cache_keys:
+                        self.face_cache.put(cache_keys[i], faces)
+                    prepared = self._prepare(faces)
+                except Exception as e:
+                    print("Prediction error on video %s: %s: %s" % (paths[i], type(e).__name__, str(e)))
+                    continue
+                finally:
+                    # The crops are copies, so the frames can go now.
+                    if faces is not None: faces.release()
+                    del faces
+                    decoded.close()
+
+                submit(i, prepared)
+
+        def cached_faces(i, digest):
+            cache_keys[i] = self.face_cache.key(paths[i], self.face_cache_params, digest)
+            return self.face_cache.get(cache_keys[i], video_idx=i)
+
+        # Only the videos that were hashed in an earlier run can be looked
+        # up in the cache right away. The others are hashed by the decoder
+        # processes, so that reading them all doesn't hold up the start.
+        to_decode = []
+        cache_keys = {}
+        for i, path in enumerate(paths):
+            if self.face_cache is None:
+                to_decode.append(i)
+                continue
+            try:
+                digest = self.face_cache.known_digest(path)
+            except OSError as e:
+                print("Prediction error on video %s: %s: %s" % (path, type(e).__name__, str(e)))
+                fallback_reasons[i] = "unreadable"
+                continue
+            faces = cached_faces(i, digest) if digest is not None else None
+            if faces is None:
+                to_decode.append(i)
+            else:
+                submit(i, self._prepare(faces))
+
+        def detect_due():
+            try:
+                detector_batcher.poll()
+            except Exception as e:
+                print("Prediction error: %s: %s" % (type(e).__name__, str(e)))
+            detected()
+            classify_due()
+
+        def wait_time():
+            waits = [w for w in (detector_batcher.wait_time(), batcher.wait_time()) if w is not None]
+            return min(waits) if len(waits) > 0 else None
+
+        # While waiting for the decoders, wake up when a batch is due, so
+        # max_wait also holds when no new video comes in.
+        hash_videos = [self.face_cache is not None and i not in cache_keys for i in to_decode]
+        for j, decoded in decode_videos([paths[i] for i in to_decode], self.frames_per_video,
+                                        self.facedet.input_size, num_workers=num_workers,
+                                        insets=self.video_reader.insets, verbose=self.verbose,
+                                        hash_videos=hash_videos, timeout=wait_time,
+                                        detect_every=self.face_extractor.detect_every):
+            if j is None:
+                detect_due()
+                continue
+            i = to_decode[j]
+            if decoded is None:
+                fallback_reasons[i] = "unreadable"
+                continue
+            if decoded.digest is not None:
+                # The same contents may be cached already, for example
+                # under another file name.
+                try:
+                    self.face_cache.remember_digest(paths[i], decoded.digest)
+                    faces = cached_faces(i, decoded.digest)
+                except OSError:
+                    faces = None
+                if faces is not None:
+                    decoded.close()
+                    submit(i, self._prepare(faces))
+                    continue
+            decoded_videos[i] = decoded
+            try:
+                detector_batcher.submit(i, decoded.frames, decoded.frame_idxs,
+                                        decoded.tiles, decoded.resize_info)
+                detector_batcher.poll()
+            except Exception as e:
+                print("Prediction error on video %s: %s: %s" % (paths[i], type(e).__name__, str(e)))
+                if i not in detector_batcher:
+                    decoded_videos.pop(i).close()
+            detected()
+
+        while detector_batcher.pending() > 0:
+            try:
+                detector_batcher.flush()
+            except Exception as e:
+                print("Prediction error: %s: %s" % (type(e).__name__, str(e)))
+        detected()
+
+        while batcher.pending() > 0:
+            try:
+                batcher.flush()
+            except Exception as e:
+                print("Prediction error: %s: %s" % (type(e).__name__, str(e)))
+        collect()
+
+        for i in range(len(paths)):
+            if predictions[i] is None:
+                predictions[i] = self._fallback(fallback_reasons.get(i, "error"))
+        return predictions
+
+    def predict_on_videos(self, paths, decode_threads=2, queue_size=2, with_reasons=False):
+        """Yields the fake probability of every video in paths, in order,
+        like predict_on_video() but with the stages overlapping: while one
+        video is being classified, the next ones are already in the face
+        detector and being read (see prefetch.py).
+
+        Arguments:
+            paths: the video files
+            decode_threads: how many videos are read at the same time
+            queue_size: how many videos may wait in front of each stage
+            with_reasons: yield (probability, fallback reason) pairs
+                instead, where the reason is None for a real prediction and
+                "unreadable", "no_faces" or "error" for the 0.5 fallback
+
+        With adaptive, the stages handle the first round of every video
+        (see predict_on_video_adaptive). The videos that need more rounds
+        read and detect those in the classify stage, while the other 
+        stages move on to the next videos.
+        """
+        def decode(path):
+            # Returns the faces if the video is in the cache, else its frames.
+            if self.face_cache is not None:
+                key = self.face_cache.key(path, self.face_cache_params)
+                faces = as_face_set(self.face_cache.get(key))
+                if faces is not None:
+                    return None, faces, None
+            else:
+                key = None
+            return key, None, self.video_reader.read_frames(path, num_frames=self.frames_per_video)
+
+        def detect(decoded):
+            key, faces, frames = decoded
+            if faces is None:
+                if frames is None: return None
+                faces = self.face_extractor.find_faces(*frames)
+                if key is not None:
+                    self.face_cache.put(key, faces)
+            if faces.num_frames == 0: return None
+            return self._prepare(faces)
+
+        def classify(prepared):
+            if prepared is None:
+                return self._fallback("unreadable"), "unreadable"
+            crops, reduce_fn = prepared
+            metrics.observe("faces_per_video", len(crops))
+            if len(crops) == 0:
+                return self._fallback("no_faces"), "no_faces"
+            return float(reduce_fn(self.predict_on_batch(crops))), None
+
+        # Adaptive sampling: the video stays open from one stage to the
+        # next, and is closed once it's classified or something fails.
+        def decode_first_round(path):
+            rounds = self._open_rounds(path)
+            try:
+                return rounds, self._read_round(rounds, 0)
+            except:
+                rounds.close()
+                raise
+
+        def detect_first_round(decoded):
+            rounds, round_data = decoded
+            try:
+                return rounds, self._round_crops(round_data)
+            except:
+                rounds.close()
+                raise
+
+        def classify_rounds(prepared):
+            rounds, crops = prepared
+            with rounds:
+                return self._classify_rounds(rounds, crops)
+
+        if self.adaptive:
+            decode, detect, classify = decode_first_round, detect_first_round, classify_rounds
+
+        stages = [Stage("decode", decode, num_threads=decode_threads, queue_size=queue_size),
+                  Stage("detect", detect, queue_size=queue_size),
+                  Stage("classify", classify, queue_size=queue_size)]
+        for path, result in pipelined(paths, stages):
+            if isinstance(result, StageError):
+                print("Prediction error on video %s: %s" % (path, str(result)))
+                result = self._fallback("error"), "error"
+            yield result if with_reasons else result[0]
+
+    def result(self, probability):
+        """FAKE or REAL, as in result.csv."""
+        return "FAKE" if probability > self.fake_threshold else "REAL"
+
+    def score(self, video_path, filename=None):
+        """Returns a row like those of result.csv: a dictionary with the
+        filename, the fake probability as "label", and "result"."""
+        probability = self.predict_on_video(video_path)
+        return { "filename": filename if filename is not None else os.path.basename(video_path),
+                 "label": probability,
+                 "result": self.result(probability) }
@@ -0,0 +1,154 @@
+"""Runs the stages of the pipeline at the same time, in threads.
+
+Scoring one video after the other runs decode -> detect -> classify
+strictly in sequence, so the CPU decoder sits idle while the models run
+and the other way around. pipelined() instead gives every stage its own
+thread(s), with a bounded queue in front of each stage. While the
+classifier works on one video, the face detector already has the next
+one and the decoder is reading the one after that.
+
+    stages = [Stage("decode", read_fn, num_threads=2, queue_size=2),
+              Stage("detect", detect_fn),
+              Stage("classify", classify_fn)]
+    for path, result in pipelined(paths, stages):
+        ...
+
+The results come out in the same order as the items went in. Threads are
+enough here because OpenCV and PyTorch release the GIL while they work.
+The queue sizes bound how many videos are in flight, and so how much
+memory the frames and crops take: at most queue_size waiting in front of
+each stage plus one per thread.
+"""
+
+import queue
+import threading
+
+
+class Stage:
+    """One step of the pipeline: a function and how to run it."""
+
+    def __init__(self, name, fn, num_threads=1, queue_size=2):
+        """Creates a new Stage.
+
+        Arguments:
+            name: used in error messages
+            fn: takes the output of the previous stage (or the item itself
+                for the first stage) and returns the input for the next
+            num_threads: how many threads run fn; only use more than one
+                if fn is safe to call from several threads at once
+            queue_size: how many inputs may wait in front of this stage
+        """
+        assert num_threads > 0 and queue_size > 0
+        self.name = name
+        self.fn = fn
+        self.num_threads = num_threads
+        self.queue_size = queue_size
+
+
+class StageError(Exception):
+    """Stands in for the result of an item whose stage raised an exception.
+    The later stages are skipped for that item."""
+
+    def __init__(self, stage, error):
+        super(StageError, self).__init__("%s: %s: %s" % (stage, type(error).__name__, str(error)))
+        self.stage = stage
+        self.error = error
+
+
+# Tells a thread that there is no more input.
+_DONE = object()
+
+# How often blocked threads check whether the consumer went away.
+_POLL_INTERVAL = 0.1
+
+
+def _put(q, value, stop):
+    while not stop.is_set():
+        try:
+            q.put(value, timeout=_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=_POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return _DONE
+
+
+def pipelined(items, stages):
+    """Runs every item through the stages, with the stages working at the
+    same time on different items.
+
+    Yields (item, result) tuples in the order of items. If a stage raised
+    an exception for an item, result is a StageError. If the caller stops
+    early, the threads are stopped too.
+    """
+    items = list(items)
+    stop = threading.Event()
+
+    # inputs[k] feeds stage k; the last one collects the results.
+    inputs = [queue.Queue(maxsize=stage.queue_size) for stage in stages]
+    inputs.append(queue.Queue())
+
+    def feed():
+        for seq, item in enumerate(items):
+            if not _put(inputs[0], (seq, item, item), stop): return
+        for _ in range(stages[0].num_threads):
+            _put(inputs[0], _DONE, stop)
+
+    # The last thread of a stage to finish tells the next stage.
+    running = [stage.num_threads for stage in stages]
+    lock = threading.Lock()
+
+    def work(k):
+        stage = stages[k]
+        while True:
+            message = _get(inputs[k], stop)
+            if message is _DONE: break
+
+            seq, item, value = message
+            if not isinstance(value, StageError):
+                try:
+                    value = stage.fn(value)
+                except Exception as e:
+                    value = StageError(stage.name, e)
+            if not _put(inputs[k + 1], (seq, item, value), stop): return
+
+        with lock:
+            running[k] -= 1
+            last = running[k] == 0
+        if last:
+            followers = stages[k + 1].num_threads if k + 1 < len(stages) else 1
+            for _ in range(followers):
+                _put(inputs[k + 1], _DONE, stop)
+
+    threads = [threading.Thread(target=feed, name="pipeline-feed", daemon=True)]
+    for k, stage in enumerate(stages):
+        for t in range(stage.num_threads):
+            threads.append(threading.Thread(target=work, args=(k,), daemon=True,
+                                            name="pipeline-%s-%d" % (stage.name, t)))
+    for thread in threads:
+        thread.start()
+
+    # Put the results back in order.
+    waiting = {}
+    next_seq = 0
+    try:
+        while next_seq < len(items):
+            message = _get(inputs[-1], stop)
+            if message is _DONE: break
+            seq, item, value = message
+            waiting[seq] = (item, value)
+            while next_seq in waiting:
+                yield waiting.pop(next_seq)
+                next_seq += 1
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
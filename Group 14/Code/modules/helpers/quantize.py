@@ -0,0 +1,169 @@
+"""INT8 quantization of the classifier for CPU inference.
+
+Two variants are made from the folded model (see classifier.fold_model()):
+
+    quantize_dynamic_head()  only the Linear layers of the head are INT8;
+                             their activations are quantized on the fly.
+                             Easy, but the head is a tiny part of the work.
+    quantize_static()        post-training static quantization of the whole
+                             model with torch.ao FX graph mode. It runs the
+                             model on a sample of face crops first to
+                             calibrate the activation ranges.
+
+save_quantized() traces a quantized model into a TorchScript file, which
+loads with classifier.TorchScriptBackend like any other exported model.
+
+quantization_report() then compares the variants on speed and on how well
+they agree with the predictions in result.csv, so that one of them can be
+picked for production.
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from classifier import fold_model
+
+
+def quantize_dynamic_head(model):
+    """Returns a folded copy of the model with INT8 Linear layers."""
+    folded = fold_model(model).cpu()
+    return quantize_dynamic(folded, { nn.Linear }, dtype=torch.qint8)
+
+
+def quantize_static(model, calibration, engine="x86"):
+    """Post-training static quantization of the whole model.
+
+    Arguments:
+        model: the float classifier
+        calibration: an iterable of normalized float batches of shape
+            (N, 3, H, W), for example from calibration_batches()
+        engine: the quantized kernels to use, "x86" (or "fbgemm") for
+            Intel/AMD CPUs, "qnnpack" for ARM
+
+    Returns the quantized model, which runs on the CPU only.
+    """
+    torch.backends.quantized.engine = engine
+    folded = fold_model(model).cpu()
+
+    example = None
+    prepared = None
+    with torch.no_grad():
+        for x in calibration:
+            x = x.cpu()
+            if prepared is None:
+                example = x[:1]
+                prepared = prepare_fx(folded, get_default_qconfig_mapping(engine), (example,))
+            prepared(x)
+
+    assert prepared is not None, "need at least one calibration batch"
+    return convert_fx(prepared)
+
+
+def save_quantized(model, path, input_size=150):
+    """Traces, freezes and saves a quantized model as TorchScript."""
+    example = torch.zeros((1, 3, input_size, input_size))
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model.eval(), example))
+    traced.save(path)
+
+
+def calibration_batches(crops, preprocessor, batch_size=32, max_images=512, seed=0):
+    """Yields normalized batches from a random sample of face crops.
+
+    Arguments:
+        crops: uint8 array of shape (N, H, W, 3), or a list of such arrays
+            (for example one per video)
+        preprocessor: a preprocess.Preprocessor
+        max_images: the size of the sample
+
+    The batches are views into the preprocessor's buffer, so each one must
+    be used before the next is requested.
+    """
+    if isinstance(crops, (list, tuple)):
+        crops = np.concatenate(crops)
+    rng = np.random.RandomState(seed)
+    sample = rng.permutation(len(crops))[:max_images]
+    for start in range(0, len(sample), batch_size):
+        yield preprocessor(crops[np.sort(sample[start:start + batch_size])])
+
+
+def evaluate(backend, preprocessor, video_crops, batch_size=64):
+    """Runs a backend on the crops of every video.
+
+    Arguments:
+        backend: one of the classifier backends
+        preprocessor: a preprocess.Preprocessor for the backend's device
+        video_crops: dictionary of filename -> uint8 crops of shape
+            (N, size, size, 3); they must already be letterboxed to the
+            preprocessor's input size (see preprocess.letterbox_batch)
+
+    Returns a dictionary of filename -> mean fake probability, and the
+    number of images per second (model time only, including preprocessing).
+    """
+    predictions = {}
+    num_images = 0
+    elapsed = 0.0
+    for filename, crops in video_crops.items():
+        scores = []
+        for start in range(0, len(crops), batch_size):
+            begin = time.perf_counter()
+            scores.append(backend(preprocessor(crops[start:start + batch_size])))
+            elapsed += time.perf_counter() - begin
+        num_images += len(crops)
+        predictions[filename] = float(np.concatenate(scores).mean()) if len(scores) > 0 else 0.5
+    return predictions, num_images / max(elapsed, 1e-9)
+
+
+def quantization_report(variants, preprocessor, video_crops, reference_csv, threshold=0.60,
+                        batch_size=64):
+    """Compares classifier variants on speed and agreement with result.csv.
+
+    Arguments:
+        variants: dictionary of name -> backend; the first one is the
+            baseline for the speedup column
+        preprocessor: a preprocess.Preprocessor on the CPU
+        video_crops: dictionary of filename -> letterboxed uint8 crops,
+            see evaluate(); videos that are not in reference_csv are skipped
+        reference_csv: a result.csv with filename, label (the fake
+            probability) and result (FAKE or REAL) columns
+        threshold: fake probability above which a video counts as FAKE;
+            the default is the 0.60 that result.csv was written with
+
+    Returns a DataFrame with one row per variant:
+        images/s     throughput of the model on the CPU
+        speedup      relative to the first variant
+        agreement    fraction of videos with the same FAKE/REAL result
+        mean |dp|    mean absolute difference with the reference probability
+        log loss     of the probabilities against the reference results
+    """
+    reference = pd.read_csv(reference_csv).set_index("filename")
+    video_crops = { name: crops for name, crops in video_crops.items() if name in reference.index }
+    names = list(video_crops.keys())
+    ref_prob = reference.loc[names, "label"].values.astype(np.float64)
+    ref_fake = (reference.loc[names, "result"].values == "FAKE")
+
+    rows = []
+    baseline_speed = None
+    for variant, backend in variants.items():
+        predictions, speed = evaluate(backend, preprocessor, video_crops, batch_size)
+        prob = np.array([predictions[name] for name in names])
+        if baseline_speed is None:
+            baseline_speed = speed
+
+        clipped = np.clip(prob, 1e-6, 1 - 1e-6)
+        log_loss = -np.mean(np.where(ref_fake, np.log(clipped), np.log(1 - clipped)))
+
+        rows.append({ "variant": variant,
+                      "images/s": speed,
+                      "speedup": speed / baseline_speed,
+                      "agreement": np.mean((prob > threshold) == ref_fake),
+                      "mean |dp|": np.mean(np.abs(prob - ref_prob)),
+                      "log loss": log_loss })
+
+    return pd.DataFrame(rows).set_index("variant")
@@ -8,13 +8,122 @@ Original file is located at
 """
 
 import os
+import struct
 import cv2
 import numpy as np
 
+from metrics import metrics
+
+
+# MP4 boxes inside a trak that only contain other boxes, on the way down
+# to the handler and sample table boxes we need.
+_MP4_CONTAINER_BOXES = (b"mdia", b"minf", b"stbl")
+
+
+def _iter_mp4_boxes(data, start=0, end=None):
+    """Yields (box_type, payload_start, payload_end) for the boxes in data."""
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack(">I4s", data[pos:pos+8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[pos+8:pos+16])[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header: return
+        yield box_type, pos + header, min(pos + size, end)
+        pos += size
+
+
+def _collect_mp4_boxes(data, start, end, wanted, found):
+    for box_type, payload_start, payload_end in _iter_mp4_boxes(data, start, end):
+        if box_type in wanted:
+            found.setdefault(box_type, payload_start)
+        elif box_type in _MP4_CONTAINER_BOXES:
+            _collect_mp4_boxes(data, payload_start, payload_end, wanted, found)
+
+
+def _read_mp4_moov(path):
+    """Reads just the moov box from an MP4/MOV file, skipping over the
+    (much larger) media data. Returns None if there is no moov box."""
+    with open(path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        pos = 0
+        while pos + 8 <= file_size:
+            f.seek(pos)
+            header = f.read(16)
+            size, box_type = struct.unpack(">I4s", header[:8])
+            header_size = 8
+            if size == 1:
+                size = struct.unpack(">Q", header[8:16])[0]
+                header_size = 16
+            elif size == 0:
+                size = file_size - pos
+            if size < header_size: return None
+            if box_type == b"moov":
+                f.seek(pos + header_size)
+                return f.read(size - header_size)
+            pos += size
+    return None
+
+
+def read_mp4_keyframes(path):
+    """Finds the keyframes of the first video track of an MP4/MOV file.
+
+    OpenCV has no API for this, but the container stores it: the "stss"
+    (sync sample) box lists the samples that can be decoded on their own.
+    If a video track has no stss box, every sample is a keyframe.
+
+    Sample numbers are in decode order. For the codecs we care about that
+    is close enough to the frame index used by CAP_PROP_POS_FRAMES.
+
+    Returns a sorted NumPy array with the (0-based) frame indices of the
+    keyframes, or None if the file is not an MP4 we can parse (for example
+    a fragmented MP4, or some other container).
+    """
+    try:
+        moov = _read_mp4_moov(path)
+        if moov is None: return None
+
+        for box_type, trak_start, trak_end in _iter_mp4_boxes(moov):
+            if box_type != b"trak": continue
+
+            found = {}
+            _collect_mp4_boxes(moov, trak_start, trak_end, (b"hdlr", b"stsz", b"stss"), found)
+
+            # hdlr: version/flags (4), pre_defined (4), handler_type (4)
+            hdlr = found.get(b"hdlr")
+            if hdlr is None or moov[hdlr+8:hdlr+12] != b"vide": continue
+
+            # stss: version/flags (4), entry_count (4), entries (4 each, 1-based)
+            stss = found.get(b"stss")
+            if stss is not None:
+                entry_count = struct.unpack(">I", moov[stss+4:stss+8])[0]
+                entries = np.frombuffer(moov, dtype=">u4", count=entry_count, offset=stss+8)
+                return np.sort(entries.astype(np.int64) - 1)
+
+            # stsz: version/flags (4), sample_size (4), sample_count (4)
+            stsz = found.get(b"stsz")
+            if stsz is not None:
+                sample_count = struct.unpack(">I", moov[stsz+8:stsz+12])[0]
+                return np.arange(sample_count)
+            return None
+    except (OSError, struct.error, ValueError):
+        return None
+    return None
+
+
 class VideoReader:
     """Helper class for reading one or more frames from a video file."""
 
-    def __init__(self, verbose=True, insets=(0, 0)):
+    # How expensive a seek is, expressed as the number of frames we could
+    # have grabbed in the same time. Seeking only pays off when it skips 
+    # more frames than this.
+    seek_cost = 48
+
+    def __init__(self, verbose=True, insets=(0, 0), keyframe_seek=True):
         """Creates a new VideoReader.
 
         Arguments:
@@ -24,11 +133,16 @@ class VideoReader:
                 to remove unimportant content around the borders. 
                 Useful for face detection, which may not work if the 
                 faces are too small.
+            keyframe_seek: when reading several frames, jump ahead to the 
+                nearest keyframe instead of grabbing every frame in between,
+                if the container tells us where the keyframes are (see 
+                plan_reads). If False, always scan through the video.
         """
         self.verbose = verbose
         self.insets = insets
+        self.keyframe_seek = keyframe_seek
 
-    def read_frames(self, path, num_frames, jitter=0, seed=None):
+    def read_frames(self, path, num_frames, jitter=0, seed=None, allocate=None):
         """Reads frames that are always evenly spaced throughout the video.
 
         Arguments:
@@ -39,6 +153,11 @@ class VideoReader:
                 this is useful so we don't always land on even or odd frames
             seed: random seed for jittering; if you set this to a fixed value,
                 you probably want to set it only on the first video 
+            allocate: optional function that takes the shape of the frames,
+                (n, H, W, 3), and returns a uint8 array of that shape to 
+                decode into, for example one in shared memory. It's called
+                once the first frame is decoded. If reading stops early, the
+                frames returned are a view of the first rows of that array.
         """
         assert num_frames > 0
 
@@ -46,16 +165,38 @@ class VideoReader:
         frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
         if frame_count <= 0: return None
 
-        frame_idxs = np.linspace(0, frame_count - 1, num_frames, endpoint=True, dtype=np.int)
-        if jitter > 0:
-            np.random.seed(seed)
-            jitter_offsets = np.random.randint(-jitter, jitter, len(frame_idxs))
-            frame_idxs = np.clip(frame_idxs + jitter_offsets, 0, frame_count - 1)
-
-        result = self._read_frames_at_indices(path, capture, frame_idxs)
+        frame_idxs = self._evenly_spaced_indices(frame_count, num_frames, jitter, seed)
+        result = self._read_frames_at_indices(path, capture, frame_idxs, allocate)
         capture.release()
         return result
 
+    def iter_frames(self, path, num_frames, chunk_size=8, jitter=0, seed=None):
+        """Streaming version of read_frames(). Picks the same evenly spaced
+        frame indices, but yields the frames in chunks instead of returning
+        them all at once.
+
+        Arguments:
+            path: the video file
+            num_frames: how many frames to read
+            chunk_size: maximum number of frames per chunk
+            jitter, seed: see read_frames()
+
+        Yields tuples of (NumPy array of shape (n, H, W, 3), list of frame
+        indices), where n <= chunk_size. See iter_frames_at_indices() for
+        the rules about the reused buffer.
+        """
+        assert num_frames > 0
+
+        capture = cv2.VideoCapture(path)
+        try:
+            frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            if frame_count <= 0: return
+
+            frame_idxs = self._evenly_spaced_indices(frame_count, num_frames, jitter, seed)
+            yield from self._iter_frames_at_indices(path, capture, frame_idxs, chunk_size)
+        finally:
+            capture.release()
+
     def read_random_frames(self, path, num_frames, seed=None):
         """Picks the frame indices at random.
         
@@ -102,33 +243,140 @@ class VideoReader:
         capture.release()
         return result
 
-    def _read_frames_at_indices(self, path, capture, frame_idxs):
+    def iter_frames_at_indices(self, path, frame_idxs, chunk_size=8, buffer=None):
+        """Reads frames from a video and yields them in fixed-size chunks.
+
+        This is the bounded-memory counterpart of read_frames_at_indices().
+        The frames are decoded into a single preallocated buffer that is
+        reused for every chunk, so peak memory depends on chunk_size and
+        not on how many frames are requested.
+
+        Important: each chunk is a view into the reused buffer, so its
+        contents are overwritten when you ask for the next chunk. Copy
+        anything you want to keep (such as face crops) before that.
+
+        Arguments:
+            path: the video file
+            frame_idxs: a list of frame indices, sorted from low-to-high
+            chunk_size: maximum number of frames per chunk
+            buffer: optional NumPy array of shape (chunk_size, H, W, 3) to
+                decode into; if None or the wrong shape, a new one is made
+
+        Yields tuples of (NumPy array of shape (n, H, W, 3), list of frame
+        indices), where n <= chunk_size. Stops early if reading fails.
+        """
+        assert len(frame_idxs) > 0
+        capture = cv2.VideoCapture(path)
         try:
-            frames = []
-            idxs_read = []
-            for frame_idx in range(frame_idxs[0], frame_idxs[-1] + 1):
-                # Get the next frame, but don't decode if we're not using it.
-                ret = capture.grab()
-                if not ret:
-                    if self.verbose:
-                        print("Error grabbing frame %d from movie %s" % (frame_idx, path))
-                    break
-
-                # Need to look at this frame?
-                current = len(idxs_read)
-                if frame_idx == frame_idxs[current]:
-                    ret, frame = capture.retrieve()
-                    if not ret or frame is None:
-                        if self.verbose:
-                            print("Error retrieving frame %d from movie %s" % (frame_idx, path))
-                        break
+            yield from self._iter_frames_at_indices(path, capture, frame_idxs,
+                                                    chunk_size, buffer)
+        finally:
+            capture.release()
+
+    def read_frames_at_index_sets(self, path, index_sets):
+        """Decodes the frames for several consumers in a single pass.
+
+        Each consumer asks for its own set of frame indices (for example,
+        the face detector wants 64 evenly spaced frames and something else
+        wants a few random ones). The union of these indices is decoded
+        just once, and every consumer gets back its own frames.
+
+        Arguments:
+            path: the video file
+            index_sets: a list of lists of frame indices
+
+        Returns a list with one entry per index set: a tuple of (NumPy array
+        of shape (n, H, W, 3), list of frame indices), or None if none of 
+        that consumer's frames could be read.
+        """
+        all_idxs = sorted(set(int(i) for idxs in index_sets for i in idxs))
+        if len(all_idxs) == 0:
+            return [None] * len(index_sets)
+
+        result = self.read_frames_at_indices(path, all_idxs)
+        if result is None:
+            return [None] * len(index_sets)
+
+        frames, idxs_read = result
+        position = { frame_idx: i for i, frame_idx in enumerate(idxs_read) }
 
-                    frame = self._postprocess_frame(frame)
-                    frames.append(frame)
-                    idxs_read.append(frame_idx)
+        results = []
+        for idxs in index_sets:
+            my_idxs = sorted(set(int(i) for i in idxs if int(i) in position))
+            if len(my_idxs) == 0:
+                results.append(None)
+            else:
+                rows = [position[i] for i in my_idxs]
+                results.append((frames[rows], my_idxs))
+        return results
+
+    def open_rounds(self, path, num_frames, rounds, jitter=0, seed=None):
+        """Opens a video for reading the frames of read_frames() in rounds,
+        for example a few evenly spaced frames first and the frames in 
+        between only if they are needed. See FrameRounds.
+
+        Arguments:
+            path: the video file
+            num_frames: how many frames read_frames() would read
+            rounds: a list of lists of positions in those num_frames frames
+            jitter, seed: see read_frames()
+        """
+        return FrameRounds(self, path, num_frames, rounds, jitter, seed)
+
+    def plan_reads(self, frame_idxs, keyframes, pos=0):
+        """Decides how to get from one requested frame to the next.
+
+        Without keyframe information the only safe option is to grab every
+        frame from the start of the video until the last requested index.
+        With it, we can also seek straight to a keyframe and grab forward 
+        from there. Seeking to an exact keyframe is reliable with OpenCV, 
+        unlike seeking to an arbitrary frame.
+
+        Cost model: grabbing a frame costs 1, a seek costs seek_cost. We 
+        seek to the last keyframe before the next target only if that 
+        skips more than seek_cost frames compared to scanning.
+
+        Arguments:
+            frame_idxs: a list of frame indices, sorted from low-to-high
+            keyframes: sorted array of keyframe indices, or None
+            pos: the frame the capture would grab next. To get to a frame
+                before it, we have to go back: to the keyframe before that
+                frame, or without keyframes, to the start of the video.
+
+        Returns a list of (seek_to, frame_idx) tuples, one for each unique
+        frame index, where seek_to is None if we should just keep grabbing.
+        """
+        plan = []
+        for frame_idx in sorted(set(int(i) for i in frame_idxs)):
+            seek_to = None
+            if keyframes is not None and len(keyframes) > 0:
+                k = np.searchsorted(keyframes, frame_idx, side="right") - 1
+                if k >= 0:
+                    keyframe = int(keyframes[k])
+                    if keyframe - pos > self.seek_cost or frame_idx < pos:
+                        seek_to = keyframe
+            if seek_to is None and frame_idx < pos:
+                seek_to = 0
+            plan.append((seek_to, frame_idx))
+            pos = frame_idx + 1
+        return plan
+
+    def _read_frames_at_indices(self, path, capture, frame_idxs, allocate=None):
+        try:
+            # A single chunk that holds all the frames. Decoding straight 
+            # into the output array avoids keeping a list of frames *and* 
+            # a stacked copy of them around at the same time. Duplicate
+            # indices are only read once.
+            num_frames = len(set(int(i) for i in frame_idxs))
+            for frames, idxs_read in self._iter_frames_at_indices(
+                    path, capture, frame_idxs, chunk_size=num_frames, allocate=allocate):
+                # If reading stopped early, this is a view of the first
+                # frames; copy them so the rest of the chunk can be freed.
+                # (Unless the caller gave us the array to decode into.)
+                if len(frames) < num_frames and allocate is None:
+                    frames = frames.copy()
+                return frames, idxs_read
 
-            if len(frames) > 0:
-                return np.stack(frames), idxs_read
             if self.verbose:
                 print("No frames read from movie %s" % path)
             return None
@@ -137,6 +385,80 @@ class VideoReader:
                 print("Exception while reading movie %s" % path)
             return None    
 
+    def _iter_frames_at_indices(self, path, capture, frame_idxs, chunk_size, buffer=None,
+                                allocate=None):
+        assert chunk_size > 0
+
+        keyframes = read_mp4_keyframes(path) if self.keyframe_seek else None
+        plan = self.plan_reads(frame_idxs, keyframes)
+
+        n = 0
+        idxs_read = []
+        pos = 0
+        for seek_to, frame_idx in plan:
+            pos, frame = self._read_next(path, capture, pos, seek_to, frame_idx)
+            if frame is None: break
+
+            # Only now do we know how large the frames are.
+            shape = (chunk_size,) + frame.shape
+            if buffer is None or buffer.shape != shape:
+                if allocate is not None:
+                    buffer = allocate(shape)
+                else:
+                    buffer = np.empty(shape, dtype=frame.dtype)
+
+            buffer[n] = frame
+            idxs_read.append(frame_idx)
+            n += 1
+
+            if n == chunk_size:
+                yield buffer, idxs_read
+                n = 0
+                idxs_read = []
+
+        if n > 0:
+            yield buffer[:n], idxs_read
+
+    def _read_next(self, path, capture, pos, seek_to, frame_idx, keep=(), kept=None):
+        """Moves the capture from position pos to frame_idx, seeking to 
+        seek_to first if it's not None, and returns the new position and
+        the frame (None if reading failed). Frames in keep that are passed
+        on the way are decoded too, and stored in the kept dictionary."""
+        grabbed = 0
+        try:
+            with metrics.stage("decode"):
+                if seek_to is not None:
+                    capture.set(cv2.CAP_PROP_POS_FRAMES, seek_to)
+                    pos = seek_to
+
+                # Get the next frames, but don't decode if we're not using them.
+                while pos <= frame_idx:
+                    ret = capture.grab()
+                    if not ret:
+                        if self.verbose:
+                            print("Error grabbing frame %d from movie %s" % (pos, path))
+                        return pos, None
+                    grabbed += 1
+                    if pos in keep and pos != frame_idx:
+                        ret, frame = capture.retrieve()
+                        if ret and frame is not None:
+                            kept[pos] = self._postprocess_frame(frame)
+                            metrics.count("frames_decoded")
+                    pos += 1
+
+                ret, frame = capture.retrieve()
+                if not ret or frame is None:
+                    if self.verbose:
+                        print("Error retrieving frame %d from movie %s" % (frame_idx, path))
+                    return pos, None
+
+                frame = self._postprocess_frame(frame)
+            metrics.count("frames_decoded")
+            return pos, frame
+        finally:
+            # How many frames the decoder went through, used or not.
+            metrics.count("frames_grabbed", grabbed)
+
     def read_middle_frame(self, path):
         """Reads the frame from the middle of the video."""
         capture = cv2.VideoCapture(path)
@@ -166,16 +488,27 @@ class VideoReader:
         return result
 
     def _read_frame_at_index(self, path, capture, frame_idx):
-        capture.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-        ret, frame = capture.read()    
+        with metrics.stage("decode"):
+            capture.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+            ret, frame = capture.read()    
+        metrics.count("frames_grabbed")
         if not ret or frame is None:
             if self.verbose:
                 print("Error retrieving frame %d from movie %s" % (frame_idx, path))
             return None
         else:
+            metrics.count("frames_decoded")
             frame = self._postprocess_frame(frame)
             return np.expand_dims(frame, axis=0), [frame_idx]
     
+    def _evenly_spaced_indices(self, frame_count, num_frames, jitter=0, seed=None):
+        frame_idxs = np.linspace(0, frame_count - 1, num_frames, endpoint=True, dtype=int)
+        if jitter > 0:
+            np.random.seed(seed)
+            jitter_offsets = np.random.randint(-jitter, jitter, len(frame_idxs))
+            frame_idxs = np.clip(frame_idxs + jitter_offsets, 0, frame_count - 1)
+        return frame_idxs
+
     def _postprocess_frame(self, frame):
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
 
@@ -189,4 +522,132 @@ class VideoReader:
             q = int(H * self.insets[1])
             frame = frame[q:-q, :, :]
 
-        return frame
\ No newline at end of file
+        return frame
+
+
+class FrameRounds:
+    """The frames of one video, read in rounds over a single open capture.
+
+    Made for adaptive sampling: read a few evenly spaced frames, look at 
+    them, and only then decide whether to read the ones in between. Doing 
+    each round with read_frames_at_indices() would open the video again 
+    and scan it from the start every time. Here the capture stays open, 
+    and every frame of a later round that is passed on the way to this 
+    round's frames is kept, so it is never decoded again. Only a frame 
+    that was skipped over by a keyframe seek needs a seek back.
+
+        with video_reader.open_rounds(path, 64, [[0, 8, 16], [4, 12]]) as rounds:
+            frames, frame_idxs = rounds.read(0)
+            if not_sure_yet:
+                frames, frame_idxs = rounds.read(1)
+
+    The video is only opened by the first read().
+    """
+
+    def __init__(self, video_reader, path, num_frames, rounds, jitter=0, seed=None):
+        """Use VideoReader.open_rounds() to make one of these."""
+        assert num_frames > 0
+        self.video_reader = video_reader
+        self.path = path
+        self.num_frames = num_frames
+        self.rounds = [list(positions) for positions in rounds]
+        self.jitter = jitter
+        self.seed = seed
+
+        self._opened = False
+        self._capture = None
+        self._frame_idxs = None
+        self._keyframes = None
+        self._pos = 0
+        self._failed = False
+        self._unread = set(range(len(self.rounds)))
+
+        # Decoded frames of later rounds, by frame index.
+        self._kept = {}
+
+    @property
+    def num_rounds(self):
+        return len(self.rounds)
+
+    def read(self, r):
+        """Reads the frames of round r.
+
+        Returns a NumPy array of shape (n, H, W, 3) and a list of the frame
+        indices, like read_frames(), or None if none of the frames could be
+        read. After a frame fails to read, only frames that were already 
+        kept are returned.
+
+        A video with fewer frames than num_frames has the same frame at 
+        several positions. Such a frame only belongs to the first round 
+        that has it, so a round can also come back empty: an array of 
+        shape (0, 0, 0, 3) and an empty list.
+        """
+        if not self._opened:
+            self._open()
+        self._unread.discard(r)
+        if self._frame_idxs is None: return None
+
+        reader = self.video_reader
+        earlier = self._round_frames(range(r))
+        wanted = sorted(self._round_frames([r]) - earlier)
+        later = self._round_frames(self._unread) - earlier - set(wanted)
+        if len(wanted) == 0:
+            return np.zeros((0, 0, 0, 3), dtype=np.uint8), []
+
+        frames = {}
+        for frame_idx in wanted:
+            if frame_idx in self._kept:
+                frames[frame_idx] = self._kept.pop(frame_idx)
+
+        if not self._failed:
+            to_read = [frame_idx for frame_idx in wanted if frame_idx not in frames]
+            try:
+                for seek_to, frame_idx in reader.plan_reads(to_read, self._keyframes, self._pos):
+                    self._pos, frame = reader._read_next(self.path, self._capture, self._pos,
+                                                         seek_to, frame_idx, later, self._kept)
+                    if frame is None:
+                        self._failed = True
+                        break
+                    frames[frame_idx] = frame
+            except:
+                if reader.verbose:
+                    print("Exception while reading movie %s" % self.path)
+                self._failed = True
+
+        if len(frames) == 0:
+            if reader.verbose:
+                print("No frames read from movie %s" % self.path)
+            return None
+        frame_idxs = sorted(frames)
+        return np.stack([frames[i] for i in frame_idxs]), frame_idxs
+
+    def _round_frames(self, rounds):
+        """The frame indices of the given rounds, as a set."""
+        return set(int(self._frame_idxs[p]) for r in rounds for p in self.rounds[r])
+
+    def _open(self):
+        self._opened = True
+        self._capture = cv2.VideoCapture(self.path)
+        frame_count = int(self._capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        if frame_count <= 0:
+            self.close()
+            return
+
+        reader = self.video_reader
+        self._frame_idxs = reader._evenly_spaced_indices(frame_count, self.num_frames,
+                                                         self.jitter, self.seed)
+        self._keyframes = read_mp4_keyframes(self.path) if reader.keyframe_seek else None
+
+    def close(self):
+        """Releases the video and any frames kept for later rounds."""
+        if self._capture is not None:
+            self._capture.release()
+            self._capture = None
+        self._failed = True
+        self._kept = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,379 @@
+"""A long-running scoring service that keeps the models loaded.
+
+Starting a batch job means importing torch, building the classifier and
+loading BlazeFace and the weights, which takes seconds before the first
+video is even opened. This server does all of that once and then scores
+videos on request, over local HTTP or a Unix socket:
+
+    python server.py --blazeface-dir blazeface --model model.pth --port 8000
+    python server.py --blazeface-dir blazeface --model model.pth --unix-socket /tmp/deepfake.sock
+
+Requests:
+
+    GET  /health    {"status": "ok", "queued": 0, "queue_size": 16}
+    GET  /metrics   per-stage timings and counters in the Prometheus text
+                    format (started with --metrics), or as JSON with
+                    ?format=json
+    POST /score     with a JSON body {"paths": ["a.mp4", "b.mp4"]} to score
+                    video files the server can read, or with the video
+                    itself as the body (Content-Type video/mp4 or
+                    application/octet-stream) and ?filename=a.mp4
+
+Both return {"results": [{"filename": ..., "label": ..., "result": ...}]},
+with the same fields as the result.csv written by predict_on_video_set.
+
+Requests are handled in parallel, but the models run on one worker thread
+that takes videos from a queue. When the queue is full, new requests are
+turned away right away with 503 and a Retry-After header instead of piling
+up, before their body is read: an upload first takes its place in the
+queue, and is then streamed to a temporary file. score_videos() is a small
+client for Python code.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class Busy(Exception):
+    """The queue doesn't have room for the request."""
+
+
+class ScoringService:
+    """Runs a DeepfakeDetector on one worker thread, fed by a bounded queue."""
+
+    def __init__(self, detector, queue_size=16):
+        """Creates a new ScoringService and starts its worker thread.
+
+        Arguments:
+            detector: a pipeline.DeepfakeDetector, or anything else with a
+                score(video_path, filename) method
+            queue_size: maximum number of videos that are waiting or being
+                scored; submit() raises Busy beyond that
+        """
+        self.detector = detector
+        self.queue_size = queue_size
+        self._jobs = queue.Queue()
+        self._lock = threading.Lock()
+        self._num_queued = 0
+
+        self._worker = threading.Thread(target=self._run, name="scoring-worker", daemon=True)
+        self._worker.start()
+
+    def queued(self):
+        """The number of videos waiting or being scored."""
+        with self._lock:
+            return self._num_queued
+
+    def reserve(self, count=1):
+        """Takes count places in the queue for videos that aren't there yet,
+        for example because they're still being uploaded. Raises Busy if
+        there isn't room. Pass reserved=count to submit() to use them, or
+        give them back with release()."""
+        with self._lock:
+            if self._num_queued + count > self.queue_size:
+                raise Busy()
+            self._num_queued += count
+
+    def release(self, count=1):
+        """Gives back places taken with reserve() that weren't used."""
+        with self._lock:
+            self._num_queued -= count
+
+    def submit(self, videos, reserved=0):
+        """Queues a list of (video_path, filename) pairs.
+
+        Either all of them are queued or, if there isn't room for all of
+        them, none are and Busy is raised. reserved is the number of places
+        already taken for them with reserve(); if Busy is raised, those are
+        still taken. Returns a Future for each video that resolves to its
+        result row.
+        """
+        with self._lock:
+            needed = len(videos) - reserved
+            if self._num_queued + needed > self.queue_size:
+                raise Busy()
+            self._num_queued += needed
+
+        futures = []
+        for video_path, filename in videos:
+            future = Future()
+            self._jobs.put((video_path, filename, future))
+            futures.append(future)
+        return futures
+
+    def close(self):
+        """Stops the worker thread after the queued videos are done."""
+        self._jobs.put(None)
+        self._worker.join()
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None: break
+
+            video_path, filename, future = job
+            try:
+                future.set_result(self.detector.score(video_path, filename))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._num_queued -= 1
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    # Set by make_server().
+    service = None
+    max_upload_bytes = None
+
+    # Uploads are copied to the temporary file in chunks of this size.
+    chunk_size = 1 << 20
+
+    def address_string(self):
+        # Unix socket clients don't have an address.
+        if isinstance(self.client_address, tuple) and len(self.client_address) > 0:
+            return self.client_address[0]
+        return "unix"
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message, headers=None):
+        # For answers sent without reading the request body: whatever is
+        # left of it must not be taken for the next request.
+        self.close_connection = True
+        self._send_json(status, { "error": message }, headers)
+
+    def _send_busy(self):
+        self._send_error(503, "busy, try again later", { "Retry-After": "1" })
+
+    def _copy_body(self, f, length):
+        # Returns False if the client went away before sending all of it.
+        while length > 0:
+            chunk = self.rfile.read(min(length, self.chunk_size))
+            if not chunk: return False
+            f.write(chunk)
+            length -= len(chunk)
+        return True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/health":
+            self._send_json(200, { "status": "ok",
+                                   "queued": self.service.queued(),
+                                   "queue_size": self.service.queue_size })
+        elif url.path == "/metrics":
+            from metrics import metrics
+            if parse_qs(url.query).get("format", [""])[0] == "json":
+                self._send_json(200, metrics.to_dict())
+                return
+            body = metrics.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self._send_json(404, { "error": "not found" })
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/score":
+            self._send_json(404, { "error": "not found" })
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self._send_error(400, "invalid Content-Length")
+            return
+        if length > self.max_upload_bytes:
+            self._send_error(413, "request body is larger than %d bytes" % self.max_upload_bytes)
+            return
+
+        # Turn the request away before reading its body if the queue is
+        # full. An upload takes its place in the queue now, so that it can't
+        # be read in only to find that there's no room left.
+        content_type = self.headers.get("Content-Type", "").split(";")[0].strip()
+        is_json = content_type == "application/json"
+        reserved = 0
+        try:
+            if is_json:
+                if self.service.queued() >= self.service.queue_size:
+                    raise Busy()
+            else:
+                self.service.reserve(1)
+                reserved = 1
+        except Busy:
+            self._send_busy()
+            return
+
+        tmp_path = None
+        try:
+            if is_json:
+                try:
+                    paths = json.loads(self.rfile.read(length).decode("utf-8"))["paths"]
+                    assert isinstance(paths, list)
+                except Exception:
+                    self._send_json(400, { "error": "expected {\"paths\": [...]}" })
+                    return
+                videos = [(path, os.path.basename(path)) for path in paths]
+            else:
+                filename = parse_qs(url.query).get("filename", ["video.mp4"])[0]
+                fd, tmp_path = tempfile.mkstemp(suffix=os.path.splitext(filename)[1] or ".mp4")
+                with os.fdopen(fd, "wb") as f:
+                    complete = self._copy_body(f, length)
+                if not complete:
+                    self._send_error(400, "incomplete request body")
+                    return
+                videos = [(tmp_path, filename)]
+
+            if len(videos) > self.service.queue_size:
+                self._send_json(413, { "error": "at most %d videos per request" % self.service.queue_size })
+                return
+
+            try:
+                futures = self.service.submit(videos, reserved=reserved)
+                reserved = 0
+            except Busy:
+                self._send_busy()
+                return
+
+            try:
+                results = [future.result() for future in futures]
+            except Exception as e:
+                self._send_json(500, { "error": str(e) })
+                return
+            self._send_json(200, { "results": results })
+        finally:
+            if reserved > 0:
+                self.service.release(reserved)
+            if tmp_path is not None:
+                os.remove(tmp_path)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # Like HTTPServer.server_bind(), which assumes a TCP address.
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def make_server(service, host="127.0.0.1", port=8000, unix_socket=None,
+                max_upload_bytes=512 * 1024**2):
+    """Creates an HTTP server for the service, on a TCP port or on a Unix
+    socket. Call serve_forever() on the result to run it."""
+    handler = type("Handler", (ScoringHandler,), { "service": service,
+                                                   "max_upload_bytes": max_upload_bytes })
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        return ThreadingUnixHTTPServer(unix_socket, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super(_UnixHTTPConnection, self).__init__("localhost", timeout=timeout)
+        self.unix_socket = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_socket)
+
+
+def score_videos(paths, host="127.0.0.1", port=8000, unix_socket=None, timeout=None):
+    """Asks a running server to score video files. Returns the result
+    rows, or raises Busy if the server's queue is full."""
+    if unix_socket is not None:
+        connection = _UnixHTTPConnection(unix_socket, timeout=timeout)
+    else:
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        body = json.dumps({ "paths": [os.path.abspath(path) for path in paths] })
+        connection.request("POST", "/score", body, { "Content-Type": "application/json" })
+        response = connection.getresponse()
+        data = json.loads(response.read().decode("utf-8"))
+    finally:
+        connection.close()
+
+    if response.status == 503:
+        raise Busy()
+    if response.status != 200:
+        raise RuntimeError("server error %d: %s" % (response.status, data.get("error")))
+    return data["results"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serves deepfake scores for videos.")
+    parser.add_argument("--blazeface-dir", required=True)
+    parser.add_argument("--model", required=True, help="classifier weights or exported model")
+    parser.add_argument("--backend", default="eager", choices=["eager", "torchscript", "onnx"])
+    parser.add_argument("--device", help="defaults to the GPU if there is one")
+    parser.add_argument("--frames-per-video", type=int, default=64)
+    parser.add_argument("--face-cache-dir")
+    parser.add_argument("--multi-face", action="store_true",
+                        help="score every person in a video, not just the best face per frame")
+    parser.add_argument("--detect-every", type=int, default=1,
+                        help="run the face detector on every Nth frame only and track the faces in between")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="start with a few frames and only read more while a video is too close to call")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix-socket", help="listen on this Unix socket instead of a TCP port")
+    parser.add_argument("--queue-size", type=int, default=16)
+    parser.add_argument("--metrics", action="store_true", help="collect the timings served on /metrics")
+    args = parser.parse_args(argv)
+
+    if args.metrics:
+        from metrics import metrics
+        metrics.enable()
+
+    from pipeline import DeepfakeDetector
+    detector = DeepfakeDetector(args.blazeface_dir, args.model, backend=args.backend,
+                                device=args.device, frames_per_video=args.frames_per_video,
+                                face_cache_dir=args.face_cache_dir, multi_face=args.multi_face,
+                                detect_every=args.detect_every, adaptive=args.adaptive)
+    service = ScoringService(detector, queue_size=args.queue_size)
+    server = make_server(service, args.host, args.port, args.unix_socket)
+
+    where = args.unix_socket if args.unix_socket is not None else "http://%s:%d" % (args.host, args.port)
+    print("Ready, listening on %s" % where)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if args.unix_socket is not None and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Splits video frames into the tiles that go through the face detector.
+
+This is plain NumPy and OpenCV, so that the decoder processes of
+decode_pool.py can tile the frames without importing PyTorch (which takes
+hundreds of MB and a couple of seconds per process). FaceExtractor uses
+the same functions, through its _tile_frames() and tiles_shape() methods.
+
+    tiles, resize_info = tile_frames(frames, (128, 128))
+"""
+
+import cv2
+import numpy as np
+
+from metrics import metrics
+
+
+def tile_layout(W, H):
+    """Returns (split_size, x_step, y_step, num_v, num_h) describing how
+    tile_frames() splits up a frame of W x H pixels. Frames that have
+    the same layout produce the same number of tiles."""
+    # Settings for 6 overlapping windows:
+    # split_size = 720
+    # x_step = 480
+    # y_step = 360
+    # num_v = 2
+    # num_h = 3
+
+    # Settings for 2 overlapping windows:
+    # split_size = min(H, W)
+    # x_step = W - split_size
+    # y_step = H - split_size
+    # num_v = 1
+    # num_h = 2 if W > H else 1
+
+    split_size = min(H, W)
+    x_step = (W - split_size) // 2
+    y_step = (H - split_size) // 2
+    num_v = 1
+    num_h = 3 if W > H else 1
+    return split_size, x_step, y_step, num_v, num_h
+
+
+def tile_grid(W, H, target_size):
+    """Describes the tiles for a frame of W x H pixels in terms of the
+    resized frame that tile_frames() cuts them from.
+
+    Returns (resized_w, resized_h, origins), where origins is a list with
+    the (x, y) position of each tile in the resized frame, in the order
+    the tiles are stored.
+    """
+    split_size, x_step, y_step, num_v, num_h = tile_layout(W, H)
+    target_w, target_h = target_size
+    resized_w = max(target_w, int(round(W * target_w / split_size)))
+    resized_h = max(target_h, int(round(H * target_h / split_size)))
+
+    origins = []
+    for v in range(num_v):
+        for h in range(num_h):
+            x = min(int(round(h * x_step * target_w / split_size)), resized_w - target_w)
+            y = min(int(round(v * y_step * target_h / split_size)), resized_h - target_h)
+            origins.append((x, y))
+    return resized_w, resized_h, origins
+
+
+def tiles_shape(num_frames, W, H, target_size):
+    """The shape of the array that tile_frames() returns for num_frames
+    frames of W x H pixels. Handy for preallocating the tiles."""
+    _, _, _, num_v, num_h = tile_layout(W, H)
+    return (num_frames * num_v * num_h, target_size[1], target_size[0], 3)
+
+
+def positions_to_detect(num_frames, detect_every):
+    """In tracking mode (detect_every > 1), returns the positions of the
+    frames that go through the face detector: every Nth frame, plus the
+    last one so there is something to interpolate towards. Returns None if
+    the detector should run on every frame."""
+    if detect_every <= 1 or num_frames <= 2:
+        return None
+    positions = list(range(0, num_frames, detect_every))
+    if positions[-1] != num_frames - 1:
+        positions.append(num_frames - 1)
+    return positions
+
+
+def tile_frames(frames, target_size, out=None):
+    """Splits each frame into several smaller, partially overlapping tiles
+    and resizes each tile to target_size.
+
+    After a bunch of experimentation, I found that for a 1920x1080 video,
+    BlazeFace works better on three 1080x1080 windows. These overlap by 420
+    pixels. (Two windows also work but it's best to have a clean center crop
+    in there as well.)
+
+    I also tried 6 windows of size 720x720 (horizontally: 720|360, 360|720;
+    vertically: 720|1200, 480|720|480, 1200|720) but that gives many false
+    positives when a window has no face in it.
+
+    For a video in portrait orientation (1080x1920), we only take a single
+    crop of the top-most 1080 pixels. If we split up the video vertically,
+    then we might get false positives again.
+
+    (NOTE: Not all videos are necessarily 1080p but the code can handle this.)
+
+    Because the windows overlap, resizing each window separately does a
+    lot of the work twice. Instead, every frame is resized just once, to
+    the scale that turns a window into a tile, and the tiles are copied
+    out of the resized frames (see tile_grid). The tile positions are
+    rounded to whole pixels of the resized frame, so they can be up to
+    half a tile pixel away from the exact window positions above.
+
+    Arguments:
+        frames: NumPy array of shape (num_frames, height, width, 3)
+        target_size: (width, height)
+        out: optional uint8 array to write the tiles into, for example a
+            slice of a larger detector batch; it is used only if it has
+            exactly the right shape
+
+    Returns:
+        - a new (num_frames * N, target_size[1], target_size[0], 3) array
+          where N is the number of tiles used.
+        - a list [scale_w, scale_h, offset_x, offset_y] that describes how
+          to map the resized and cropped tiles back to the original image
+          coordinates. This is needed for scaling up the face detections
+          from the smaller image to the original image, so we can take the
+          face crops in the original coordinate space.
+    """
+    num_frames, H, W, _ = frames.shape
+
+    target_w, target_h = target_size
+    resized_w, resized_h, origins = tile_grid(W, H, target_size)
+
+    shape = (num_frames * len(origins), target_h, target_w, 3)
+    if out is not None and out.shape == shape and out.dtype == np.uint8:
+        splits = out
+    else:
+        splits = np.zeros(shape, dtype=np.uint8)
+
+    with metrics.stage("tile"):
+        resized = np.empty((num_frames, resized_h, resized_w, 3), dtype=np.uint8)
+        for f in range(num_frames):
+            cv2.resize(frames[f], (resized_w, resized_h), dst=resized[f],
+                       interpolation=cv2.INTER_AREA)
+
+        # One copy per tile position, for all the frames at once.
+        tiles = splits.reshape(num_frames, len(origins), target_h, target_w, 3)
+        for t, (x, y) in enumerate(origins):
+            tiles[:, t] = resized[:, y:y+target_h, x:x+target_w]
+    metrics.count("tiles", len(splits))
+
+    resize_info = [W / resized_w, H / resized_h, 0, 0]
+    return splits, resize_info